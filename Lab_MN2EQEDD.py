@@ -7,15 +7,16 @@
 #   1. Script is being run with Python 3.6 on Windows 10. Script was created
 #      with Python 3.6.0 on Windows 10 Pro 21H1.
 #   2. User provides a directory which contains either one Lab_MN .zip file,
-#      or three delimited text files with certain strings in the file name.
+#      one .xlsx workbook with a sheet for each Lab_MN file, or three
+#      delimited text (or .xlsx) files with certain strings in the file
+#      name. Sheets and files are matched by the same strings.
 #   3. The Lab_MN and EQEDD contain the same set of fields as what was
 #      referenced when the script was created. The user will see whether this
 #      is true based on how EDP responds when the EQEDD is loaded. If the set
 #      of fields has changed, the user may need to tweak the script.
 #
-# Future to-do:
-#   - XML parsing to accept an .xlsx as an input, since that's how the MDH
-#     delivers Lab_MNs
+# The conversion can also be run from another script by importing this one
+# and calling convert_labmn().
 #
 # MIT License (https://en.wikipedia.org/wiki/MIT_License)
 #
@@ -40,9 +41,24 @@
 # SOFTWARE.
 
 import os
+import io
+import sys
+import ast
 import csv
-from zipfile import ZipFile
-import tempfile
+import json
+import time
+import argparse
+import re
+import shutil
+import hashlib
+import itertools
+import datetime
+import posixpath
+import contextlib
+import collections
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from zipfile import ZipFile, BadZipFile
 
 # Section within the pound signs are dictionaries containing the values in the
 # Lab_MN and the corresponding destination reference value. In some cases these
@@ -86,287 +102,1516 @@ lab_anl_method_name = {'lab_anl_method_name': 'lab_anl_method_name',
 total_or_dissolved = {'total_or_dissolved': 'total_or_dissolved',
                       'Total': 'dest_ref_val',
                       'Dissolved': 'dest_ref_val'}
+
+# Sets the value for sampling_company_code from the LabSample's sample_source
+# under the assumption the script is parsing an MDH Lab_MN. This isn't
+# necessarily the case since other labs can provide Lab_MNs, but this is
+# relatively uncommon. Any sample_source not listed gets 'dest_ref_for_MDH'.
+sampling_company_code = {'Field': 'dest_comp_code'}
 #######################################
 #######################################
 
 
-def sample_parser(mdh_labsample, dest_labsample, samples_to_skip):
-    '''Function to parse the Lab_MN LabSample_v1 file.
+def col(index):
+    '''Column spec for the value in column index of the Lab_MN row.'''
+    return ('col', index)
 
-    1. Takes in the input LabSample, the file path for the output LabSample,
-    and an empty list to contain samples to skip.
-    2. Parses the file to populate the list of samples to skip and creates the
-    output LabSample file in a temporary directory.
-    3. Returns the SDG# for use in results_parser().
-    '''
-    # Opens the Lab_MN LabSample file and output LabSample file, implemented
-    # from this stackoverflow post:
-    # https://stackoverflow.com/a/57518881
-    with open(mdh_labsample, newline='') as input_file, open(dest_labsample, 'w', newline='') as output_file:
-        
-        # In some cases, the first row of the file will be the header, so to
-        # give csv.Sniffer() a representative sample, skips twice to the third
-        # row. In rarer cases, it's possible the second row could be a
-        # description of the field.
-        next(input_file)
-        next(input_file)
-
-        # Automatically detects the "dialect" of the file. The dialect are
-        # things like delimiter character and quoting preference. This is done
-        # to avoid having the user specify what the character delimiter is and
-        # having to implement more lines to deal with that input. It assumes
-        # the script will only encounter comma- and tab-delimited files, but
-        # the user will need to tweak accordingly if they receive files
-        # delimited otherwise.
-        # https://docs.python.org/3.6/library/csv.html#csv.Sniffer
-        dialect = csv.Sniffer().sniff(input_file.readline(), [',', '\t'])
-        input_file.seek(0)
-
-        # Assigns the returned reader object to a variable using the dialect
-        # detected above. The same occurrs with the writing file but with
-        # specified dialect settings.
-        reader = csv.reader(input_file, dialect)
-        writer = csv.writer(output_file, delimiter='\t',
-                            quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-        # Iterates through the input file loaded in the reader object.
-        for row in reader:
 
-            # If the SDG# is blank or the sample type is QC-O, skip the row.
-            # In the context in which this script was designed, "non-site",
-            # or samples that are not from the SDG being processed, aren't
-            # uploaded to EQuIS and are skipped.
-            if row[7] == '' or row[4] == 'QC-O':
-                # Appends the undesired sample's sys_sample_code to
-                # samples_to_skip so they can be skipped in later functions.
-                samples_to_skip.append(row[0])
-                pass
-            else:
-                # Sets the SDG# for reference in results_parser().
-                field_sdg = row[7]
-
-                # Sets the value for sampling_company_code under the
-                # assumption the script is parsing an MDH Lab_MN. This isn't
-                # necessarily the case since other labs can provide Lab_MNs,
-                # but this is relatively uncommon.
-                if row[5] == 'Field':
-                    sampling_company_code = 'dest_comp_code'
-                else:
-                    sampling_company_code = 'dest_ref_for_MDH'
-                
-                # Writes the output row. lower() is used so referencing the
-                # dictionary doesn't break.
-                writer.writerow([row[0], row[0],
-                                 sample_matrix_code[row[3].lower()],
-                                 sample_type_code[row[4]], row[5], row[6],
-                                 row[7], row[8] + '  ' + row[9], '', '', '',
-                                 '', '', '', '', row[20],
-                                 sampling_company_code])
-
-    return field_sdg
-
-
-def results_parser(mdh_testresultsqc, dest_testresultsqc,
-                   samples_to_skip, field_sdg):
-    '''Function to parse the Lab_MN TestResultsQC_v1 file.
+def const(value):
+    '''Column spec for a fixed value.'''
+    return ('const', value)
 
-    1. Takes in the input TestResultsQC, the file path for the output
-    TestResultsQC, an empty list to contain samples to skip, and the SDG#
-    identified in sample_parser().
-    2. Parses the file to change various values and creates the output
-    TestResultsQC file in a temporary directory.
-    '''
-    # Opens the Lab_MN TestResultsQC file and output TestResultsQC file,
-    # implemented from this stackoverflow post:
-    # https://stackoverflow.com/a/57518881
-    with open(mdh_testresultsqc, newline='') as input_file, open(dest_testresultsqc, 'w', newline='') as output_file:
-        
-        # In some cases, the first row of the file will be the header, so to
-        # give csv.Sniffer() a representative sample, skips twice to the third
-        # row. In rarer cases, it's possible the second row could be a
-        # description of the field.
-        next(input_file)
-        next(input_file)
-
-        # Automatically detects the "dialect" of the file. The dialect are
-        # things like delimiter character and quoting preference. This is done
-        # to avoid having the user specify what the character delimiter is and
-        # having to implement more lines to deal with that input. It assumes
-        # the script will only encounter comma- and tab-delimited files, but
-        # the user will need to tweak accordingly if they receive files
-        # delimited otherwise.
-        # https://docs.python.org/3.6/library/csv.html#csv.Sniffer
-        dialect = csv.Sniffer().sniff(input_file.readline(), [',', '\t'])
-        input_file.seek(0)
-
-        # Assigns the returned reader object to a variable using the dialect
-        # detected above. The same occurrs with the writing file but with
-        # specified dialect settings.
-        reader = csv.reader(input_file, dialect)
-        writer = csv.writer(output_file, delimiter='\t',
-                            quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-        # Iterates through the input file loaded in the reader object.
-        for row in reader:
 
-            # If the sys_sample_code is present in the list of samples to
-            # skip, skip the row.
-            if row[0] in samples_to_skip:
-                pass
-            else:
-                # If the prep method is listed as "Unspecified", assume the
-                # prep method is just the lab_anl_method_name, otherwise use
-                # whatever's in lab_prep_method for the output.
-                if row[21] == 'Unspecified':
-                    lab_prep_method = 'METHOD'
+# Marks a lookup() without a default, so missing values raise KeyError.
+_REQUIRED = object()
+
+
+def lookup(index, table, key=None, default=_REQUIRED):
+    '''Column spec for the value in column index looked up in a dictionary.
+
+    If given, key is called on the value first, e.g. str.lower, and default
+    is used for values missing from the dictionary.
+    '''
+    return ('lookup', index, table, key, default)
+
+
+def join(separator, *indexes):
+    '''Column spec for the values in the given columns joined by separator.'''
+    return ('join', separator, indexes)
+
+
+def replace(index, old, new):
+    '''Column spec for the value in column index with old replaced by new.'''
+    return ('replace', index, old, new)
+
+
+def derive(func, *indexes):
+    '''Column spec for func called with the values in the given columns.'''
+    return ('derive', func, indexes)
+
+
+def param(name):
+    '''Column spec for a value passed in per file, e.g. field_sdg.'''
+    return ('param', name)
+
+
+def _lab_prep_method(prep_method):
+    '''If the prep method is listed as "Unspecified", assume the prep method
+    is just the lab_anl_method_name, otherwise use whatever's in
+    lab_prep_method for the output.
+    '''
+    if prep_method == 'Unspecified':
+        return 'METHOD'
+    return prep_method
+
+
+# Section within the pound signs are the column layouts of the EQEDD files.
+# Each entry is one output column, in order, built with the column spec
+# functions above from the Lab_MN row and the dictionaries. If the set of
+# fields changes, this is the only place that needs to be edited.
+#######################################
+#######################################
+# lower() is used on sample_matrix_code so referencing the dictionary doesn't
+# break. If the lab qualifier contains a <, it's replaced with a U, since
+# that's what was used for non-detects.
+LABSAMPLE_COLUMNS = (
+    col(0), col(0), lookup(3, sample_matrix_code, str.lower),
+    lookup(4, sample_type_code), col(5), col(6), col(7),
+    join('  ', 8, 9), const(''), const(''), const(''), const(''),
+    const(''), const(''), const(''), col(20),
+    lookup(5, sampling_company_code, default='dest_ref_for_MDH'))
+
+TESTRESULTSQC_COLUMNS = (
+    col(0), lookup(1, lab_anl_method_name), col(2),
+    lookup(3, total_or_dissolved), col(4), col(5), const('WQ'), const('LB'),
+    const('Wet'), col(27), col(20), derive(_lab_prep_method, 21), col(22),
+    const(''), const(''), const('dest_ref_for_MDH'), col(26), col(27),
+    col(28), const(''), const(''), col(31), col(32), const(''), const(''),
+    const(''), const(''), col(36), col(37), col(39), const(''), col(43),
+    const('Yes'), col(45), replace(47, '<', 'U'), const(''),
+    replace(47, '<', 'U'), const(''), col(48), col(49), col(49),
+    col(50), col(50), const(''), const(''), param('field_sdg'), col(56),
+    col(57), col(58), col(59), col(60), col(61), col(62), col(63), col(64),
+    col(65), col(66), col(67), col(68), col(69), col(70))
+
+TESTBATCH_COLUMNS = (
+    col(0), lookup(1, lab_anl_method_name), col(2),
+    lookup(3, total_or_dissolved), col(4), col(5), const('Analysis'), col(9))
+#######################################
+#######################################
+
+
+def _spec_node(spec, row, bind):
+    '''Returns the expression computing a lookup(), join(), replace() or
+    derive() column spec from the Lab_MN row, as an ast node. bind(value)
+    returns the name a dictionary or function is reached by.
+    '''
+    kind = spec[0]
+    if kind == 'lookup':
+        index, table, key, default = spec[1:]
+        value = row(index)
+
+        # str methods such as str.lower are called as methods, which is
+        # quicker than calling them as functions.
+        if key is not None and getattr(key, '__objclass__', None) is str:
+            value = ast.Call(func=ast.Attribute(value=value,
+                                                attr=key.__name__,
+                                                ctx=ast.Load()),
+                             args=[], keywords=[])
+        elif key is not None:
+            value = ast.Call(func=bind(key), args=[value], keywords=[])
+
+        if default is _REQUIRED:
+            return ast.Subscript(value=bind(table), slice=_index(value),
+                                 ctx=ast.Load())
+
+        # Without a key function, the value is checked for in the dictionary
+        # rather than calling get(), which is quicker.
+        if key is None:
+            return ast.IfExp(
+                test=ast.Compare(left=row(index), ops=[ast.In()],
+                                 comparators=[bind(table)]),
+                body=ast.Subscript(value=bind(table),
+                                   slice=_index(row(index)), ctx=ast.Load()),
+                orelse=bind(default))
+        return ast.Call(func=ast.Attribute(value=bind(table), attr='get',
+                                           ctx=ast.Load()),
+                        args=[value, bind(default)], keywords=[])
+    elif kind == 'join':
+        separator, indexes = spec[1:]
+        node = row(indexes[0])
+        for index in indexes[1:]:
+            node = ast.BinOp(left=ast.BinOp(left=node, op=ast.Add(),
+                                            right=ast.Constant(separator)),
+                             op=ast.Add(), right=row(index))
+        return node
+    elif kind == 'replace':
+        index, old, new = spec[1:]
+        return ast.Call(func=ast.Attribute(value=row(index), attr='replace',
+                                           ctx=ast.Load()),
+                        args=[ast.Constant(old), ast.Constant(new)],
+                        keywords=[])
+    elif kind == 'derive':
+        func, indexes = spec[1:]
+        return ast.Call(func=bind(func), args=[row(i) for i in indexes],
+                        keywords=[])
+    raise ValueError('Unknown column spec ' + repr(spec))
+
+
+def _index(node):
+    '''Wraps a subscript for the ast of Python before 3.9.'''
+    if sys.version_info >= (3, 9):
+        return node
+    return ast.Index(value=node)
+
+
+def compile_mapping(columns, params=()):
+    '''Function to compile a column layout into a row transformer.
+
+    1. Takes in a sequence of column specs and the names of the param()
+    values used in it.
+    2. Builds the syntax tree of a function returning the whole output row
+    as one list display, the same as the hand-written rows it replaces:
+    row[n] for each col(), the fixed strings inline, and an expression for
+    each computed spec. Dictionaries and functions are reached as globals
+    of the function, and a computed spec used by more than one column (such
+    as the lab qualifiers in TestResultsQC) is assigned to a local first, so
+    it's computed once per row. No source is generated; the tree is built
+    from the specs' values and compiled directly, so the function runs as
+    quickly as the hand-written rows.
+    3. Returns the function, which is called as transform(row, *params).
+    '''
+    bound = {}
+    names = {}
+
+    def bind(value):
+        # Dictionaries can't be hashed, so each value is bound by identity.
+        if id(value) not in names:
+            names[id(value)] = '_b%d' % len(bound)
+            bound[names[id(value)]] = value
+        return ast.Name(id=names[id(value)], ctx=ast.Load())
+
+    def row(index):
+        return ast.Subscript(value=ast.Name(id='row', ctx=ast.Load()),
+                             slice=_index(ast.Constant(index)),
+                             ctx=ast.Load())
+
+    def signature(spec):
+        return tuple(id(part) if isinstance(part, dict) else part
+                     for part in spec)
+
+    uses = collections.Counter(signature(spec) for spec in columns)
+    assignments = []
+    local = {}
+    values = []
+    for spec in columns:
+        kind = spec[0]
+        if kind == 'col':
+            values.append(row(spec[1]))
+        elif kind == 'const' and isinstance(spec[1], str):
+            values.append(ast.Constant(spec[1]))
+        elif kind == 'const':
+            values.append(bind(spec[1]))
+        elif kind == 'param':
+            if spec[1] not in params:
+                raise ValueError('param ' + repr(spec[1]) + ' not declared')
+            values.append(ast.Name(id=spec[1], ctx=ast.Load()))
+        # Lookups with a default are conditional expressions, which run
+        # quicker assigned to a local first, as the hand-written rows did,
+        # than inside the list display.
+        elif uses[signature(spec)] == 1 and not (
+                kind == 'lookup' and spec[4] is not _REQUIRED):
+            values.append(_spec_node(spec, row, bind))
+        else:
+            if signature(spec) not in local:
+                name = '_v%d' % len(local)
+                local[signature(spec)] = name
+                assignments.append(ast.Assign(
+                    targets=[ast.Name(id=name, ctx=ast.Store())],
+                    value=_spec_node(spec, row, bind)))
+            values.append(ast.Name(id=local[signature(spec)],
+                                   ctx=ast.Load()))
+
+    arguments = ast.arguments(
+        posonlyargs=[], args=[ast.arg(arg=name, annotation=None)
+                              for name in ('row',) + tuple(params)],
+        vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+    function = ast.FunctionDef(
+        name='transform', args=arguments,
+        body=assignments + [ast.Return(value=ast.List(elts=values,
+                                                      ctx=ast.Load()))],
+        decorator_list=[], returns=None, type_params=[])
+    module = ast.fix_missing_locations(ast.Module(body=[function],
+                                                  type_ignores=[]))
+    namespace = dict(bound)
+    exec(compile(module, '<compile_mapping>', 'exec'), namespace)
+    return namespace['transform']
+
+
+# Row transformers for each EQEDD file, compiled once when the script loads.
+_labsample_row = compile_mapping(LABSAMPLE_COLUMNS)
+_testresultsqc_row = compile_mapping(TESTRESULTSQC_COLUMNS, ('field_sdg',))
+_testbatch_row = compile_mapping(TESTBATCH_COLUMNS, ('field_sdg',))
+
+
+# Substrings identifying each Lab_MN file (case insensitive), and the name of
+# the EQEDD file each one is converted to inside the output .zip.
+LABMN_FILES = ('labsample', 'testresultsqc', 'testbatch')
+EQEDD_FILES = {'labsample': 'out.LabSample_v1.txt',
+               'testresultsqc': 'out.TestResultsQC_v1.txt',
+               'testbatch': 'out.TestBatch_v1.txt'}
+
+
+def _labmn_reader(input_file):
+    '''Function to create a csv reader for a Lab_MN text stream.
+
+    1. Takes in an open text stream of a Lab_MN file, either a file on disk or
+    a member of a .zip.
+    2. Detects the dialect of the file without seeking, so the stream can be
+    read straight out of a .zip.
+    3. Returns a csv reader over every row of the file, header included.
+    '''
+    # In some cases, the first row of the file will be the header, so to
+    # give csv.Sniffer() a representative sample, reads up to the third
+    # row. In rarer cases, it's possible the second row could be a
+    # description of the field. The rows read here are chained back in front
+    # of the rest of the stream, since .zip members can't be rewound with
+    # seek() on Python 3.6.
+    head = list(itertools.islice(input_file, 3))
+
+    # Automatically detects the "dialect" of the file. The dialect are
+    # things like delimiter character and quoting preference. This is done
+    # to avoid having the user specify what the character delimiter is and
+    # having to implement more lines to deal with that input. It assumes
+    # the script will only encounter comma- and tab-delimited files, but
+    # the user will need to tweak accordingly if they receive files
+    # delimited otherwise.
+    # https://docs.python.org/3.6/library/csv.html#csv.Sniffer
+    dialect = csv.Sniffer().sniff(head[-1], [',', '\t'])
+
+    return csv.reader(itertools.chain(head, input_file), dialect)
+
+
+def _eqedd_writer(output_file):
+    '''Function to create a csv writer for an EQEDD text stream.'''
+    return csv.writer(output_file, delimiter='\t',
+                      quotechar='"', quoting=csv.QUOTE_MINIMAL)
+
+
+# Built-in number formats Excel treats as dates and/or times, by numFmtId.
+_XLSX_DATE_FORMATS = {14, 15, 16, 17, 22}
+_XLSX_TIME_FORMATS = {18, 19, 20, 21, 22, 45, 46, 47}
+
+
+def _local_name(tag):
+    '''Returns an XML tag or attribute name without its namespace.'''
+    return tag.rpartition('}')[2]
+
+
+def _xlsx_sheets(workbook):
+    '''Function to list the worksheets of an open .xlsx ZipFile.
+
+    Returns an OrderedDict of sheet name to the worksheet's member name, in
+    workbook order.
+    '''
+    targets = {}
+    with workbook.open('xl/_rels/workbook.xml.rels') as rels_file:
+        for rel in ET.parse(rels_file).getroot():
+            targets[rel.get('Id')] = rel.get('Target')
+
+    sheets = collections.OrderedDict()
+    with workbook.open('xl/workbook.xml') as workbook_file:
+        for element in ET.parse(workbook_file).iter():
+            if _local_name(element.tag) == 'sheet':
+                rel_id = [value for name, value in element.items()
+                          if _local_name(name) == 'id'][0]
+                target = targets[rel_id]
+
+                # Targets are relative to xl/ unless they start with /.
+                if target.startswith('/'):
+                    target = target[1:]
                 else:
-                    lab_prep_method = row[21]
-                
-                # If the lab qualifier contains a <, replace it with a U,
-                # since that's what was used for non=detects.
-                if '<' in row[47]:
-                    lab_qualifiers = row[47].replace('<', 'U')
+                    target = posixpath.normpath(posixpath.join('xl', target))
+                sheets[element.get('name')] = target
+
+    return sheets
+
+
+def xlsx_sheet_names(xlsx_path):
+    '''Returns the worksheet names of an .xlsx, in workbook order.'''
+    with ZipFile(xlsx_path, 'r') as workbook:
+        return list(_xlsx_sheets(workbook))
+
+
+def _xlsx_shared_strings(workbook):
+    '''Function to read the shared strings table of an open .xlsx ZipFile.
+
+    Returns a list of the strings, which cells of type "s" index into. Rich
+    text runs are joined, and phonetic hints are left out.
+    '''
+    strings = []
+    if 'xl/sharedStrings.xml' not in workbook.namelist():
+        return strings
+
+    with workbook.open('xl/sharedStrings.xml') as strings_file:
+        for _, element in ET.iterparse(strings_file):
+            if _local_name(element.tag) == 'si':
+                text = []
+                for child in element:
+                    name = _local_name(child.tag)
+                    if name == 't':
+                        text.append(child.text or '')
+                    elif name == 'r':
+                        text.extend(run.text or '' for run in child
+                                    if _local_name(run.tag) == 't')
+                strings.append(''.join(text))
+                element.clear()
+
+    return strings
+
+
+def _xlsx_date_styles(workbook):
+    '''Function to find the cell styles of an open .xlsx ZipFile that format
+    numbers as dates or times.
+
+    Returns a dictionary of style index to a tuple of whether the style shows
+    a date and whether it shows a time. Styles not formatted as either are
+    left out.
+    '''
+    if 'xl/styles.xml' not in workbook.namelist():
+        return {}
+
+    with workbook.open('xl/styles.xml') as styles_file:
+        root = ET.parse(styles_file).getroot()
+
+    # Custom number formats are recognized by the date and time codes in
+    # them, with anything quoted or in brackets (colors, locales) removed.
+    formats = {}
+    for element in root.iter():
+        if _local_name(element.tag) == 'numFmt':
+            code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.', '',
+                          element.get('formatCode', '')).lower()
+            formats[int(element.get('numFmtId'))] = (
+                'd' in code or 'y' in code,
+                'h' in code or 's' in code)
+
+    styles = {}
+    for element in root.iter():
+        if _local_name(element.tag) == 'cellXfs':
+            for n, xf in enumerate(element):
+                format_id = int(xf.get('numFmtId', 0))
+                if format_id in formats:
+                    is_date, is_time = formats[format_id]
                 else:
-                    lab_qualifiers = row[47]
-                
-                # Writes the output row.
-                writer.writerow([row[0], lab_anl_method_name[row[1]], row[2],
-                                 total_or_dissolved[row[3]], row[4], row[5],
-                                 'WQ', 'LB', 'Wet', row[27], row[20],
-                                 lab_prep_method, row[22], '', '',
-                                 'dest_ref_for_MDH', row[26], row[27], row[28],
-                                 '', '', row[31], row[32], '', '', '', '',
-                                 row[36], row[37], row[39], '', row[43], 'Yes',
-                                 row[45], lab_qualifiers, '', lab_qualifiers,
-                                 '', row[48], row[49], row[49], row[50],
-                                 row[50], '', '', field_sdg, row[56], row[57],
-                                 row[58], row[59], row[60], row[61], row[62],
-                                 row[63], row[64], row[65], row[66], row[67],
-                                 row[68], row[69], row[70]])
-
-
-def batch_parser(mdh_testbatch, dest_testbatch, samples_to_skip):
+                    is_date = format_id in _XLSX_DATE_FORMATS
+                    is_time = format_id in _XLSX_TIME_FORMATS
+                if is_date or is_time:
+                    styles[n] = (is_date, is_time)
+
+    return styles
+
+
+def _xlsx_date(serial, is_date, is_time, epoch):
+    '''Formats an Excel date serial number the way a delimited Lab_MN shows
+    dates (M/D/YYYY) and times (H:MM).
+    '''
+    moment = epoch + datetime.timedelta(days=float(serial))
+
+    # Rounds to the nearest minute, since serials are rarely exact.
+    moment = moment + datetime.timedelta(seconds=30)
+    parts = []
+    if is_date:
+        parts.append('%d/%d/%d' % (moment.month, moment.day, moment.year))
+    if is_time:
+        parts.append('%d:%02d' % (moment.hour, moment.minute))
+    return ' '.join(parts)
+
+
+def _xlsx_number(text):
+    '''Formats a number stored in a cell the way it shows in Excel, e.g.
+    "1.1999999999999999E-3" as "0.0012".
+    '''
+    if 'E' not in text and '.' not in text:
+        return text
+    number = float(text)
+    if number.is_integer() and abs(number) < 1e15:
+        return str(int(number))
+    return repr(number)
+
+
+def xlsx_rows(xlsx_path, sheet=None):
+    '''Generator yielding the rows of one worksheet of an .xlsx.
+
+    1. Takes in the file path of the .xlsx and the name of the worksheet
+    (None for the first one).
+    2. Streams the worksheet's XML out of the .xlsx with iterparse(), so only
+    one row is held in memory at a time, besides the shared strings table.
+    3. Yields each row as a list of strings, the same as a csv reader over
+    the delimited text version of the sheet would. Empty cells are '', rows
+    are padded to the width of the sheet, and empty rows are left out.
+    '''
+    with ZipFile(xlsx_path, 'r') as workbook:
+        sheets = _xlsx_sheets(workbook)
+        if sheet is None:
+            sheet = list(sheets)[0]
+        strings = _xlsx_shared_strings(workbook)
+        date_styles = _xlsx_date_styles(workbook)
+
+        # Workbooks from Excel for Mac may count dates from 1904.
+        with workbook.open('xl/workbook.xml') as workbook_file:
+            date1904 = re.search(rb'date1904="(1|true)"', workbook_file.read())
+        if date1904:
+            epoch = datetime.datetime(1904, 1, 1)
+        else:
+            epoch = datetime.datetime(1899, 12, 30)
+
+        with workbook.open(sheets[sheet]) as sheet_file:
+            yield from _xlsx_sheet_rows(sheet_file, strings, date_styles,
+                                        epoch)
+
+
+def _xlsx_sheet_rows(sheet_file, strings, date_styles, epoch):
+    '''Generator doing the parsing for xlsx_rows().'''
+    width = 0
+    columns = {}
+    sheet_data = None
+    row_tag = cell_tag = value_tag = inline_tag = None
+
+    for event, element in ET.iterparse(sheet_file, ('start', 'end')):
+        if event == 'start':
+            # The namespace is taken from the root element, so both
+            # transitional and strict .xlsx files can be read.
+            if row_tag is None:
+                namespace = element.tag[:element.tag.find('}') + 1]
+                row_tag = namespace + 'row'
+                cell_tag = namespace + 'c'
+                value_tag = namespace + 'v'
+                inline_tag = namespace + 'is'
+            elif _local_name(element.tag) == 'sheetData':
+                sheet_data = element
+
+            # The sheet dimension (e.g. A1:BS5000) gives the width up front.
+            elif _local_name(element.tag) == 'dimension':
+                last = element.get('ref', '').rpartition(':')[2]
+                width = _xlsx_column(last.rstrip('0123456789'), columns) + 1
+            continue
+
+        if element.tag != row_tag:
+            continue
+
+        row = []
+        for cell in element.iter(cell_tag):
+            # Cells are only stored when they have a value, so skipped
+            # columns are filled in from the cell reference (e.g. BS12).
+            ref = cell.get('r')
+            if ref is not None:
+                column = _xlsx_column(ref.rstrip('0123456789'), columns)
+                if column > len(row):
+                    row.extend([''] * (column - len(row)))
+
+            cell_type = cell.get('t')
+            value = cell.find(value_tag)
+            if cell_type == 'inlineStr':
+                inline = cell.find(inline_tag)
+                text = '' if inline is None else ''.join(inline.itertext())
+            elif value is None or value.text is None:
+                text = ''
+            elif cell_type == 's':
+                text = strings[int(value.text)]
+            elif cell_type == 'b':
+                text = 'TRUE' if value.text == '1' else 'FALSE'
+            elif cell_type in ('str', 'e'):
+                text = value.text
+            elif int(cell.get('s', 0)) in date_styles:
+                is_date, is_time = date_styles[int(cell.get('s'))]
+                text = _xlsx_date(value.text, is_date, is_time, epoch)
+            else:
+                text = _xlsx_number(value.text)
+            row.append(text)
+
+        # Rows already read are dropped from the tree to bound memory.
+        if sheet_data is not None:
+            sheet_data.clear()
+        else:
+            element.clear()
+
+        if row:
+            if len(row) > width:
+                width = len(row)
+            elif len(row) < width:
+                row.extend([''] * (width - len(row)))
+            yield row
+
+
+def _xlsx_column(letters, columns):
+    '''Converts column letters (e.g. BS) to a 0-based index, caching them in
+    the columns dictionary.
+    '''
+    column = columns.get(letters)
+    if column is None:
+        column = 0
+        for letter in letters:
+            column = column * 26 + ord(letter.upper()) - 64
+        column = columns[letters] = column - 1
+    return column
+
+
+# The LabSample details of one sample kept by sample_parser().
+Sample = collections.namedtuple(
+    'Sample', ['field_sdg', 'sample_matrix_code', 'sample_type_code'])
+
+
+class SampleIndex(object):
+    '''Index of the samples in a LabSample, built by sample_parser().
+
+    skipped is the set of sys_sample_codes skipped in the other files,
+    samples maps every other sys_sample_code to its Sample, and sdgs holds
+    the SDG#s as the keys of a dict, in the order they were first seen.
+    '''
+
+    def __init__(self):
+        self.skipped = set()
+        self.samples = {}
+        self.sdgs = {}
+
+    def add(self, sys_sample_code, field_sdg, sample_matrix_code,
+            sample_type_code):
+        '''Adds a sample kept for the EQEDD of its SDG#.'''
+        self.sdgs[field_sdg] = None
+        self.samples[sys_sample_code] = Sample(field_sdg, sample_matrix_code,
+                                               sample_type_code)
+
+
+def _is_header(row):
+    '''Returns whether a Lab_MN row is the header row.'''
+    return row[0] == 'sys_sample_code'
+
+
+def _is_skipped_sample(row):
+    '''Returns whether a LabSample row is for a sample to skip.
+
+    If the SDG# is blank or the sample type is QC-O, skip the row. In the
+    context in which this script was designed, "non-site", or samples that
+    are not from the SDG being processed, aren't uploaded to EQuIS and are
+    skipped.
+    '''
+    return row[7] == '' or row[4] == 'QC-O'
+
+
+def sample_parser(reader, writers, index):
+    '''Function to parse the Lab_MN LabSample_v1 file.
+
+    1. Takes in a reader over the input LabSample rows, the output LabSample
+    writers keyed by SDG# (see _EqeddWriters), and an empty SampleIndex.
+    2. Parses the rows to populate the index, and writes the output LabSample
+    rows laid out by LABSAMPLE_COLUMNS to the writer for their SDG#. The
+    header row is written for every SDG#.
+    '''
+    transform = _labsample_row
+    header = []
+
+    # Iterates through the input file loaded in the reader object.
+    for row in reader:
+
+        # The header row is held until the writer for each SDG# is opened.
+        if _is_header(row):
+            header.append(transform(row))
+
+        # Samples that aren't from an SDG being processed are skipped.
+        elif _is_skipped_sample(row):
+            # Adds the undesired sample's sys_sample_code to the set of
+            # samples to skip so they can be skipped in later functions.
+            index.skipped.add(row[0])
+        else:
+            field_sdg = row[7]
+            index.add(row[0], field_sdg, row[3], row[4])
+            if field_sdg not in writers:
+                writers[field_sdg].writerows(header)
+
+            # Writes the output row.
+            writers[field_sdg].writerow(transform(row))
+
+
+def _route_rows(reader, writers, index, transform):
+    '''Function to write each row of a file to the writer for the SDG# of
+    its sample, used by results_parser() and batch_parser().
+
+    Rows for skipped samples are dropped. Rows for samples not in the
+    LabSample, like the header row, are written for every SDG#. transform is
+    called with the row and the SDG# it's being written for.
+    '''
+    samples = index.samples
+    skipped = index.skipped
+    writerows = {field_sdg: writers[field_sdg].writerow
+                 for field_sdg in index.sdgs}
+
+    # Iterates through the input file loaded in the reader object. Samples
+    # are looked up in the index first, since those rows are the ones
+    # written, so skipped samples are only checked for when it misses.
+    for row in reader:
+        sample = samples.get(row[0])
+        if sample is not None:
+            field_sdg = sample.field_sdg
+            writerows[field_sdg](transform(row, field_sdg))
+        elif row[0] not in skipped:
+            for field_sdg, writerow in writerows.items():
+                writerow(transform(row, field_sdg))
+
+
+def results_parser(reader, writers, index):
+    '''Function to parse the Lab_MN TestResultsQC_v1 file.
+
+    1. Takes in a reader over the input TestResultsQC rows, the output
+    TestResultsQC writers keyed by SDG#, and the SampleIndex built by
+    sample_parser().
+    2. Writes the output TestResultsQC rows laid out by
+    TESTRESULTSQC_COLUMNS, with the SDG# of each row's sample.
+    '''
+    _route_rows(reader, writers, index, _testresultsqc_row)
+
+
+def batch_parser(reader, writers, index):
     '''Function to parse the Lab_MN TestBatch_v1 file.
 
-    1. Takes in the input TestBatch, the file path for the output TestBatch,
-    and an empty list to contain samples to skip.
-    2. Parses the file to change various values and creates the output
-    TestBatch file in a temporary directory.
-    '''
-    # Opens the Lab_MN TestBatch file and output TestBatch file, implemented
-    # from this stackoverflow post:
-    # https://stackoverflow.com/a/57518881
-    with open(mdh_testbatch, newline='') as input_file, open(dest_testbatch, 'w', newline='') as output_file:
-
-        # In some cases, the first row of the file will be the header, so to
-        # give csv.Sniffer() a representative sample, skips twice to the third
-        # row. In rarer cases, it's possible the second row could be a
-        # description of the field.        
-        next(input_file)
-        next(input_file)
-
-        # Automatically detects the "dialect" of the file. The dialect are
-        # things like delimiter character and quoting preference. This is done
-        # to avoid having the user specify what the character delimiter is and
-        # having to implement more lines to deal with that input. It assumes
-        # the script will only encounter comma- and tab-delimited files, but
-        # the user will need to tweak accordingly if they receive files
-        # delimited otherwise.
-        # https://docs.python.org/3.6/library/csv.html#csv.Sniffer
-        dialect = csv.Sniffer().sniff(input_file.readline(), [',', '\t'])
-        input_file.seek(0)
-
-        # Assigns the returned reader object to a variable using the dialect
-        # detected above. The same occurrs with the writing file but with
-        # specified dialect settings.        
-        reader = csv.reader(input_file, dialect)
-        writer = csv.writer(output_file, delimiter='\t',
-                            quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        
-        # Iterates through the input file loaded in the reader object.
+    1. Takes in a reader over the input TestBatch rows, the output TestBatch
+    writers keyed by SDG#, and the SampleIndex built by sample_parser().
+    2. Writes the output TestBatch rows laid out by TESTBATCH_COLUMNS.
+    '''
+    _route_rows(reader, writers, index, _testbatch_row)
+
+
+def _match_labmn(names):
+    '''Function to match file names to the three Lab_MN files.
+
+    Returns a dictionary with a key from LABMN_FILES for each name containing
+    that string. lower() is used to aid string comparison.
+    '''
+    found = {}
+    for name in names:
+        for key in LABMN_FILES:
+            if key in os.path.basename(name).lower():
+                found[key] = name
+    return found
+
+
+def _labmn_archives(dir_path, names):
+    '''Generator yielding (file path, None) for the .zips and .xlsx
+    workbooks in a directory that hold all three Lab_MN files, and
+    (file path, error) for those that can't be read. EQEDDs written into the
+    directory by a previous run are ignored.
+    '''
+    for name in names:
+        path = os.path.join(dir_path, name)
+        try:
+            if name.lower().endswith('.eqedd.zip'):
+                continue
+            elif name.lower().endswith('.zip'):
+                with ZipFile(path, 'r') as edd_zip:
+                    found = _match_labmn(edd_zip.namelist())
+            elif name.lower().endswith('.xlsx') and not _match_labmn([name]):
+                found = _match_labmn(xlsx_sheet_names(path))
+            else:
+                continue
+        except (BadZipFile, OSError, KeyError, ET.ParseError) as e:
+            yield path, e
+            continue
+        if len(found) == 3:
+            yield path, None
+
+
+def _sorted_names(names):
+    '''Sorts the file names in a directory, leaving out the ~$ lock files
+    Excel leaves next to open workbooks.
+    '''
+    return sorted(name for name in names if not name.startswith('~$'))
+
+
+def _find_labmn(source):
+    '''Function to locate the three files of a Lab_MN.
+
+    1. Takes in the file path of a Lab_MN .zip or .xlsx workbook, or of a
+    directory containing one of those or the three files as delimited text
+    or .xlsx files.
+    2. Returns a dictionary keyed by LABMN_FILES of tuples of the kind of
+    file ('text', 'zip' for a .zip member, or 'xlsx'), its file path, and
+    the .zip member or worksheet name (None for the first worksheet).
+    '''
+    if os.path.isdir(source):
+        names = _sorted_names(os.listdir(source))
+
+        # If a .zip or workbook is present the loose files are skipped.
+        unreadable = []
+        for path, error in _labmn_archives(source, names):
+            if error is None:
+                return _find_labmn(path)
+            unreadable.append(os.path.basename(path) + ': ' + str(error))
+
+        files = {}
+        for key, name in _match_labmn(names).items():
+            kind = 'xlsx' if name.lower().endswith('.xlsx') else 'text'
+            files[key] = (kind, os.path.join(source, name), None)
+    elif source.lower().endswith('.xlsx'):
+        files = {key: ('xlsx', source, sheet) for key, sheet
+                 in _match_labmn(xlsx_sheet_names(source)).items()}
+    else:
+        with ZipFile(source, 'r') as edd_zip:
+            files = {key: ('zip', source, member) for key, member
+                     in _match_labmn(edd_zip.namelist()).items()}
+
+    missing = [key for key in LABMN_FILES if key not in files]
+    if missing:
+        message = ('No Lab_MN ' + ', '.join(missing) + ' file found in ' +
+                   source)
+        if os.path.isdir(source) and unreadable:
+            message += ' (could not read ' + '; '.join(unreadable) + ')'
+        raise FileNotFoundError(message)
+
+    return files
+
+
+@contextlib.contextmanager
+def _open_labmn(labmn, key):
+    '''Context manager yielding a reader over the rows of one Lab_MN file.
+
+    Rows are streamed straight out of the .zip member or worksheet, if the
+    Lab_MN is a .zip or .xlsx, so nothing is extracted to disk.
+    '''
+    kind, path, member = labmn[key]
+    if kind == 'text':
+        with open(path, newline='') as input_file:
+            yield _labmn_reader(input_file)
+    elif kind == 'zip':
+        with ZipFile(path, 'r') as edd_zip, \
+                edd_zip.open(member, 'r') as zip_member, \
+                io.TextIOWrapper(zip_member, newline='') as input_file:
+            yield _labmn_reader(input_file)
+    else:
+        rows = xlsx_rows(path, member)
+        try:
+            yield rows
+        finally:
+            rows.close()
+
+
+@contextlib.contextmanager
+def _open_eqedd(new_zip, key):
+    '''Context manager yielding a writer over one entry of the EQEDD .zip.
+
+    Rows are compressed straight into the output .zip as they're written.
+    '''
+    with new_zip.open(EQEDD_FILES[key], 'w') as entry, \
+            io.TextIOWrapper(entry, newline='') as output_file:
+        yield _eqedd_writer(output_file)
+
+
+class UnmappedValuesError(Exception):
+    '''Raised by validate_labmn() when Lab_MN values are missing from the
+    dictionaries. unmapped maps each dictionary's name to the sorted list of
+    values missing from it.
+    '''
+
+    def __init__(self, source, unmapped):
+        self.source = source
+        self.unmapped = unmapped
+        lines = ['Values missing from the dictionaries in ' + source +
+                 ', add them and rerun:']
+        for name, values in sorted(unmapped.items()):
+            lines.append('  ' + name + ': ' + ', '.join(map(repr, values)))
+        super().__init__('\n'.join(lines))
+
+
+def _dictionary_name(table):
+    '''Returns the name of one of the dictionaries at the top of the script.'''
+    for name, value in globals().items():
+        if value is table:
+            return name
+    return repr(table)
+
+
+def _required_lookups(columns):
+    '''Returns the index, dictionary and key function of each lookup() in a
+    column layout without a default, since those raise KeyError on values
+    missing from the dictionary. Repeated lookups are only returned once.
+    '''
+    lookups = []
+    for spec in columns:
+        if spec[0] == 'lookup' and spec[4] is _REQUIRED:
+            lookup = spec[1:4]
+            if not any(lookup[0] == l[0] and lookup[1] is l[1]
+                       for l in lookups):
+                lookups.append(lookup)
+    return lookups
+
+
+def _scan_lookups(labmn, key, columns):
+    '''Function run by validate_labmn() for each Lab_MN file.
+
+    1. Takes in the Lab_MN located by _find_labmn(), the LABMN_FILES key of
+    the file to scan, and the file's column layout.
+    2. Reads only the sys_sample_code and looked up columns of each row.
+    3. Returns a dictionary of (dictionary name, value) for each value
+    missing from a dictionary to the set of sys_sample_codes with it, and the
+    set of samples a LabSample skips (empty for other files).
+    '''
+    lookups = _required_lookups(columns)
+    unmapped = collections.defaultdict(set)
+    skipped = set()
+
+    with _open_labmn(labmn, key) as reader:
         for row in reader:
+            if (key == 'labsample' and not _is_header(row) and
+                    _is_skipped_sample(row)):
+                skipped.add(row[0])
+                continue
+            for index, table, func in lookups:
+                value = row[index] if func is None else func(row[index])
+                if value not in table:
+                    unmapped[(_dictionary_name(table), value)].add(row[0])
+
+    return unmapped, skipped
+
+
+def validate_labmn(source, labmn=None):
+    '''Function to find every Lab_MN value missing from the dictionaries
+    before any conversion work starts.
+
+    1. Takes in the file path of the Lab_MN, and optionally the Lab_MN as
+    already located by _find_labmn().
+    2. Scans the three files at the same time, reading only the columns the
+    column layouts look up in the dictionaries. Values are only reported if
+    the conversion would look them up, so rows of skipped samples are left
+    out, the same as in the parsers.
+    3. Raises UnmappedValuesError listing every missing value at once, or
+    returns None if there are none.
+    '''
+    if labmn is None:
+        labmn = _find_labmn(source)
+    layouts = {'labsample': LABSAMPLE_COLUMNS,
+               'testresultsqc': TESTRESULTSQC_COLUMNS,
+               'testbatch': TESTBATCH_COLUMNS}
+
+    with ThreadPoolExecutor(len(LABMN_FILES)) as executor:
+        scans = [executor.submit(_scan_lookups, labmn, key, layouts[key])
+                 for key in LABMN_FILES]
+        results = [scan.result() for scan in scans]
+
+    skipped = results[0][1]
+    unmapped = collections.defaultdict(set)
+    for file_unmapped, _ in results:
+        for (name, value), samples in file_unmapped.items():
+            if not samples <= skipped:
+                unmapped[name].add(value)
+
+    if unmapped:
+        raise UnmappedValuesError(source, {name: sorted(values) for
+                                           name, values in unmapped.items()})
+
+
+class _RowCounter(object):
+    '''Wraps a csv writer to count the rows written through it.'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = 0
+
+    def writerow(self, row):
+        self.rows += 1
+        return self.writer.writerow(row)
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+
+class _Eqedds(object):
+    '''The EQEDD .zips written by convert_labmn(), one per SDG#.
+
+    Each .zip is opened the first time a row is written for its SDG#, and
+    all of them are closed when the object is used as a context manager.
+    Each .zip is written under a .part name of its own and only moved into
+    place by commit(), so a failed conversion leaves any earlier EQEDDs
+    untouched, and conversions writing to the same folder at once never
+    share a .part.
+    '''
+
+    def __init__(self, dest, replace=()):
+        self.dest = dest
+        self.replace = replace
+        self.zips = collections.OrderedDict()
+        self.parts = {}
+        self.rows = {}
+        self._stack = contextlib.ExitStack()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._stack.__exit__(*exc_info)
+
+    def path(self, field_sdg):
+        return os.path.abspath(os.path.join(self.dest,
+                                            field_sdg + '.EQEDD.zip'))
+
+    def zip(self, field_sdg):
+        '''Returns the .zip for an SDG#, opening it if needed. Like the
+        script always has, refuses to replace an existing EQEDD, unless
+        replace is True or holds the EQEDD's file path.
+        '''
+        if field_sdg not in self.zips:
+            path = self.path(field_sdg)
+            if os.path.exists(path) and not (self.replace is True or
+                                             path in self.replace):
+                raise FileExistsError(path)
+            # A random name, created only if it doesn't exist yet, so no
+            # other conversion can be writing to the same .part.
+            part = path + '.' + os.urandom(6).hex() + '.part'
+            part_file = self._stack.enter_context(open(part, 'xb'))
+            self.parts[field_sdg] = part
+            new_zip = ZipFile(part_file, 'w')
+            self.zips[field_sdg] = self._stack.enter_context(new_zip)
+            self.rows[field_sdg] = {}
+        return self.zips[field_sdg]
+
+    @contextlib.contextmanager
+    def writers(self, key):
+        '''Context manager yielding the writers of one file of the EQEDDs,
+        with a writer already open for every .zip opened so far.
+        '''
+        with contextlib.ExitStack() as entries:
+            writers = _EqeddWriters(self, key, entries)
+            for field_sdg in list(self.zips):
+                writers[field_sdg]
+            yield writers
+
+    def commit(self):
+        '''Moves every finished .zip into place.'''
+        for field_sdg in self.zips:
+            os.replace(self.parts[field_sdg], self.path(field_sdg))
+
+    def remove(self):
+        '''Closes and deletes every .zip, for when a conversion fails.'''
+        self._stack.close()
+        for part in self.parts.values():
+            if os.path.exists(part):
+                os.remove(part)
+
+
+class _EqeddWriters(dict):
+    '''Writers of one file of the EQEDDs keyed by SDG#. The file's entry in
+    an SDG#'s .zip is opened the first time its writer is looked up.
+    '''
+
+    def __init__(self, eqedds, key, entries):
+        super().__init__()
+        self.eqedds = eqedds
+        self.key = key
+        self.entries = entries
+
+    def __missing__(self, field_sdg):
+        new_zip = self.eqedds.zip(field_sdg)
+        writer = _RowCounter(self.entries.enter_context(
+            _open_eqedd(new_zip, self.key)))
+        self.eqedds.rows[field_sdg][self.key] = writer
+        self[field_sdg] = writer
+        return writer
+
+
+def _write_json(path, data):
+    '''Writes data to a JSON file, replacing the file in one step so other
+    processes never see it half written.
+    '''
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=2)
+    os.replace(temp_path, path)
 
-            # If the sys_sample_code is present in the list of samples to
-            # skip, skip the row.
-            if row[0] in samples_to_skip:
-                pass
+
+def _read_json(path):
+    '''Returns the data in a JSON file, or None if it can't be read.'''
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+# Bumped whenever a change to the parsers changes the EQEDDs they write, so
+# conversions cached before the change are redone.
+CACHE_VERSION = 1
+
+
+def mapping_version():
+    '''Function to fingerprint the column layouts and the dictionaries they
+    look values up in.
+
+    Returns a SHA-256 hex digest that changes whenever an entry is added to
+    or changed in a dictionary (sample_type_code, lab_anl_method_name, etc.)
+    or a layout, so cached conversions made with the old ones are redone.
+    '''
+    def encode(part):
+        if isinstance(part, dict):
+            return sorted([str(k), str(v)] for k, v in part.items())
+        elif isinstance(part, (tuple, list)):
+            return [encode(p) for p in part]
+        elif part is _REQUIRED:
+            return 'required'
+        elif callable(part):
+            code = getattr(part, '__code__', None)
+            return [getattr(part, '__qualname__', repr(part)),
+                    code.co_code.hex() if code else '',
+                    repr(code.co_consts) if code else '']
+        return part
+
+    layouts = [CACHE_VERSION, EQEDD_FILES, LABSAMPLE_COLUMNS,
+               TESTRESULTSQC_COLUMNS, TESTBATCH_COLUMNS]
+    return hashlib.sha256(json.dumps(encode(layouts)).encode()).hexdigest()
+
+
+def _default_cache_dir():
+    '''Returns the default cache directory, under %LOCALAPPDATA% on Windows
+    and ~/.cache elsewhere.
+    '''
+    base = os.environ.get('LOCALAPPDATA',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'Lab_MN2EQEDD')
+
+
+class ConversionCache(object):
+    '''On-disk cache of conversions, so unchanged Lab_MNs aren't converted
+    again.
+
+    Conversions are keyed by the SHA-256 of the Lab_MN files plus
+    mapping_version(). Each entry holds the summary returned by
+    convert_labmn() and a copy of the EQEDDs, so an EQEDD that's been moved
+    or deleted can be put back without converting. The least recently used
+    entries are evicted once the entries add up to more than max_bytes.
+
+    The cache directory holds:
+        files/    the size, modification time and SHA-256 of each file
+                  hashed, so unchanged files aren't read again
+        sources/  the key and EQEDDs of the last conversion of each Lab_MN
+        entries/  one directory per key with summary.json and the EQEDDs
+    '''
+
+    def __init__(self, cache_dir=None, max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir or _default_cache_dir()
+        self.max_bytes = max_bytes
+        for name in ('files', 'sources', 'entries'):
+            os.makedirs(os.path.join(self.cache_dir, name), exist_ok=True)
+
+    def _record_path(self, kind, path):
+        name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        return os.path.join(self.cache_dir, kind, name + '.json')
+
+    def file_digest(self, path):
+        '''Returns the SHA-256 of a file, only reading the file if its size
+        or modification time changed since it was last hashed.
+        '''
+        stat = os.stat(path)
+        record_path = self._record_path('files', path)
+        record = _read_json(record_path)
+        if (record and record['size'] == stat.st_size and
+                record['mtime_ns'] == stat.st_mtime_ns):
+            return record['sha256']
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as hashed_file:
+            for block in iter(lambda: hashed_file.read(1024 * 1024), b''):
+                digest.update(block)
+        _write_json(record_path, {'path': os.path.abspath(path),
+                                  'size': stat.st_size,
+                                  'mtime_ns': stat.st_mtime_ns,
+                                  'sha256': digest.hexdigest()})
+        return digest.hexdigest()
+
+    def key(self, labmn):
+        '''Returns the cache key of a Lab_MN located by _find_labmn().'''
+        digest = hashlib.sha256(mapping_version().encode())
+        for key in LABMN_FILES:
+            kind, path, member = labmn[key]
+            digest.update(json.dumps([key, kind, member,
+                                      self.file_digest(path)]).encode())
+        return digest.hexdigest()
+
+    def previous_eqedds(self, source):
+        '''Returns the file paths of the EQEDDs the last cached conversion
+        of a Lab_MN wrote.
+        '''
+        record = _read_json(self._record_path('sources', source))
+        return set(record['eqedds']) if record else set()
+
+    def restore(self, key, dest):
+        '''Function to skip a conversion that's already been done.
+
+        1. Takes in the cache key of a Lab_MN and the directory its EQEDDs go
+        in.
+        2. Checks each EQEDD cached for the key is in the directory and
+        unchanged, copying back any that are missing.
+        3. Returns the cached summary, or None if the key isn't cached or an
+        EQEDD in the directory has been changed since.
+        '''
+        entry_dir = os.path.join(self.cache_dir, 'entries', key)
+        summary = _read_json(os.path.join(entry_dir, 'summary.json'))
+        if summary is None:
+            return None
+
+        missing = []
+        for eqedd in summary['eqedds']:
+            name = os.path.basename(eqedd['eqedd'])
+            eqedd['eqedd'] = os.path.abspath(os.path.join(dest, name))
+            if not os.path.exists(eqedd['eqedd']):
+                missing.append(eqedd)
+            elif self.file_digest(eqedd['eqedd']) != eqedd['sha256']:
+                return None
+
+        try:
+            for eqedd in missing:
+                name = os.path.basename(eqedd['eqedd'])
+                shutil.copyfile(os.path.join(entry_dir, name),
+                                eqedd['eqedd'])
+        except FileNotFoundError:
+            # The entry was evicted by another process part way through.
+            return None
+
+        # Touches the entry so eviction sees it as recently used.
+        os.utime(os.path.join(entry_dir, 'summary.json'))
+        return summary
+
+    def remember(self, key, source, summary):
+        '''Records the key and EQEDDs of the last conversion of a Lab_MN.'''
+        _write_json(self._record_path('sources', source),
+                    {'source': os.path.abspath(source), 'key': key,
+                     'eqedds': [e['eqedd'] for e in summary['eqedds']]})
+
+    def store(self, key, source, summary):
+        '''Caches the summary and EQEDDs of a conversion, then evicts the
+        least recently used entries if the cache is too big.
+        '''
+        entries_dir = os.path.join(self.cache_dir, 'entries')
+        temp_dir = os.path.join(entries_dir, key + '.' + str(os.getpid()))
+        os.makedirs(temp_dir, exist_ok=True)
+        for eqedd in summary['eqedds']:
+            eqedd['sha256'] = self.file_digest(eqedd['eqedd'])
+            shutil.copyfile(eqedd['eqedd'], os.path.join(
+                temp_dir, os.path.basename(eqedd['eqedd'])))
+        _write_json(os.path.join(temp_dir, 'summary.json'), summary)
+
+        # If another process cached the same key first, its copy is kept.
+        try:
+            os.rename(temp_dir, os.path.join(entries_dir, key))
+        except OSError:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        self.remember(key, source, summary)
+        self.evict()
+
+    def evict(self):
+        '''Deletes the least recently used entries until the entries add up
+        to no more than max_bytes.
+        '''
+        entries_dir = os.path.join(self.cache_dir, 'entries')
+        entries = []
+        total = 0
+        for name in os.listdir(entries_dir):
+            entry_dir = os.path.join(entries_dir, name)
+            try:
+                summary_path = os.path.join(entry_dir, 'summary.json')
+                used = os.stat(summary_path).st_mtime
+                size = sum(os.path.getsize(os.path.join(entry_dir, f))
+                           for f in os.listdir(entry_dir))
+            except OSError:
+                continue
+            entries.append((used, size, entry_dir))
+            total += size
+
+        for used, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+def convert_labmn(source, dest, cache=None, force=False, validate=True):
+    '''Function to convert one Lab_MN to EQEDD .zips.
+
+    1. Takes in the file path of the Lab_MN (see _find_labmn()), the
+    directory to write the EQEDDs to, a ConversionCache (or None to always
+    convert), whether to convert even if the cache has the Lab_MN, and
+    whether to check for unmapped values first (see validate_labmn()).
+    2. Skips the conversion if the cache has it (see
+    ConversionCache.restore()). Otherwise, streams the rows of each Lab_MN
+    file through the parsers and into the output .zips, one file at a time.
+    The samples of each SDG# go to their own EQEDD, named after the SDG#.
+    Nothing is written to disk besides the output .zips, and memory use
+    doesn't grow with the size of the files. An existing EQEDD is only
+    replaced if force is set or the cache shows it came from an earlier
+    conversion of the same Lab_MN.
+    3. Returns a dictionary describing the conversion: the file path and
+    the number of rows written to each file for each SDG#'s EQEDD, the
+    samples skipped, whether it came from the cache, and the time taken in
+    seconds.
+    '''
+    start = time.perf_counter()
+    labmn = _find_labmn(source)
+    replace = True if force else set()
+
+    if cache is not None:
+        key = cache.key(labmn)
+        if not force:
+            summary = cache.restore(key, dest)
+            if summary is not None:
+                cache.remember(key, source, summary)
+                summary.update(source=source, cached=True,
+                               seconds=round(time.perf_counter() - start, 3))
+                return summary
+            replace = cache.previous_eqedds(source)
+
+    # Every unmapped value is reported before any EQEDD is started.
+    if validate:
+        validate_labmn(source, labmn)
+
+    index = SampleIndex()
+    eqedds = _Eqedds(dest, replace)
+    try:
+        with eqedds:
+            with _open_labmn(labmn, 'labsample') as reader, \
+                    eqedds.writers('labsample') as writers:
+                sample_parser(reader, writers, index)
+            if not index.sdgs:
+                raise ValueError('No samples with an SDG# found in ' + source)
+            with _open_labmn(labmn, 'testresultsqc') as reader, \
+                    eqedds.writers('testresultsqc') as writers:
+                results_parser(reader, writers, index)
+            with _open_labmn(labmn, 'testbatch') as reader, \
+                    eqedds.writers('testbatch') as writers:
+                batch_parser(reader, writers, index)
+        eqedds.commit()
+    except BaseException:
+        eqedds.remove()
+        raise
+
+    summary = {'source': source,
+               'eqedds': [{'field_sdg': field_sdg,
+                           'eqedd': eqedds.path(field_sdg),
+                           'rows': {key: eqedds.rows[field_sdg][key].rows
+                                    for key in LABMN_FILES}}
+                          for field_sdg in index.sdgs],
+               'skipped_samples': sorted(index.skipped),
+               'cached': False}
+    if cache is not None:
+        cache.store(key, source, summary)
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def find_labmns(root):
+    '''Generator yielding every Lab_MN under a directory tree.
+
+    Yields the file path of each .zip or .xlsx workbook holding the three
+    Lab_MN files, and of each directory containing the three files loose but
+    no such .zip or workbook. Either can be passed to convert_labmn() as the
+    source. A .zip or workbook that can't be read is yielded too, so it
+    fails as a delivery of its own, but doesn't hide the loose files next to
+    it.
+    '''
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        names = _sorted_names(file_names)
+        found_archive = False
+        for path, error in _labmn_archives(dir_path, names):
+            if error is None:
+                found_archive = True
             else:
-                # Writes the output row.
-                writer.writerow([row[0], lab_anl_method_name[row[1]], row[2],
-                                 total_or_dissolved[row[3]], row[4], row[5],
-                                 'Analysis', row[9]])
-
-
-#file_path = input('Paste/type the full file path (e.g. C:\\workspace\\a_folder) for the folder\ncontaining a Lab_MN to convert to EQEDD, then hit Enter. The Lab_MN can be\npresent as either:\n\t1. One .zip file whose contents are at least three comma- or\n\ttab-delimited files with file names containing the strings "labsample",\n\t"testresultsqc", and "testbatch" (case insensitive)\n\t-or-\n\t2. Three comma- or tab-delimited files whose file names contain\n\tthose strings.\n\nIf both are present the text files will be skipped.\n')
-file_path = r'C:\workspace\LabMN2EQEDD'
-
-# These two bits of information are passed around differently. Implementing
-# field_sdg in a similar manner to samples_to_skip results in writing brackets
-# to the lab_sdg field in TestResultsQC. So somehow, samples_to_skip can be
-# populated in the sample_parser function and not be returned but is still
-# accessible to the other functions, but field_sdg needs to be returned and
-# passed back into the other function. Unclear why this happens.
-samples_to_skip = []
-field_sdg = []
-
-# Creates a temporary directory to do the interstitial file saving in.
-# Eliminates the need to specify a working/scratch directory by the user, and
-# avoids cluttering up the directory provided by the user. When all the sample
-# parsing and EQEDD creation is complete, deletes the temporary directory and
-# contents.
-# https://docs.python.org/3.6/library/tempfile.html#tempfile.TemporaryDirectory
-with tempfile.TemporaryDirectory() as temp_dir:
-
-    # Lists the files in the directory provided by the user, then iterates
-    # through them.
-    for files in os.listdir(file_path):
-
-        # If the Lab_MN is provided by the user as a .zip, proceed with one
-        # way of saving the files.
-        if '.zip' in files:
-
-            # Extract files from the .zip to the temporary directory for
-            # parsing.
-            with ZipFile(files, 'r') as edd_zip:
-                edd_zip.extractall(temp_dir)
-            
-            # Lists the files extracted into the temporary directory and
-            # iterates through them.
-            for unzipped_file in os.listdir(temp_dir):
-
-                # If various strings are present in the file names, assign
-                # them to variables for parsing. lower() is used to aid string
-                # comparison.
-                if 'labsample' in unzipped_file.lower():
-                    mdh_labsample = os.path.join(temp_dir, unzipped_file)
-                elif 'testresultsqc' in unzipped_file.lower():
-                    mdh_testresultsqc = os.path.join(temp_dir, unzipped_file)
-                elif 'testbatch' in unzipped_file.lower():
-                    mdh_testbatch = os.path.join(temp_dir, unzipped_file)
-        
-        # If the Lab_MN is provided as standalone files, checks for various
-        # strings in the file names and assigns them to variables for parsing.
-        # lower() is used to aid string comparison.
-        elif 'labsample' in files.lower():
-            mdh_labsample = os.path.join(file_path, files)
-        elif 'testresultsqc' in files.lower():
-            mdh_testresultsqc = os.path.join(file_path, files)
-        elif 'testbatch' in files.lower():
-            mdh_testbatch = os.path.join(file_path, files)
-
-    # Variables containing the output file names.
-    dest_labsample = os.path.join(temp_dir, 'out.LabSample_v1.txt')
-    dest_testresultsqc = os.path.join(temp_dir, 'out.TestResultsQC_v1.txt')
-    dest_testbatch = os.path.join(temp_dir, 'out.TestBatch_v1.txt')
-
-    # Calls the functions that do the file parsing/creation.
-    field_sdg = sample_parser(mdh_labsample, dest_labsample, samples_to_skip)
-    results_parser(mdh_testresultsqc, dest_testresultsqc,
-                   samples_to_skip, field_sdg)
-    batch_parser(mdh_testbatch, dest_testbatch, samples_to_skip)
-
-    # Creates the output EQEDD .zip file and writes the output files to it.
-    with ZipFile(os.path.join(file_path, str(field_sdg) + '.EQEDD.zip'), 'x') as new_zip:
-        new_zip.write(dest_labsample, os.path.basename(dest_labsample))
-        new_zip.write(dest_testresultsqc, os.path.basename(dest_testresultsqc))
-        new_zip.write(dest_testbatch, os.path.basename(dest_testbatch))
+                print('Could not read ' + path + ': ' + str(error))
+            yield path
+
+        if not found_archive and len(_match_labmn(names)) == 3:
+            yield dir_path
+
+
+class DuplicateSDGError(Exception):
+    '''Reported by convert_inbox() for Lab_MNs in a batch that would
+    write the same EQEDD.
+    '''
+    pass
+
+
+def _eqedd_dir(source, dest):
+    '''Returns the directory a Lab_MN's EQEDDs are written to by
+    convert_inbox(): dest, or next to the Lab_MN if dest is None.
+    '''
+    if dest is None:
+        dest = source if os.path.isdir(source) else os.path.dirname(source)
+    return dest
+
+
+def _sdgs_worker(source):
+    '''Function run in the process pool by convert_inbox() before the
+    conversions.
+
+    Returns the SDG#s a Lab_MN's EQEDDs would be named after, read from its
+    LabSample the way sample_parser() does, or None if it can't be read
+    (the conversion then reports why).
+    '''
+    try:
+        sdgs = {}
+        with _open_labmn(_find_labmn(source), 'labsample') as reader:
+            for row in reader:
+                if not _is_header(row) and not _is_skipped_sample(row):
+                    sdgs[row[7]] = None
+        return list(sdgs)
+    except Exception:
+        return None
+
+
+def _convert_worker(source, dest, cache, force):
+    '''Function run in the process pool by convert_inbox().
+
+    Converts one Lab_MN, writing the EQEDD next to it if no destination is
+    given. Errors are returned in the manifest entry rather than raised, so
+    one bad delivery doesn't stop the rest of the batch.
+    '''
+    dest = _eqedd_dir(source, dest)
+    start = time.perf_counter()
+    try:
+        return convert_labmn(source, dest, cache, force)
+    except Exception as e:
+        return {'source': source,
+                'error': type(e).__name__ + ': ' + str(e),
+                'seconds': round(time.perf_counter() - start, 3)}
+
+
+def convert_inbox(root, dest=None, workers=None, cache=None, force=False):
+    '''Function to convert every Lab_MN under a directory tree.
+
+    1. Takes in the directory to search, the directory to write the EQEDDs to
+    (None writes each EQEDD next to its Lab_MN), the number of worker
+    processes (None uses one per CPU), and the cache and force arguments for
+    convert_labmn().
+    2. Converts the Lab_MNs found by find_labmns() across a process pool.
+    The SDG#s of every Lab_MN are read first, and Lab_MNs that would write
+    the same EQEDD (the same SDG# into the same directory) are all failed
+    rather than converted, since they'd replace each other's EQEDD.
+    3. Writes a JSON manifest of the run into the destination directory (or
+    the searched directory), with one entry per Lab_MN as returned by
+    convert_labmn(), and returns the manifest's file path.
+    '''
+    start = time.perf_counter()
+    started = time.strftime('%Y%m%d_%H%M%S')
+    sources = list(find_labmns(root))
+
+    with ProcessPoolExecutor(workers) as executor:
+        # Every Lab_MN writing each EQEDD, keyed by the EQEDD's path.
+        eqedds = collections.defaultdict(list)
+        for source, sdgs in zip(sources, executor.map(_sdgs_worker,
+                                                      sources)):
+            for field_sdg in sdgs or ():
+                path = os.path.normcase(os.path.abspath(os.path.join(
+                    _eqedd_dir(source, dest), field_sdg + '.EQEDD.zip')))
+                eqedds[path].append(source)
+
+        duplicates = collections.defaultdict(list)
+        for path, path_sources in eqedds.items():
+            if len(path_sources) > 1:
+                for source in path_sources:
+                    duplicates[source].append(
+                        os.path.basename(path) + ' (also from ' +
+                        ', '.join(other for other in path_sources
+                                  if other != source) + ')')
+
+        convert = [source for source in sources if source not in duplicates]
+        results = dict(zip(convert, executor.map(_convert_worker, convert,
+                                                 itertools.repeat(dest),
+                                                 itertools.repeat(cache),
+                                                 itertools.repeat(force))))
+
+    deliveries = []
+    for source in sources:
+        if source in duplicates:
+            error = DuplicateSDGError('another Lab_MN in the batch writes ' +
+                                      '; '.join(duplicates[source]))
+            deliveries.append({'source': source,
+                               'error': type(error).__name__ + ': ' +
+                                        str(error),
+                               'seconds': 0})
+        else:
+            deliveries.append(results[source])
+
+    manifest_path = os.path.join(dest or root,
+                                 'EQEDD_manifest_' + started + '.json')
+    with open(manifest_path, 'x') as manifest_file:
+        json.dump({'root': root,
+                   'started': started,
+                   'seconds': round(time.perf_counter() - start, 3),
+                   'converted': sum('error' not in d and not d['cached']
+                                    for d in deliveries),
+                   'cached': sum(d.get('cached', False) for d in deliveries),
+                   'failed': sum('error' in d for d in deliveries),
+                   'deliveries': deliveries},
+                  manifest_file, indent=2)
+
+    return manifest_path
+
+
+if __name__ == '__main__':
+    #file_path = input('Paste/type the full file path (e.g. C:\\workspace\\a_folder) for the folder\ncontaining a Lab_MN to convert to EQEDD, then hit Enter. The Lab_MN can be\npresent as either:\n\t1. One .zip file whose contents are at least three comma- or\n\ttab-delimited files with file names containing the strings "labsample",\n\t"testresultsqc", and "testbatch" (case insensitive)\n\t-or-\n\t2. Three comma- or tab-delimited files whose file names contain\n\tthose strings.\n\nIf both are present the text files will be skipped.\n')
+    parser = argparse.ArgumentParser(
+        description='Convert Lab_MN EDDs to EQEDDs for upload to EQuIS.')
+    parser.add_argument('file_path', nargs='?',
+                        default=r'C:\workspace\LabMN2EQEDD',
+                        help='folder containing a Lab_MN (or, with --batch, '
+                             'a folder tree of Lab_MNs)')
+    parser.add_argument('--batch', action='store_true',
+                        help='convert every Lab_MN under file_path')
+    parser.add_argument('--dest',
+                        help='folder to write the EQEDDs to (defaults to '
+                             'the folder of each Lab_MN)')
+    parser.add_argument('--workers', type=int,
+                        help='number of worker processes for --batch '
+                             '(defaults to one per CPU)')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the Lab_MN for values missing from '
+                             'the dictionaries, without converting')
+    parser.add_argument('--force', action='store_true',
+                        help='convert and replace EQEDDs even if the Lab_MN '
+                             'is unchanged since it was last converted')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't use or update the conversion cache")
+    parser.add_argument('--cache-dir',
+                        help='conversion cache folder (defaults to ' +
+                             _default_cache_dir() + ')')
+    parser.add_argument('--cache-size', type=int, default=1024,
+                        help='MB the cache may hold before the least '
+                             'recently used conversions are evicted')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        cache = None
+    else:
+        cache = ConversionCache(args.cache_dir, args.cache_size * 1024 ** 2)
+
+    if args.check:
+        # Checks each Lab_MN found (or just the one) and lists what's
+        # missing from the dictionaries.
+        if args.batch:
+            sources = list(find_labmns(args.file_path))
+        else:
+            sources = [args.file_path]
+        for source in sources:
+            try:
+                validate_labmn(source)
+                print(source + ': OK')
+            except UnmappedValuesError as e:
+                print(e)
+    elif args.batch:
+        # Converts every Lab_MN found and reports where the manifest is.
+        manifest_path = convert_inbox(args.file_path, args.dest, args.workers,
+                                      cache, args.force)
+        print('Run manifest written to ' + manifest_path)
+    else:
+        # Converts the Lab_MN and writes the EQEDD .zip into the same
+        # directory, unless told otherwise.
+        summary = convert_labmn(args.file_path, args.dest or args.file_path,
+                                cache, args.force)
+        if summary['cached']:
+            print('Lab_MN unchanged since it was last converted, skipped.')
@@ -0,0 +1,491 @@
+# Benchmarks for Lab_MN2EQEDD.py, with a generator for synthetic Lab_MNs to
+# run them against.
+#
+#   generate    writes a synthetic Lab_MN of any size, comma- or
+#               tab-delimited, loose or zipped, with QC-O and blank-SDG#
+#               samples mixed in like a real delivery
+#   stages      times sample_parser(), results_parser(), batch_parser(),
+#               validate_labmn() and the full zip-to-zip convert_labmn() on a
+#               generated Lab_MN, reporting rows/sec, seconds and peak RSS for
+#               each. Each stage runs in its own process so its peak RSS is
+#               its own. With --baseline, exits with status 1 if any stage's
+#               rows/sec fell more than --threshold below the baseline.
+#   transforms  compares the hand-indexed writerow() lists the parsers used
+#               to build with the row transformers compiled from the column
+#               layouts, for the transform alone and with the rows written
+#               out through the csv writer
+#
+# Usage: python Lab_MN2EQEDD_bench.py generate DIR [--samples N] [--tab] ...
+#        python Lab_MN2EQEDD_bench.py stages [--samples N] [--baseline FILE]
+#        python Lab_MN2EQEDD_bench.py transforms [--rows N]
+#
+# MIT License (https://en.wikipedia.org/wiki/MIT_License)
+#
+# Copyright (c) 2021 Gerrit VanderWaal
+
+import io
+import os
+import csv
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+import Lab_MN2EQEDD as labmn
+from Lab_MN2EQEDD import (sample_matrix_code, sample_type_code,
+                          lab_anl_method_name, total_or_dissolved)
+
+
+def legacy_labsample_row(row):
+    '''The LabSample row as built by hand before the column layouts.'''
+    if row[5] == 'Field':
+        sampling_company_code = 'dest_comp_code'
+    else:
+        sampling_company_code = 'dest_ref_for_MDH'
+    return [row[0], row[0], sample_matrix_code[row[3].lower()],
+            sample_type_code[row[4]], row[5], row[6], row[7],
+            row[8] + '  ' + row[9], '', '', '', '', '', '', '', row[20],
+            sampling_company_code]
+
+
+def legacy_testresultsqc_row(row, field_sdg):
+    '''The TestResultsQC row as built by hand before the column layouts.'''
+    if row[21] == 'Unspecified':
+        lab_prep_method = 'METHOD'
+    else:
+        lab_prep_method = row[21]
+    if '<' in row[47]:
+        lab_qualifiers = row[47].replace('<', 'U')
+    else:
+        lab_qualifiers = row[47]
+    return [row[0], lab_anl_method_name[row[1]], row[2],
+            total_or_dissolved[row[3]], row[4], row[5], 'WQ', 'LB', 'Wet',
+            row[27], row[20], lab_prep_method, row[22], '', '',
+            'dest_ref_for_MDH', row[26], row[27], row[28], '', '', row[31],
+            row[32], '', '', '', '', row[36], row[37], row[39], '', row[43],
+            'Yes', row[45], lab_qualifiers, '', lab_qualifiers, '', row[48],
+            row[49], row[49], row[50], row[50], '', '', field_sdg, row[56],
+            row[57], row[58], row[59], row[60], row[61], row[62], row[63],
+            row[64], row[65], row[66], row[67], row[68], row[69], row[70]]
+
+
+def legacy_testbatch_row(row, field_sdg):
+    '''The TestBatch row as built by hand before the column layouts.'''
+    return [row[0], lab_anl_method_name[row[1]], row[2],
+            total_or_dissolved[row[3]], row[4], row[5], 'Analysis', row[9]]
+
+
+def make_rows(n, width):
+    '''Returns n Lab_MN rows of the given width, using mapped values in the
+    columns looked up for that file.
+    '''
+    rows = []
+    for i in range(n):
+        row = ['value%d_%d' % (i, c) for c in range(width)]
+        row[0] = 'S%d' % i
+        if width == 21:
+            row[3] = ('WTR-Ground', 'Drinking Water')[i % 2]
+            row[4] = ('Sample', 'QC-FB')[i % 2]
+            row[5] = ('Field', 'Lab')[i % 2]
+        else:
+            row[1] = ('533', '524.3')[i % 2]
+            row[3] = ('Total', 'Dissolved')[i % 2]
+        if width == 71:
+            row[21] = ('Unspecified', 'EPA 533')[i % 2]
+            row[47] = ('<', 'J')[i % 2]
+        rows.append(row)
+    return rows
+
+
+def rows_per_sec(transform, rows, args, writer=None):
+    '''Returns the rows/sec of transforming the rows, and writing them if
+    given a writer.
+    '''
+    start = time.perf_counter()
+    if writer is None:
+        for row in rows:
+            transform(row, *args)
+    else:
+        writerow = writer.writerow
+        for row in rows:
+            writerow(transform(row, *args))
+    return len(rows) / (time.perf_counter() - start)
+
+
+# Column counts of the Lab_MN files, from the highest column the parsers
+# read in each.
+LABSAMPLE_WIDTH = 21
+TESTRESULTSQC_WIDTH = 71
+TESTBATCH_WIDTH = 10
+
+
+def _header(width, names):
+    '''Returns a Lab_MN header row, using the given names by column and
+    column_N for the rest. The looked up columns are named after their
+    dictionaries, which map the names to themselves.
+    '''
+    return [names.get(n, 'column_%d' % n) for n in range(width)]
+
+
+def _mapped_values(table):
+    '''Returns the values of a dictionary that aren't its header entry.'''
+    return [value for value in table if value not in table.values()]
+
+
+def generate_labmn(dest, samples=1000, results_per_sample=20, delimiter=',',
+                   sdgs=1, qc_o=0.05, blank_sdg=0.05, as_zip=False, seed=0):
+    '''Function to write a synthetic Lab_MN.
+
+    1. Takes in the directory to write it to, the number of samples, the
+    number of TestResultsQC rows per sample, the delimiter, the number of
+    SDG#s, the fractions of QC-O and blank-SDG# samples, whether to zip the
+    files, and the random seed.
+    2. Writes the three files row by row, so any size can be generated
+    without holding it in memory. Values come from the dictionaries in
+    Lab_MN2EQEDD.py, in mixed capitalization where the script lowercases.
+    3. Returns the file path to pass to convert_labmn(): the .zip, or the
+    directory of loose files.
+    '''
+    rand = random.Random(seed)
+    matrices = _mapped_values(sample_matrix_code)
+    types = _mapped_values(sample_type_code)
+    methods = [m for m in _mapped_values(lab_anl_method_name) if m.strip()]
+    fractions = _mapped_values(total_or_dissolved)
+    os.makedirs(dest, exist_ok=True)
+
+    headers = {
+        'labsample': _header(LABSAMPLE_WIDTH, {
+            0: 'sys_sample_code', 3: 'sample_matrix_code',
+            4: 'sample_type_code', 5: 'sample_source', 7: 'field_sdg',
+            8: 'sample_date', 9: 'sample_time'}),
+        'testresultsqc': _header(TESTRESULTSQC_WIDTH, {
+            0: 'sys_sample_code', 1: 'lab_anl_method_name', 2: 'cas_rn',
+            3: 'total_or_dissolved', 21: 'lab_prep_method',
+            47: 'lab_qualifiers'}),
+        'testbatch': _header(TESTBATCH_WIDTH, {
+            0: 'sys_sample_code', 1: 'lab_anl_method_name', 2: 'cas_rn',
+            3: 'total_or_dissolved'})}
+    names = {'labsample': 'Synthetic_LabSample_v1.txt',
+             'testresultsqc': 'Synthetic_TestResultsQC_v1.txt',
+             'testbatch': 'Synthetic_TestBatch_v1.txt'}
+
+    with contextlib.ExitStack() as stack:
+        if as_zip:
+            path = os.path.join(dest, 'Synthetic_Lab_MN.zip')
+            new_zip = stack.enter_context(zipfile.ZipFile(
+                path, 'w', zipfile.ZIP_DEFLATED))
+            files = {key: stack.enter_context(io.TextIOWrapper(
+                new_zip.open(names[key], 'w'), newline=''))
+                for key in labmn.LABMN_FILES[:1]}
+        else:
+            path = dest
+            files = {key: stack.enter_context(open(
+                os.path.join(dest, names[key]), 'w', newline=''))
+                for key in labmn.LABMN_FILES}
+
+        def writer_for(key):
+            # Only one .zip member can be written at a time, so each is
+            # opened as the previous one is finished.
+            if key not in files:
+                for output_file in files.values():
+                    output_file.close()
+                files.clear()
+                files[key] = stack.enter_context(io.TextIOWrapper(
+                    new_zip.open(names[key], 'w'), newline=''))
+            writer = csv.writer(files[key], delimiter=delimiter)
+            writer.writerow(headers[key])
+            return writer
+
+        # LabSample, remembering each sample for the other files.
+        writer = writer_for('labsample')
+        codes = []
+        for n in range(samples):
+            code = 'LAB%07d' % n
+            codes.append(code)
+            row = ['v%d' % c for c in range(LABSAMPLE_WIDTH)]
+            row[0] = code
+            row[3] = rand.choice(matrices).upper()
+            row[4] = 'QC-O' if rand.random() < qc_o else rand.choice(types)
+            row[5] = rand.choice(('Field', 'Lab'))
+            row[6] = ''
+            if rand.random() < blank_sdg:
+                row[7] = ''
+            else:
+                row[7] = 'SDG%04d' % (n * sdgs // samples)
+            row[8] = '%d/%d/2021' % (rand.randint(1, 12), rand.randint(1, 28))
+            row[9] = '%d:%02d' % (rand.randint(6, 18), rand.randint(0, 59))
+            writer.writerow(row)
+
+        # TestResultsQC, with a row per analyte per sample.
+        writer = writer_for('testresultsqc')
+        for code in codes:
+            method = rand.choice(methods)
+            for n in range(results_per_sample):
+                row = ['r%d' % c for c in range(TESTRESULTSQC_WIDTH)]
+                row[0] = code
+                row[1] = method
+                row[2] = '%d-%02d-%d' % (rand.randint(50, 9999),
+                                         rand.randint(10, 99), n % 10)
+                row[3] = rand.choice(fractions)
+                row[21] = rand.choice(('Unspecified', 'EPA ' + method))
+                row[47] = rand.choice(('<', 'J', '', '<J'))
+                row[48] = '%.4g' % rand.uniform(0, 100)
+                writer.writerow(row)
+
+        # TestBatch, with a row per sample.
+        writer = writer_for('testbatch')
+        for code in codes:
+            row = ['b%d' % c for c in range(TESTBATCH_WIDTH)]
+            row[0] = code
+            row[1] = rand.choice(methods)
+            row[3] = rand.choice(fractions)
+            writer.writerow(row)
+
+    return path
+
+
+class _NullWriters(dict):
+    '''Writers keyed by SDG# that write to the null device, standing in
+    for the EQEDD .zips when timing the parsers on their own.
+    '''
+
+    def __init__(self, sink):
+        super().__init__()
+        self.sink = sink
+
+    def __missing__(self, field_sdg):
+        writer = self[field_sdg] = labmn._RowCounter(
+            labmn._eqedd_writer(self.sink))
+        return writer
+
+
+def peak_rss_mb():
+    '''Returns the peak resident memory of this process in MB, or None if
+    neither the resource module nor psutil is available.
+    '''
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+
+    # ru_maxrss is in bytes on macOS and KB everywhere else.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_stage(stage, source):
+    '''Function run in a fresh process by run_stages() for each stage.
+
+    Returns the rows processed, the seconds taken, and the peak RSS in MB.
+    Stages after sample_parser() build the SampleIndex untimed first.
+    '''
+    located = labmn._find_labmn(source)
+    index = labmn.SampleIndex()
+    parsers = {'sample_parser': ('labsample', labmn.sample_parser),
+               'results_parser': ('testresultsqc', labmn.results_parser),
+               'batch_parser': ('testbatch', labmn.batch_parser)}
+
+    with open(os.devnull, 'w', newline='') as sink:
+        if stage != 'sample_parser':
+            with labmn._open_labmn(located, 'labsample') as reader:
+                labmn.sample_parser(reader, _NullWriters(sink), index)
+
+        start = time.perf_counter()
+        if stage in parsers:
+            key, parser = parsers[stage]
+            writers = _NullWriters(sink)
+            for field_sdg in index.sdgs:
+                writers[field_sdg]
+            with labmn._open_labmn(located, key) as reader:
+                parser(reader, writers, index)
+            rows = sum(writer.rows for writer in writers.values())
+        elif stage == 'validate_labmn':
+            labmn.validate_labmn(source, located)
+            rows = None
+        else:
+            with tempfile.TemporaryDirectory() as dest:
+                summary = labmn.convert_labmn(source, dest)
+            rows = sum(sum(eqedd['rows'].values())
+                       for eqedd in summary['eqedds'])
+        seconds = time.perf_counter() - start
+
+    return rows, seconds, peak_rss_mb()
+
+
+STAGES = ('sample_parser', 'results_parser', 'batch_parser',
+          'validate_labmn', 'convert_labmn')
+
+
+def run_stages(source, input_rows):
+    '''Function to time each stage of a conversion.
+
+    1. Takes in the file path of a Lab_MN and the number of rows in each of
+    its files, keyed by LABMN_FILES.
+    2. Runs each stage in STAGES in its own process.
+    3. Returns a dictionary of stage name to its rows/sec (of input rows),
+    seconds, and peak RSS in MB.
+    '''
+    stage_rows = {'sample_parser': input_rows['labsample'],
+                  'results_parser': input_rows['testresultsqc'],
+                  'batch_parser': input_rows['testbatch'],
+                  'validate_labmn': sum(input_rows.values()),
+                  'convert_labmn': sum(input_rows.values())}
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for stage in STAGES:
+        with context.Pool(1) as pool:
+            _, seconds, peak = pool.apply(_run_stage, (stage, source))
+        results[stage] = {'rows_per_sec': round(stage_rows[stage] / seconds),
+                          'seconds': round(seconds, 3),
+                          'peak_rss_mb': peak and round(peak, 1)}
+    return results
+
+
+def check_regressions(results, baseline, threshold):
+    '''Returns a message for each stage whose rows/sec fell more than
+    threshold (a fraction) below the baseline.
+    '''
+    regressions = []
+    for stage, result in results.items():
+        if stage in baseline:
+            floor = baseline[stage]['rows_per_sec'] * (1 - threshold)
+            if result['rows_per_sec'] < floor:
+                regressions.append('%s: %d rows/sec, baseline %d' % (
+                    stage, result['rows_per_sec'],
+                    baseline[stage]['rows_per_sec']))
+    return regressions
+
+
+def run_transforms(rows, repeats=5):
+    '''Prints the rows/sec of the legacy and compiled row transforms, the
+    best of several runs of each. The runs alternate between the two, so
+    neither gains from going first.
+    '''
+    cases = (('LabSample', LABSAMPLE_WIDTH, legacy_labsample_row,
+              labmn._labsample_row, ()),
+             ('TestResultsQC', TESTRESULTSQC_WIDTH, legacy_testresultsqc_row,
+              labmn._testresultsqc_row, ('SDG1',)),
+             ('TestBatch', TESTBATCH_WIDTH, legacy_testbatch_row,
+              labmn._testbatch_row, ('SDG1',)))
+
+    # Rows are written to the null device so disk speed doesn't factor in.
+    with open(os.devnull, 'w', newline='') as sink:
+        writer = labmn._eqedd_writer(sink)
+        print('rows/sec       %21s %21s' % ('transform only',
+                                             'transform and write'))
+        print('%-14s %10s %10s %10s %10s' % ('file', 'before', 'after',
+                                             'before', 'after'))
+        for name, width, legacy, compiled, extra in cases:
+            sample_rows = make_rows(rows, width)
+            assert legacy(sample_rows[0], *extra) == \
+                compiled(sample_rows[0], *extra)
+            runs = ((legacy, None), (compiled, None), (legacy, writer),
+                    (compiled, writer))
+            best = [0] * len(runs)
+            for _ in range(repeats):
+                for n, (transform, run_writer) in enumerate(runs):
+                    best[n] = max(best[n], rows_per_sec(
+                        transform, sample_rows, extra, run_writer))
+            print('%-14s %10.0f %10.0f %10.0f %10.0f' % (name, *best))
+
+
+def _add_generate_arguments(parser):
+    parser.add_argument('--samples', type=int, default=10000,
+                        help='LabSample rows (default 10000)')
+    parser.add_argument('--results-per-sample', type=int, default=20,
+                        help='TestResultsQC rows per sample (default 20)')
+    parser.add_argument('--sdgs', type=int, default=1,
+                        help='number of SDG#s (default 1)')
+    parser.add_argument('--tab', action='store_true',
+                        help='tab-delimited instead of comma-delimited')
+    parser.add_argument('--zip', action='store_true',
+                        help='zip the three files')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks for Lab_MN2EQEDD.py.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    generate = commands.add_parser('generate',
+                                   help='write a synthetic Lab_MN')
+    generate.add_argument('dest', help='folder to write the Lab_MN to')
+    _add_generate_arguments(generate)
+    generate.add_argument('--qc-o', type=float, default=0.05,
+                          help='fraction of QC-O samples (default 0.05)')
+    generate.add_argument('--blank-sdg', type=float, default=0.05,
+                          help='fraction of samples without an SDG# '
+                               '(default 0.05)')
+
+    stages = commands.add_parser('stages',
+                                 help='time each stage of a conversion')
+    _add_generate_arguments(stages)
+    stages.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare to')
+    stages.add_argument('--threshold', type=float, default=0.2,
+                        help='fraction below the baseline rows/sec that '
+                             'counts as a regression (default 0.2)')
+    stages.add_argument('--save', help='write the results to a JSON file, '
+                                       'for use as a later --baseline')
+
+    transforms = commands.add_parser('transforms',
+                                     help='compare the row transforms')
+    transforms.add_argument('--rows', type=int, default=200000,
+                            help='rows per file (default 200000)')
+    transforms.add_argument('--repeats', type=int, default=5,
+                            help='runs of each, keeping the best (default 5)')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        path = generate_labmn(args.dest, args.samples, args.results_per_sample,
+                              '\t' if args.tab else ',', args.sdgs,
+                              args.qc_o, args.blank_sdg, args.zip, args.seed)
+        print('Lab_MN written to ' + path)
+
+    elif args.command == 'stages':
+        with tempfile.TemporaryDirectory() as work_dir:
+            source = generate_labmn(work_dir, args.samples,
+                                    args.results_per_sample,
+                                    '\t' if args.tab else ',', args.sdgs,
+                                    as_zip=args.zip,
+                                    seed=args.seed)
+            # Each file has a header row besides the data rows.
+            input_rows = {'labsample': args.samples + 1,
+                          'testresultsqc': (args.samples *
+                                            args.results_per_sample + 1),
+                          'testbatch': args.samples + 1}
+            results = run_stages(source, input_rows)
+
+        print('%-16s %12s %10s %14s' % ('stage', 'rows/sec', 'seconds',
+                                        'peak RSS (MB)'))
+        for stage, result in results.items():
+            print('%-16s %12d %10.3f %14s' % (stage, result['rows_per_sec'],
+                                              result['seconds'],
+                                              result['peak_rss_mb']))
+        if args.save:
+            with open(args.save, 'w') as save_file:
+                json.dump(results, save_file, indent=2)
+
+        if args.baseline:
+            with open(args.baseline) as baseline_file:
+                regressions = check_regressions(
+                    results, json.load(baseline_file), args.threshold)
+            for message in regressions:
+                print('REGRESSION ' + message)
+            if regressions:
+                sys.exit(1)
+
+    else:
+        run_transforms(args.rows, args.repeats)
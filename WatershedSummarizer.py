@@ -1,230 +1,807 @@
-# Purpose: Given a set of netCDF files in a directory, converts the netCDF files to rasters and
-# uses the Zonal Statistics with a supplied zone layer. The created tables are then merged together
-# into a single dBASE table, then converted to an .xls spreadsheet in the chose output directory.
+# Purpose: Given a set of netCDF files in a directory, reads the netCDF files and computes zonal
+# statistics with a supplied zone layer. The statistics are then merged together into a single
+# summary table in memory, which is written once to a .csv, .parquet or .xlsx file in the
+# chosen output directory.
 #
-# Version: 1.0
+# Version: 1.4
 #
-# Requires: Spatial Analyst extension for ArcMap, pre-created input and output directories, and
-# a supplied zone layer.
+# Requires: ArcMap, pre-created input and output directories, and a supplied zone layer. h5py
+# is only needed for netCDF-4 files, and pyarrow for Parquet output.
+#
+# The zones are rasterized onto the Livneh grid once, as an integer label per cell. Every
+# variable of a file is then summarized at once with NumPy, over an array of all the variables
+# stacked together, instead of running Zonal Statistics as Table once per variable per file.
+#
+# netCDF-3 files are read directly: the header is parsed and the variables are memory-mapped,
+# so each file is opened once and only the cells of the variables summarized are read. Fill
+# values and scale_factor/add_offset are applied as the values are read.
+#
+# Each file's results are cached in a folder of the output directory, so a re-run only
+# summarizes new or changed months and builds the rest of the summary from the cache.
 
-# Imports os module.
-print "Importing os module..."
+# Imports os, re, io, sys, json, hashlib, mmap, struct, zipfile, tempfile, itertools and
+# multiprocessing modules.
 import os
+import re
+import io
+import sys
+import json
+import hashlib
+import mmap
+import struct
+import zipfile
+import tempfile
+import itertools
+import multiprocessing
+from xml.sax.saxutils import escape
+
+# Imports numpy module, which comes with ArcGIS.
+import numpy as np
+
+# Imports h5py module for netCDF-4 files, if it's installed.
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# Imports pyarrow module for Parquet output, if it's installed.
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Imports arcpy module (akin to libraries for C or C++), in the main process only. The worker
+# processes only read netCDF files, and importing arcpy in each of them takes a while.
+if multiprocessing.current_process().name == "MainProcess":
+    print "Importing arcpy module...\n"
+    import arcpy
+
+# Number of worker processes summarizing files at the same time; None for one per CPU.
+PROCESSES = None
+
+# Variables summarized from each kind of file, by the start of its name: the netCDF variable
+# and the TYPE it's given in the summary.
+# At the time this script was created, files were in the format of
+# "Fluxes_Livneh_NAmerExt_15Oct2014.*four digit year**two digit month*.nc" and
+# "livneh_NAmerExt_15Oct2014.*four digit year**two digit month*.mon.nc".
+VARIABLES = [("Fluxes", [("Baseflow", "Baseflow"),
+                         ("TotalET", "Evapotranspiration"),
+                         ("Runoff", "Runoff"),
+                         ("SoilMoist", "Soil Moisture")]),
+             ("livneh", [("Prec", "Precipitation")])]
+
+# Matches the ".YYYYMM." in the file names above.
+FILE_DATE = re.compile(r"\.(\d{4})(\d{2})\.")
+
+# Fields of the summary table, in order, with their types.
+FIELDS = [("NAME", "TEXT"), ("MONTH", "TEXT"), ("YEAR", "TEXT"), ("TYPE", "TEXT"),
+          ("ZONE_CODE", "LONG"), ("COUNT", "LONG"), ("AREA", "DOUBLE"), ("MIN", "DOUBLE"),
+          ("MAX", "DOUBLE"), ("RANGE", "DOUBLE"), ("MEAN", "DOUBLE"), ("STD", "DOUBLE"),
+          ("SUM", "DOUBLE")]
+
+# The statistics, which are the fields after ZONE_CODE.
+STATISTICS = [field for field, _ in FIELDS[5:]]
+
+# Formats the summary can be written in, by file extension.
+FORMATS = ("xlsx", "csv", "parquet")
+
+# Folder of the output directory the results of each file are cached in, and the index of
+# the hashes of the files' contents in it.
+CACHE_FOLDER = "summary_cache"
+CACHE_INDEX = "index.json"
+
+# Most rows an .xlsx worksheet holds, including the header.
+XLSX_ROWS = 1048576
+
+# The fixed parts of an .xlsx workbook of one worksheet.
+XLSX_PARTS = [
+    ("[Content_Types].xml",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+     '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+     '</Types>'),
+    ("_rels/.rels",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ("xl/workbook.xml",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+     'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+     '<sheets><sheet name="Summary" sheetId="1" r:id="rId1"/></sheets></workbook>'),
+    ("xl/_rels/workbook.xml.rels",
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+     '</Relationships>')]
 
-# Imports arcpy module (akin to libraries for C or C++).
-print "Importing arcpy module...\n"
-import arcpy
+# netCDF-3 header tags, and the NumPy type (big-endian) of each netCDF type.
+NC_DIMENSION = 10
+NC_VARIABLE = 11
+NC_ATTRIBUTE = 12
+NC_TYPES = {1: np.dtype("i1"), 2: np.dtype("S1"), 3: np.dtype(">i2"), 4: np.dtype(">i4"),
+            5: np.dtype(">f4"), 6: np.dtype(">f8")}
 
-# Creates custom exception error to be used in case the Spatial Analyst license is unavailable. This section does nothing but is called later.
-# in the script if needed. See https://docs.python.org/2.7/tutorial/errors.html for more info.
-class LicenseError(Exception):
+# Default fill values netCDF uses for a type when a variable has no _FillValue attribute.
+NC_FILLS = {1: -127, 3: -32767, 4: -2147483647, 5: 9.9692099683868690e+36,
+            6: 9.9692099683868690e+36}
+
+
+# Custom exception for files that can't be read as netCDF.
+class NetCDFError(Exception):
     pass
 
-# Checks that the Spatial Analyst extension is installed, calls the LicenseError exception if it is not.
-print "Checking Spatial Analyst license..."
-if arcpy.CheckExtension("Spatial") == "Available":
-    arcpy.CheckOutExtension("Spatial")
-    print "License retrieved.\n"
-else:
-    raise LicenseError
 
-# Main program component.
-try:
+# Custom exception for a summary that can't be written in the chosen format.
+class OutputError(Exception):
+    pass
+
+
+class NetCDFVariable(object):
+    '''A variable of a netCDF file.
+
+    raw is the variable's array as stored: a view of the memory-mapped file for netCDF-3, or
+    an h5py dataset for netCDF-4. Nothing is read until the variable is indexed, and only
+    the cells indexed are read and unpacked.
+    '''
+
+    def __init__(self, name, dimensions, raw, attributes, default_fill=None):
+        self.name = name
+        self.dimensions = dimensions
+        self.raw = raw
+        self.shape = raw.shape
+        self.attributes = attributes
+        self.fill = attributes.get("_FillValue", default_fill)
+
+    def __getitem__(self, index):
+        '''Returns the cells at index as doubles, with NaN for fill and missing values and
+        scale_factor and add_offset applied.
+        '''
+        data = np.asarray(self.raw[index])
+        if data.dtype.kind == "S":
+            return data
+        values = data.astype(np.float64)
+        for fill in (self.fill, self.attributes.get("missing_value")):
+            for value in np.ravel(fill if fill is not None else []):
+                values[data == value] = np.nan
+        if "scale_factor" in self.attributes:
+            values *= np.ravel(self.attributes["scale_factor"])[0]
+        if "add_offset" in self.attributes:
+            values += np.ravel(self.attributes["add_offset"])[0]
+        return values
+
+
+class NetCDFFile(object):
+    '''A netCDF file opened for reading, with its variables by name in variables.
+
+    netCDF-3 (classic and 64-bit offset) files are parsed here and memory-mapped. netCDF-4
+    files are HDF5 files, and are opened through h5py.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.variables = {}
+        self._file = open(path, "rb")
+        self._map = self._h5 = None
+        try:
+            magic = self._file.read(4)
+            if magic[:3] == b"CDF" and magic[3:] in (b"\x01", b"\x02"):
+                self._read_classic(magic[3:] == b"\x02")
+            elif magic == b"\x89HDF":
+                self._read_hdf5()
+            else:
+                raise NetCDFError(path + " isn't a netCDF file")
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.variables = {}
+        if self._h5 is not None:
+            self._h5.close()
+        # The map itself is unmapped once no array read from it is left.
+        self._map = None
+        self._file.close()
+
+    def _read_hdf5(self):
+        '''Opens a netCDF-4 file through h5py. Dimension names come from the dimension scales
+        netCDF-4 attaches to each variable.
+        '''
+        if h5py is None:
+            raise NetCDFError(self.path + " is a netCDF-4 file, and h5py isn't installed")
+        self._h5 = h5py.File(self.path, "r")
+        for name, dataset in self._h5.items():
+            if not isinstance(dataset, h5py.Dataset):
+                continue
+            dimensions = tuple(dim[0].name.lstrip("/") if len(dim) else "" for dim in dataset.dims)
+            self.variables[name] = NetCDFVariable(name, dimensions, dataset, dict(dataset.attrs))
+
+    def _read_classic(self, offset64):
+        '''Parses a netCDF-3 header, then maps each variable's array onto the file.
+
+        Record variables (those along the unlimited dimension) are interleaved, one record of
+        each after another, so their arrays step through the file by the size of a whole record.
+        '''
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = _Header(self._map, 4)
+
+        numrecs = header.count()
+        dimensions = [(header.name(), header.count()) for _ in header.list(NC_DIMENSION)]
+        header.attributes()
+
+        variables = []
+        for _ in header.list(NC_VARIABLE):
+            name = header.name()
+            dimids = [header.count() for _ in range(header.count())]
+            attributes = header.attributes()
+            ncType, vsize = header.count(), header.count()
+            begin = header.unpack(">Q" if offset64 else ">I")
+            isRecord = bool(dimids) and dimensions[dimids[0]][1] == 0
+            variables.append((name, dimids, attributes, ncType, vsize, begin, isRecord))
+
+        records = [v for v in variables if v[6]]
+        if len(records) == 1:
+            dtype = NC_TYPES[records[0][3]]
+            recsize = dtype.itemsize * int(np.prod([dimensions[d][1] for d in records[0][1][1:]]))
+        else:
+            recsize = sum(v[4] for v in records)
+        if numrecs == 0xFFFFFFFF and records:
+            numrecs = (len(self._map) - min(v[5] for v in records)) // max(recsize, 1)
+
+        for name, dimids, attributes, ncType, vsize, begin, isRecord in variables:
+            if ncType not in NC_TYPES:
+                raise NetCDFError(self.path + " has a variable of unknown type " + str(ncType))
+            dtype = NC_TYPES[ncType]
+            shape = [dimensions[d][1] for d in dimids]
+            if isRecord:
+                shape[0] = numrecs
+            strides = [dtype.itemsize * int(np.prod(shape[i + 1:])) for i in range(len(shape))]
+            if isRecord:
+                strides[0] = recsize
+            raw = np.ndarray(tuple(shape), dtype, buffer=self._map, offset=begin,
+                             strides=tuple(strides))
+            self.variables[name] = NetCDFVariable(name, tuple(dimensions[d][0] for d in dimids),
+                                                  raw, attributes, NC_FILLS.get(ncType))
+
+
+class _Header(object):
+    '''Reads the fields of a netCDF-3 header from a buffer, in order.'''
+
+    def __init__(self, buffer, offset):
+        self.buffer = buffer
+        self.offset = offset
+
+    def unpack(self, fmt):
+        value = struct.unpack_from(fmt, self.buffer, self.offset)[0]
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def count(self):
+        return self.unpack(">I")
+
+    def padded(self, size):
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += size + (-size % 4)
+        return data
+
+    def name(self):
+        return self.padded(self.count()).decode("utf-8")
+
+    def list(self, tag):
+        '''Returns a range over the items of a dimension, attribute or variable list, which is
+        either the tag and the count, or two zeros for an empty list.
+        '''
+        found, count = self.count(), self.count()
+        if found not in (tag, 0):
+            raise NetCDFError("Unexpected tag %i in netCDF header" % found)
+        return range(count)
+
+    def attributes(self):
+        attributes = {}
+        for _ in self.list(NC_ATTRIBUTE):
+            name = self.name()
+            dtype = NC_TYPES[self.count()]
+            size = self.count()
+            data = self.padded(size * dtype.itemsize)
+            if dtype.kind == "S":
+                attributes[name] = data.decode("utf-8", "replace").rstrip("\x00")
+            else:
+                attributes[name] = np.frombuffer(data, dtype).astype(dtype.newbyteorder("="))
+        return attributes
+
+
+class ZoneGrid(object):
+    '''Zones rasterized onto a netCDF file's grid.
+
+    labels holds the zone code of each cell, or -1 outside every zone. The cells inside a zone
+    are also kept sorted by zone (cells), with where each zone's run starts (starts), so the
+    statistics of every zone can be taken with one ufunc.reduceat() call per statistic.
+    '''
+
+    def __init__(self, labels, names, cell_area):
+        self.labels = labels
+        self.names = names
+        self.cell_area = cell_area
+
+        flat = labels.ravel()
+        inside = np.flatnonzero(flat >= 0)
+        self.cells = inside[np.argsort(flat[inside], kind="mergesort")]
+        sorted_labels = flat[self.cells]
+        changes = np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1
+        self.starts = np.r_[0, changes] if len(self.cells) else changes
+        self.codes = sorted_labels[self.starts]
+
+    def digest(self):
+        '''Returns a hash of the zones as they're summarized: the zone of each cell, the NAME
+        of each zone and the area of a cell.
+        '''
+        digest = hashlib.sha1(self.labels.astype(np.int64).tobytes())
+        digest.update(json.dumps(sorted(self.names.items())).encode("utf-8"))
+        digest.update(repr(float(self.cell_area)).encode("utf-8"))
+        return digest.hexdigest()
+
+
+def variables_for(CDFs):
+    '''Returns the (variable, type) pairs summarized from a file, by the start of its name, or
+    an empty list for files that aren't summarized.
+    '''
+    for prefix, variables in VARIABLES:
+        if CDFs.startswith(prefix):
+            return variables
+    return []
+
+
+def read_grid(nc):
+    '''Returns the longitudes and latitudes of the cell centers of an open netCDF file, with
+    longitudes from 180 to 360 moved to -180 to 0 to match the zone layer.
+    '''
+    lon = nc.variables["lon"][:]
+    lat = nc.variables["lat"][:]
+    return np.where(lon > 180, lon - 360, lon), lat
+
+
+def read_variables(nc, variables):
+    '''Returns the variables of an open netCDF file stacked together as an array of doubles,
+    shaped (variables, lat, lon), with NaN for NoData. Each monthly file holds one time step.
+    '''
+    layers = []
+    for variable, _ in variables:
+        values = nc.variables[variable]
+        if values.dimensions[-2:] != ("lat", "lon") or np.prod(values.shape[:-2]) != 1:
+            raise NetCDFError(nc.path + " doesn't hold one lat/lon grid of " + variable)
+        layers.append(values[(0,) * (len(values.shape) - 2)])
+    return np.array(layers)
+
+
+def rasterize_zones(zones, lon, lat):
+    '''Function to rasterize the zones onto the grid of the netCDF files.
+
+    1. Takes in the zone layer and the longitudes and latitudes of the cell centers.
+    2. Converts the zones to a raster by their NAME field, in WGS 1984 with the extent and cell
+    size of the grid, so each zone cell lines up with a netCDF cell.
+    3. Returns a ZoneGrid of the zone codes, in the files' order of rows and columns, and the
+    NAME of each code.
+    '''
+    cellSize = float(abs(lon[1] - lon[0]))
+    left = float(lon.min()) - cellSize / 2
+    bottom = float(lat.min()) - cellSize / 2
+    zoneRaster = os.path.join(arcpy.env.scratchGDB, "zone_labels")
+
+    arcpy.env.extent = arcpy.Extent(left, bottom, left + cellSize * len(lon),
+                                    bottom + cellSize * len(lat))
+    arcpy.env.outputCoordinateSystem = arcpy.SpatialReference(4326)
+    try:
+        arcpy.PolygonToRaster_conversion(zones, "NAME", zoneRaster, "CELL_CENTER", "NONE",
+                                         cellSize)
+        labels = arcpy.RasterToNumPyArray(zoneRaster, arcpy.Point(left, bottom), len(lon),
+                                          len(lat), -1).astype(np.int64)
+        with arcpy.da.SearchCursor(zoneRaster, ["Value", "NAME"]) as cursor:
+            names = dict((int(code), name) for code, name in cursor)
+    finally:
+        arcpy.env.extent = arcpy.env.outputCoordinateSystem = None
+        arcpy.Delete_management(zoneRaster)
+
+    # The raster's first row is the northernmost; the files list latitudes south to north.
+    if lat[0] < lat[-1]:
+        labels = labels[::-1]
+    if lon[0] > lon[-1]:
+        labels = labels[:, ::-1]
+    return ZoneGrid(labels, names, cellSize * cellSize)
+
+
+def zonal_statistics(zoneGrid, values):
+    '''Function to compute the zonal statistics of several variables at once.
 
+    1. Takes in the ZoneGrid and an array of the variables stacked together, shaped
+    (variables, rows, columns), with NaN for NoData.
+    2. Gathers each zone's cells together for every variable at once, then reduces each zone's
+    run with np.add/np.fmin/np.fmax.reduceat: the count of cells with data, the sum, the lowest
+    and highest, and the sum of squared differences from the mean for the (population)
+    standard deviation, as Zonal Statistics computes it.
+    3. Returns a dictionary of statistic (COUNT, AREA, MIN, MAX, RANGE, MEAN, STD, SUM) to an
+    array shaped (variables, zones), with a column for each code in zoneGrid.codes.
+    '''
+    if len(zoneGrid.codes) == 0:
+        empty = np.zeros((len(values), 0))
+        return dict((name, empty) for name in STATISTICS)
+
+    data = values.reshape(len(values), -1)[:, zoneGrid.cells]
+    valid = ~np.isnan(data)
+    starts = zoneGrid.starts
+    sizes = np.diff(np.r_[starts, data.shape[1]])
+
+    count = np.add.reduceat(valid.astype(np.int64), starts, axis=1)
+    total = np.add.reduceat(np.where(valid, data, 0), starts, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        deviations = np.where(valid, data - np.repeat(mean, sizes, axis=1), 0)
+        std = np.sqrt(np.add.reduceat(deviations ** 2, starts, axis=1) / count)
+        low = np.fmin.reduceat(data, starts, axis=1)
+        high = np.fmax.reduceat(data, starts, axis=1)
+
+    return {"COUNT": count, "AREA": count * zoneGrid.cell_area, "MIN": low, "MAX": high,
+            "RANGE": high - low, "MEAN": mean, "STD": std, "SUM": total}
+
+
+def summarize_file(path, zoneGrid):
+    '''Function to summarize every variable of one netCDF file.
+
+    1. Takes in the file's path and the ZoneGrid.
+    2. Reads the file's variables from one open, stacks them and computes their zonal
+    statistics together.
+    3. Returns the file's block of results: its year, month, and the TYPE of each variable,
+    with an array of the statistics shaped (STATISTICS, variables, zones).
+    '''
+    CDFs = os.path.basename(path)
+    variables = variables_for(CDFs)
+    date = FILE_DATE.search(CDFs)
+
+    print "Summarizing " + ", ".join(name for _, name in variables) + " for " + CDFs + "..."
+    with NetCDFFile(path) as nc:
+        values = read_variables(nc, variables)
+    if values.shape[1:] != zoneGrid.labels.shape:
+        raise ValueError(CDFs + " isn't on the same grid as the zones")
+    statistics = zonal_statistics(zoneGrid, values)
+
+    return (date.group(1), date.group(2), [typeName for _, typeName in variables],
+            np.array([statistics[name] for name in STATISTICS], dtype=np.float64))
+
+
+class SummaryTable(object):
+    '''The summary table, held in memory as columns and filled a file's block at a time.
+
+    Each block's rows are kept as a column of each field, and the columns of all the blocks
+    are only joined together once, by columns(), when the table is written.
+    '''
+
+    def __init__(self):
+        self.blocks = []
+        self.rows = 0
+
+    def add(self, block, zoneGrid):
+        '''Adds the rows of a file's block of results, for each variable of each zone with any
+        data, in the order of the variables and then the zones.
+        '''
+        year, month, types, statistics = block
+        variable, zone = np.nonzero(statistics[0] > 0)
+        codes = zoneGrid.codes[zone]
+        columns = {"NAME": [zoneGrid.names[int(code)] for code in codes],
+                   "MONTH": [month] * len(zone), "YEAR": [year] * len(zone),
+                   "TYPE": [types[v] for v in variable], "ZONE_CODE": codes.astype(np.int64),
+                   "COUNT": statistics[0, variable, zone].astype(np.int64)}
+        for i, name in enumerate(STATISTICS[1:], 1):
+            columns[name] = statistics[i, variable, zone]
+        self.blocks.append(columns)
+        self.rows += len(zone)
+
+    def columns(self):
+        '''Returns the table as a dictionary of field to column: a list for text fields, and
+        an array for numbers.
+        '''
+        columns = {}
+        for field, fieldType in FIELDS:
+            parts = [block[field] for block in self.blocks]
+            if fieldType == "TEXT":
+                columns[field] = [value for part in parts for value in part]
+            else:
+                dtype = np.int64 if fieldType == "LONG" else np.float64
+                columns[field] = np.concatenate(parts or [np.zeros(0)]).astype(dtype)
+        return columns
+
+
+def _cells(column, fieldType):
+    '''Returns the values of a column as text, with doubles at full precision.'''
+    if fieldType == "TEXT":
+        return column
+    if fieldType == "LONG":
+        return [u"%d" % value for value in column.tolist()]
+    return [u"%r" % value for value in column.tolist()]
+
+
+def write_csv(columns, path):
+    '''Writes the summary columns to a UTF-8 .csv file, with a header of the field names.'''
+    cells = []
+    for field, fieldType in FIELDS:
+        if fieldType == "TEXT":
+            cells.append([u'"%s"' % value.replace('"', '""') for value in columns[field]])
+        else:
+            cells.append(_cells(columns[field], fieldType))
+
+    with io.open(path, "w", encoding="utf-8", newline="") as output:
+        output.write(u",".join(field for field, _ in FIELDS) + u"\r\n")
+        for row in zip(*cells):
+            output.write(u",".join(row) + u"\r\n")
+
+
+def write_parquet(columns, path):
+    '''Writes the summary columns to a .parquet file, straight from the arrays.'''
+    table = pyarrow.Table.from_arrays([pyarrow.array(columns[field]) for field, _ in FIELDS],
+                                      [field for field, _ in FIELDS])
+    pyarrow.parquet.write_table(table, path)
+
+
+def _sheet_xml(columns):
+    '''Yields the XML of a worksheet of the summary columns a row at a time, with text as
+    inline strings.
+    '''
+    letters = [chr(ord("A") + c) for c in range(len(FIELDS))]
+    cells = []
+    for (field, fieldType), letter in zip(FIELDS, letters):
+        if fieldType == "TEXT":
+            cells.append((letter, u'" t="inlineStr"><is><t>%s</t></is></c>',
+                          [escape(value) for value in columns[field]]))
+        else:
+            cells.append((letter, u'"><v>%s</v></c>', _cells(columns[field], fieldType)))
+
+    yield (u'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+           u'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+           u'<sheetData><row r="1">')
+    yield u"".join(u'<c r="%s1" t="inlineStr"><is><t>%s</t></is></c>' % (letter, field)
+                   for (field, _), letter in zip(FIELDS, letters))
+    yield u"</row>"
+    for r, values in enumerate(itertools.izip(*[values for _, _, values in cells]), 2):
+        yield u'<row r="%d">' % r + u"".join(
+            u'<c r="%s%d' % (letter, r) + cell % value
+            for (letter, cell, _), value in zip(cells, values)) + u"</row>"
+    yield u"</sheetData></worksheet>"
+
+
+def write_xlsx(columns, path):
+    '''Function to write the summary columns to an Excel workbook.
+
+    1. Takes in the summary columns and the path of the .xlsx file.
+    2. Writes the worksheet of the summary a row at a time to a temporary file beside the
+    workbook, so it's never held in memory whole, then writes the fixed parts of a workbook and
+    compresses the worksheet into it from that file. ZIP64 is allowed, since Python 2's zipfile
+    doesn't by default, so a worksheet over 2 GB can still be written.
+    '''
+    if len(columns["NAME"]) >= XLSX_ROWS:
+        raise OutputError("The summary has more rows than an .xlsx worksheet holds; "
+                          "write it as .csv or .parquet instead.")
+
+    handle, sheetPath = tempfile.mkstemp(suffix=".xml",
+                                         dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(handle, "wb") as sheet:
+            for xml in _sheet_xml(columns):
+                sheet.write(xml.encode("utf-8"))
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for name, xml in XLSX_PARTS:
+                archive.writestr(name, xml)
+            archive.write(sheetPath, "xl/worksheets/sheet1.xml")
+    finally:
+        os.remove(sheetPath)
+
+
+# Writes the summary in each format, by file extension.
+WRITERS = {"csv": write_csv, "parquet": write_parquet, "xlsx": write_xlsx}
+
+
+def file_digest(path):
+    '''Returns a hash of the contents of a file, read a megabyte at a time.'''
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache(object):
+    '''Cache of each netCDF file's block of results, one .npz file per block in a folder.
+
+    A block is stored under a key hashed from the file's contents, the zones (ZoneGrid.digest)
+    and the variables and statistics taken, so it's only reused when none of them changed.
+    The hash of each file's contents is kept in an index with the file's size and modification
+    time, and a file is only read again to hash it when either of those changes.
+    '''
+
+    def __init__(self, folder, zoneGrid):
+        self.folder = folder
+        self.indexPath = os.path.join(folder, CACHE_INDEX)
+        self.zones = zoneGrid.digest()
+        self.index = {}
+        self.seen = {}
+        self.keys = set()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                self.index = json.load(f)
+
+    def key(self, path):
+        '''Returns the key of a file's block, hashing the file only if it's new or changed.'''
+        CDFs = os.path.basename(path)
+        status = os.stat(path)
+        entry = self.index.get(CDFs)
+        if entry is None or entry[:2] != [status.st_size, status.st_mtime]:
+            entry = [status.st_size, status.st_mtime, file_digest(path)]
+        self.seen[CDFs] = entry
+
+        key = hashlib.sha1()
+        for part in (entry[2], self.zones, repr(variables_for(CDFs)), ",".join(STATISTICS)):
+            key.update(part.encode("utf-8") + b"|")
+        self.keys.add(key.hexdigest())
+        return key.hexdigest()
+
+    def load(self, key):
+        '''Returns the cached block of a key, or None if it isn't cached or can't be read.'''
+        path = os.path.join(self.folder, key + ".npz")
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return (str(data["year"]), str(data["month"]),
+                        [str(typeName) for typeName in data["types"]], data["statistics"])
+        except Exception:
+            return None
+
+    def store(self, key, block):
+        '''Caches a block, written to a temporary file first so a block is never half
+        written.
+        '''
+        year, month, types, statistics = block
+        path = os.path.join(self.folder, key + ".npz")
+        temporary = os.path.join(self.folder, key + ".tmp.npz")
+        np.savez(temporary, year=year, month=month, types=np.array(types),
+                 statistics=statistics)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temporary, path)
+
+    def save(self):
+        '''Saves the index of the files seen this run, and removes the blocks no file
+        summarized this run needs.
+        '''
+        with open(self.indexPath, "w") as f:
+            json.dump(self.seen, f, indent=1, sort_keys=True)
+        for name in os.listdir(self.folder):
+            if name.endswith(".npz") and name[:-4] not in self.keys:
+                os.remove(os.path.join(self.folder, name))
+
+
+# Set in each worker process by _start_worker(), so the zones are sent to a worker once
+# rather than with every file.
+_job = {}
+
+
+def _start_worker(zoneGrid):
+    _job["zoneGrid"] = zoneGrid
+
+
+def _summarize(path):
+    return summarize_file(path, _job["zoneGrid"])
+
+
+def summarize_files(paths, zoneGrid, processes=PROCESSES):
+    '''Function to summarize netCDF files on every core.
+
+    1. Takes in the files' paths, the ZoneGrid, and the number of worker processes (default
+    one per CPU).
+    2. Has a process pool summarize the files at the same time, each worker returning only the
+    file's small block of results.
+    3. Yields the blocks in the order of paths, as soon as each one and those before it are
+    finished.
+    '''
+    pool = multiprocessing.Pool(processes, _start_worker, (zoneGrid,))
+    try:
+        for block in pool.imap(_summarize, paths):
+            yield block
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    '''Main program component.'''
     # Enables data overwriting.
     print "Overwriting of data enabled.\n"
     arcpy.env.overwriteOutput = True
-    
-    # Sets the workspace that the script will take in files from.
+
+    # Sets the directory that the script will take in files from.
     inputSpace = raw_input("Enter directory containing netCDF files as a complete filepath: ")
-    arcpy.env.workspace = inputSpace
 
     # Sets default output directory that files will be deposited in.
     outputSpace = raw_input("Enter directory where resulting data will be stored (complete filepath): ")
-    
-    # Sets zone locations for use in Zonal Statistics tool.
+
+    # Sets zone locations for use in computing zonal statistics.
     zones = raw_input("Enter layer to be used as zones in Zonal Statistics (complete filepath): ")
-    
-    # Stores netCDF files in variable fileList
-    fileList = os.listdir(inputSpace)
-    
-    # Creates new table that rest of tables will be appended to, with the year as the title
-    print "\nCreating summary table...\n"
-    period = fileList[0].find(".")
-    summaryFile = "Summary_" + fileList[0][period+1:period+5]
-    yearTable = arcpy.CreateTable_management(outputSpace, summaryFile + ".dbf", "", "")
-    
-    # Adds fields to final table
-    arcpy.AddField_management(yearTable, "NAME", "TEXT", "", "", 24, "", "", "", "")
-    arcpy.AddField_management(yearTable, "MONTH", "TEXT", "", "", 2, "", "", "", "")
-    arcpy.AddField_management(yearTable, "YEAR", "TEXT", "", "", 4, "", "", "", "")
-    arcpy.AddField_management(yearTable, "TYPE", "TEXT", "", "", 20, "", "", "", "")    
-    arcpy.AddField_management(yearTable, "ZONE_CODE", "LONG", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "COUNT", "LONG", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "AREA", "DOUBLE", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "MIN", "DOUBLE", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "MAX", "DOUBLE", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "RANGE", "DOUBLE", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "MEAN", "DOUBLE", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "STD", "DOUBLE", "", "", "", "", "", "", "")
-    arcpy.AddField_management(yearTable, "SUM", "DOUBLE", "", "", "", "", "", "", "")
-    
-    # Begins a loop, fetching a list of files from the input workspace and storing them in the variable "CDFs".
-    for CDFs in fileList:
-    
-        # If the file begins with "Fluxes", create rasters and tables for baseflow, evapotranspiration, runoff, and soil moisture.
-        # At the time this script was created, files were in the format of "Fluxes_Livneh_NAmerExt_15Oct2014.*four digit year**two digit month*.nc" and
-        # "livneh_NAmerExt_15Oct2014.*four digit year**two digit month*.mon.nc".
-        if CDFs.startswith("Fluxes"):
-        
-            # Creates a raster from the netCDF file stored in "CDFs" using the "Baseflow" variable, "lon" as the x-dimension, "lat" as the y-dimension, and default variables for
-            # the rest.
-            print "Creating baseflow raster for " + CDFs + "..."
-            rasterBaseflow = arcpy.MakeNetCDFRasterLayer_md (CDFs, "Baseflow", "lon", "lat", os.path.join(outputSpace, "baseflow"), "", "", "")
-            
-            # Creates a Zonal Statistics table using the specified zone layer as the zones, the watershed names as the distinguishing fields, the previously created raster as
-            # the input raster, and default variables for the rest.
-            print "Creating baseflow table for " + CDFs + "...\n"
-            outputTable = os.path.join(outputSpace, "baseflow_" + CDFs[37:39] + "_" + CDFs[33:37] + ".dbf")
-            arcpy.sa.ZonalStatisticsAsTable (zones, "NAME", rasterBaseflow, outputTable, "", "")
-            
-            # Adds month, year, and type fields to newly created table.
-            arcpy.AddField_management(outputTable, "MONTH", "TEXT", "", "", 2, "", "", "", "")
-            arcpy.AddField_management(outputTable, "YEAR", "TEXT", "", "", 4, "", "", "", "")
-            arcpy.AddField_management(outputTable, "TYPE", "TEXT", "", "", 20, "", "", "", "")
-            
-            # Populate month, year, and type fields in new table.
-            with arcpy.da.UpdateCursor(outputTable, ["MONTH", "YEAR", "TYPE"], "", "", "", (None, None)) as cursor:
-                for row in cursor:
-                    row[0] = CDFs[37:39]
-                    row[1] = CDFs[33:37]
-                    row[2] = "Baseflow"
-                    cursor.updateRow(row)
-            
-            # Appends newly created table to final table.
-            arcpy.Append_management(outputTable, yearTable, "NO_TEST", "", "")
-            
-            # Repeat the above for evapotranspiration.
-            print "Creating evapotranspiration raster for " + CDFs + "..."
-            rasterTotalET = arcpy.MakeNetCDFRasterLayer_md (CDFs, "TotalET", "lon", "lat", os.path.join(outputSpace, "evapo"), "", "")
-            print "Creating evapotranspiration table for " + CDFs + "...\n"
-            outputTable = os.path.join(outputSpace, "evapo_" + CDFs[37:39] + "_" + CDFs[33:37] + ".dbf")
-            arcpy.sa.ZonalStatisticsAsTable (zones, "NAME", rasterTotalET, outputTable, "", "")
-
-            # Adds month, year, and type fields to newly created table.
-            arcpy.AddField_management(outputTable, "MONTH", "TEXT", "", "", 2, "", "", "", "")
-            arcpy.AddField_management(outputTable, "YEAR", "TEXT", "", "", 4, "", "", "", "")
-            arcpy.AddField_management(outputTable, "TYPE", "TEXT", "", "", 20, "", "", "", "")
-            
-            # Populate month, year, and type fields in new table.
-            with arcpy.da.UpdateCursor(outputTable, ["MONTH", "YEAR", "TYPE"], "", "", "", (None, None)) as cursor:
-                for row in cursor:
-                    row[0] = CDFs[37:39]
-                    row[1] = CDFs[33:37]
-                    row[2] = "Evapotranspiration"
-                    cursor.updateRow(row)
-            
-            # Appends newly created table to final table.
-            arcpy.Append_management(outputTable, yearTable, "NO_TEST", "", "")
-            
-            print "Creating runoff raster for " + CDFs + "..."
-            rasterRunoff = arcpy.MakeNetCDFRasterLayer_md (CDFs, "Runoff", "lon", "lat", os.path.join(outputSpace, "runoff"), "", "")
-            print "Creating runoff table for " + CDFs + "...\n"
-            outputTable = os.path.join(outputSpace, "runoff_" + CDFs[37:39] + "_" + CDFs[33:37] + ".dbf")
-            arcpy.sa.ZonalStatisticsAsTable (zones, "NAME", rasterRunoff, outputTable, "", "")
-
-            # Adds month, year, and type fields to newly created table.
-            arcpy.AddField_management(outputTable, "MONTH", "TEXT", "", "", 2, "", "", "", "")
-            arcpy.AddField_management(outputTable, "YEAR", "TEXT", "", "", 4, "", "", "", "")
-            arcpy.AddField_management(outputTable, "TYPE", "TEXT", "", "", 20, "", "", "", "")
-            
-            # Populate month, year, and type fields in new table.
-            with arcpy.da.UpdateCursor(outputTable, ["MONTH", "YEAR", "TYPE"], "", "", "", (None, None)) as cursor:
-                for row in cursor:
-                    row[0] = CDFs[37:39]
-                    row[1] = CDFs[33:37]
-                    row[2] = "Runoff"
-                    cursor.updateRow(row)
-            
-            # Appends newly created table to final table.
-            arcpy.Append_management(outputTable, yearTable, "NO_TEST", "", "")
-            
-            print "Creating soil moisture raster for " + CDFs + "..."
-            rasterSoilMoist = arcpy.MakeNetCDFRasterLayer_md (CDFs, "SoilMoist", "lon", "lat", os.path.join(outputSpace, "soilmoist"), "", "")
-            print "Creating soil moisture table for " + CDFs + "...\n"
-            outputTable = os.path.join(outputSpace, "soilmoist_" + CDFs[37:39] + "_" + CDFs[33:37] + ".dbf")
-            arcpy.sa.ZonalStatisticsAsTable (zones, "NAME", rasterSoilMoist, outputTable, "", "")
-
-            # Adds month, year, and type fields to newly created table.
-            arcpy.AddField_management(outputTable, "MONTH", "TEXT", "", "", 2, "", "", "", "")
-            arcpy.AddField_management(outputTable, "YEAR", "TEXT", "", "", 4, "", "", "", "")
-            arcpy.AddField_management(outputTable, "TYPE", "TEXT", "", "", 20, "", "", "", "")
-            
-            # Populate month, year, and type fields in new table.
-            with arcpy.da.UpdateCursor(outputTable, ["MONTH", "YEAR", "TYPE"], "", "", "", (None, None)) as cursor:
-                for row in cursor:
-                    row[0] = CDFs[37:39]
-                    row[1] = CDFs[33:37]
-                    row[2] = "Soil Moisture"
-                    cursor.updateRow(row)
-            
-            # Appends newly created table to final table.
-            arcpy.Append_management(outputTable, yearTable, "NO_TEST", "", "")
-            
-        # If the file begins with anything else, create rasters and tables for precipitation.
-        elif CDFs.startswith("livneh"):
-            print "Creating precipitation raster for " + CDFs + "..."
-            rasterPrecip = arcpy.MakeNetCDFRasterLayer_md (CDFs, "Prec", "lon", "lat", os.path.join(outputSpace, "precip"), "", "")
-            print "Creating precipitation table for " + CDFs + "...\n"
-            outputTable = os.path.join(outputSpace, "precip_" + CDFs[30:32] + "_" + CDFs[26:30] + ".dbf")
-            arcpy.sa.ZonalStatisticsAsTable (zones, "NAME", rasterPrecip, outputTable, "", "ALL")
-
-            # Adds month, year, and type fields to newly created table.
-            arcpy.AddField_management(outputTable, "MONTH", "TEXT", "", "", 2, "", "", "", "")
-            arcpy.AddField_management(outputTable, "YEAR", "TEXT", "", "", 4, "", "", "", "")
-            arcpy.AddField_management(outputTable, "TYPE", "TEXT", "", "", 20, "", "", "", "")
-            
-            # Populate month, year, and type fields in new table.
-            with arcpy.da.UpdateCursor(outputTable, ["MONTH", "YEAR", "TYPE"], "", "", "", (None, None)) as cursor:
-                for row in cursor:
-                    row[0] = CDFs[30:32]
-                    row[1] = CDFs[26:30]
-                    row[2] = "Precipitation"
-                    cursor.updateRow(row)
-            
-            # Appends newly created table to final table.
-            arcpy.Append_management(outputTable, yearTable, "NO_TEST", "", "")
-        else:
-            pass
-            
-    # Returns Spatial Analyst license for use by others.
-    arcpy.CheckInExtension("Spatial")
-    
-    # Converts summary dBASE table to an Excel 2003 table.
-    arcpy.TableToExcel_conversion (yearTable, os.path.join(outputSpace, summaryFile + ".xls"), "", "")
-
-    # Deletes dBASE files generated in constructing Excel file.
-    outputFiles = os.listdir(outputSpace)
-    os.chdir(outputSpace)
-    for toDelete in outputFiles:
-        if toDelete.endswith(".xls"):
-            pass
-        elif toDelete.endswith(".lock"):
-            pass
-        else:
-            os.remove(toDelete)
-            
+
+    # Sets the format the summary is written in, .xlsx unless another is chosen.
+    outputFormat = raw_input("Enter format of the summary (" + ", ".join(FORMATS) + ") [xlsx]: ")
+    outputFormat = outputFormat.strip().lower().lstrip(".") or "xlsx"
+    if outputFormat not in FORMATS:
+        raise OutputError("Unknown summary format " + outputFormat)
+    if outputFormat == "parquet" and pyarrow is None:
+        raise OutputError("pyarrow isn't installed, so the summary can't be written as Parquet")
+
+    # Stores the netCDF files that are summarized in variable fileList
+    fileList = [CDFs for CDFs in sorted(os.listdir(inputSpace))
+                if variables_for(CDFs) and FILE_DATE.search(CDFs)]
+    if not fileList:
+        raise NetCDFError("No Fluxes or livneh netCDF files in " + inputSpace)
+
+    # Names the summary table after the years of all the files, like Summary_1950-2013
+    years = sorted(set(FILE_DATE.search(CDFs).group(1) for CDFs in fileList))
+    summaryFile = "Summary_" + years[0]
+    if years[-1] != years[0]:
+        summaryFile += "-" + years[-1]
+    summaryFile += "." + outputFormat
+
+    # Rasterizes the zones once, onto the grid of the first file
+    print "Rasterizing zones...\n"
+    with NetCDFFile(os.path.join(inputSpace, fileList[0])) as nc:
+        lon, lat = read_grid(nc)
+    zoneGrid = rasterize_zones(zones, lon, lat)
+
+    # Looks up each file's results in the cache.
+    paths = [os.path.join(inputSpace, CDFs) for CDFs in fileList]
+    cache = ResultCache(os.path.join(outputSpace, CACHE_FOLDER), zoneGrid)
+    keys = [cache.key(path) for path in paths]
+    blocks = [cache.load(key) for key in keys]
+    missing = [i for i, block in enumerate(blocks) if block is None]
+    print str(len(paths) - len(missing)) + " of " + str(len(paths)) + " files already summarized.\n"
+
+    # Summarizes the new and changed files in worker processes, caching each one's results.
+    if missing:
+        for block, i in zip(summarize_files([paths[i] for i in missing], zoneGrid), missing):
+            cache.store(keys[i], block)
+            blocks[i] = block
+    cache.save()
+
+    # Adds the rows of every file to the summary table, in the order of the files.
+    summary = SummaryTable()
+    for block in blocks:
+        summary.add(block, zoneGrid)
+
+    # Writes the summary table once, the only file this script creates besides the cache.
+    print "\nWriting " + str(summary.rows) + " rows to " + summaryFile + "...\n"
+    WRITERS[outputFormat](summary.columns(), os.path.join(outputSpace, summaryFile))
+
     print "Check " + outputSpace + " for the created summary file, " + summaryFile + "."
     # Closes console.
     raw_input("Script completed. Press Enter to quit.")
 
-# Error handling.
-except LicenseError:
-    print "Spatial Analyst license unavailable."
-    
-except Exception as e:
-    # If an error occurred, print line number and error message
-    import traceback, sys
-    tb = sys.exc_info()[2]
-    print "An error occured on line %i" % tb.tb_lineno
-    print str(e)
+
+# Guards the main program, so worker processes can import this script without running it.
+if __name__ == "__main__":
+    try:
+        main()
+
+    # Error handling.
+    except Exception as e:
+        # If an error occurred, print line number and error message
+        import traceback
+        tb = sys.exc_info()[2]
+        print "An error occured on line %i" % traceback.extract_tb(tb)[-1][1]
+        print str(e)
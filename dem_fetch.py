@@ -1,9 +1,27 @@
 # Purpose: a script to download zipped DEMs from URLs in a file for future manipulation.
 #
-# Version 1.1
+# Version 1.2
 #
 # Requires: a pre-exisitng file containing URLs. This was made for use on the MnDNR's FTP
 # server, so if you'd like to use it on a different server, variables will have to be adjusted.
+#
+# Downloads run on a pool of FTP connections (4 by default), each of which
+# reconnects itself if the server drops it. Instead of waiting 5 seconds
+# between files, politeness is kept by a token bucket limiting requests per
+# second and bytes per second to the server.
+#
+# A manifest in the output directory records each DEM's size and mtime on
+# the server and how far along it is locally, so a restarted run only
+# fetches what's missing. Partial downloads resume where they stopped (FTP
+# REST), and every archive's CRCs are checked before it's extracted.
+#
+# Downloading and extracting overlap: finished archives go through a bounded
+# queue to extractor threads, which delete each .zip once it's extracted. At
+# most --max-archives zips are on disk at any time.
+#
+# Which DEMs exist, and their sizes and mtimes, come from a catalog of the
+# server's directories listed with MLSD, cached in the output directory for
+# --catalog-ttl hours. A rerun within that time lists nothing.
 #---
 # MIT License (https://en.wikipedia.org/wiki/MIT_License)
 #
@@ -13,81 +31,702 @@
 print("importing libraries...")
 import ftplib
 import os
+import json
 import time
+import queue
 import zipfile
+import argparse
+import posixpath
+import threading
+import contextlib
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+# FTP server hosting the DEMs
+FTP_HOST = 'ftp.lmic.state.mn.us'
+
+# Bytes asked of the server at a time while downloading
+BLOCK_SIZE = 64 * 1024
+
+# File name of the download manifest, kept in the output directory
+MANIFEST_NAME = 'dem_manifest.json'
+
+# File name of the remote catalog cache, kept in the output directory
+CATALOG_NAME = 'dem_catalog.json'
+
+
+class CorruptDownloadError(Exception):
+    pass
+
+
+class LocalFileError(Exception):
+    pass
+
+
+class TokenBucket(object):
+    '''Token bucket refilled at rate tokens per second, holding at most
+    capacity (default: one second's worth). take() spends tokens, going into
+    debt if there aren't enough and sleeping until the debt is paid off, so
+    any number of threads can share one bucket. A rate of 0 or None never
+    limits.
+    '''
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens
+                              + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class HostLimiter(object):
+    '''Politeness limits for one server: commands (logins, listings,
+    SIZE/MDTM probes and downloads) per second, and bytes per second across
+    every connection.
+    '''
+
+    def __init__(self, requests_per_sec=2, bytes_per_sec=None):
+        self.requests = TokenBucket(requests_per_sec)
+        self.bytes = TokenBucket(bytes_per_sec)
+
+    def request(self):
+        self.requests.take()
+
+    def transfer(self, size):
+        self.bytes.take(size)
+
+
+class FTPPool(object):
+    '''Pool of up to size logged-in connections to one FTP server.
+
+    Connections are made as they're first needed and reused after that. One
+    that fails mid-command is closed and dropped rather than returned, so
+    the next use of its slot reconnects. retry() runs a function on a
+    pooled connection, retrying on a fresh one when the connection fails.
+    Errors on the local disk are raised as LocalFileError, which isn't one
+    of ftplib.all_errors, so they aren't mistaken for a lost connection.
+    '''
+
+    def __init__(self, host, size, limiter, user='', passwd='', timeout=60,
+                 port=21):
+        self.host = host
+        self.port = port
+        self.limiter = limiter
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.retries = 0
+
+    def _connect(self):
+        self.limiter.request()
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.passwd)
+        with self.lock:
+            self.connects += 1
+        return ftp
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.slots:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                ftp = self._connect()
+            try:
+                yield ftp
+            except ftplib.error_perm:
+                # A 5xx reply leaves the connection as good as it was
+                self.idle.put(ftp)
+                raise
+            except ftplib.all_errors:
+                ftp.close()
+                raise
+            except LocalFileError:
+                # The connection is fine, but it may have been stopped
+                # partway through a transfer whose reply is still unread
+                ftp.close()
+                raise
+            except Exception:
+                self.idle.put(ftp)
+                raise
+            except BaseException:
+                ftp.close()
+                raise
+            self.idle.put(ftp)
+
+    def retry(self, func, attempts=5):
+        '''Function to run func(ftp) on a pooled connection.
+
+        1. Takes in the function and the number of attempts.
+        2. Runs it, and if the connection fails, waits (1, 2, 4... seconds)
+        and runs it again on a fresh connection. Permanent errors like a
+        missing file (5xx replies) and errors on the local disk aren't
+        retried.
+        3. Returns what the function returns.
+        '''
+        for attempt in range(attempts):
+            try:
+                with self.connection() as ftp:
+                    return func(ftp)
+            except ftplib.error_perm:
+                raise
+            except ftplib.all_errors as e:
+                if attempt == attempts - 1:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                print("connection lost (" + str(e) + "), retrying...")
+                time.sleep(min(60, 2 ** attempt))
+
+    def close(self):
+        while True:
+            try:
+                ftp = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+
+class Progress(object):
+    '''Download progress shared by every connection, printed as one line at
+    most every interval seconds rather than once per file.
+    '''
+
+    def __init__(self, total_files, interval=5):
+        self.total_files = total_files
+        self.interval = interval
+        self.files = 0
+        self.bytes = 0
+        self.start = self.printed = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, size):
+        with self.lock:
+            self.bytes += size
+            if time.monotonic() - self.printed >= self.interval:
+                self.report()
+
+    def file_done(self):
+        with self.lock:
+            self.files += 1
+
+    def report(self):
+        self.printed = time.monotonic()
+        elapsed = max(self.printed - self.start, 1e-9)
+        print("%d/%d files, %.1f MB, %.2f MB/s" % (
+            self.files, self.total_files, self.bytes / 1e6,
+            self.bytes / 1e6 / elapsed))
+
+
+class Manifest(object):
+    '''Record of every DEM's download, saved as JSON after each change.
+
+    Entries are keyed by the path on the server and hold its size and mtime
+    there, and its state: "partial" while downloading, "verified" once its
+    CRCs check out, and "extracted" once it's unzipped.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as manifest_file:
+                self.entries = json.load(manifest_file)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def get(self, remote_path):
+        with self.lock:
+            return dict(self.entries.get(remote_path, {}))
+
+    def update(self, remote_path, **fields):
+        with self.lock:
+            self.entries.setdefault(remote_path, {}).update(fields)
+            # Written to a temporary file and renamed over the manifest, so
+            # a crash mid-write can't leave it half written
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as manifest_file:
+                json.dump(self.entries, manifest_file, indent=1,
+                          sort_keys=True)
+            os.replace(temporary, self.path)
+
 
-# Creates file object at a given location with read-only permissions ('r')
-print("opening URL file...")
-url_file = open(r"C:\Users\Gerrit\GIS\optimal_agate_picking\URLs.txt",'r')
-
-# Sets output directory
-output_dir = r"C:\Users\Gerrit\GIS\optimal_agate_picking\DEM_zips"
-
-# Opens anonyous connection [login()] to FTP server hosting DEMs
-print("connecting to DNR FTP server...")
-ftp_server = ftplib.FTP('ftp.lmic.state.mn.us')
-ftp_server.login()
-
-# Fetches list (literally) of files from desired directories for later error-proofing
-block1_dir = ftp_server.nlst(r"/pub/data/elevation/lidar/projects/arrowhead/block_1/geodatabase")
-block3_dir = ftp_server.nlst(r"/pub/data/elevation/lidar/projects/arrowhead/block_3/geodatabase")
-
-count = 0
-invalid_url = 0
-
-# Loops through the URLs contained in the local file
-for URL in url_file:
-  
-    # Create new file path to change directories into, also checks against directories
-    new_ftp_dir = os.path.join("/pub/data/elevation/lidar/projects/arrowhead/" + URL[71:79] + "geodatabase/")
-  
-    # Create filename to fetch
-    new_ftp_dem = URL[91:].rstrip('\r\n')
-  
-    # Creates the full filepath on the remote server based on the local URL file
-    check_file = os.path.join(new_ftp_dir,new_ftp_dem)
-  
-    # Checks whether or not the file actually exists. If it does not, the loop iterates.
-    if (check_file in block1_dir) or (check_file in block3_dir):
-  
-        count += 1
-
-        # Sets new local file name
-        new_local_dem = os.path.join(output_dir,new_ftp_dem)
-
-        # Change into previously created file path
-        ftp_server.cwd(new_ftp_dir)
-  
-        # Retrieve DEM designated in URL, where the file in newDEM is passed to RETR with the %s placeholder.
-		# https://docs.python.org/3.4/library/string.html#string-formatting leads me to believe this may be
-		# unecessary but it stays.
-        print("fetching " + new_ftp_dem + ", saving to disk...")
-        ftp_server.retrbinary('RETR %s' % new_ftp_dem, open(new_local_dem, 'wb').write)
-
-        # Returns to base directory
-        ftp_server.cwd('/pub/data/elevation/lidar/projects/arrowhead/')
-  
-        # Creates a zipfile object, extracts the given file, and closes the object
-        print("unzipping...")
-        zip_object = zipfile.ZipFile(new_local_dem, 'r')
+def parse_dem_url(url):
+    '''Returns the host and the full path on the server of a DEM's URL,
+    like ftp://ftp.lmic.state.mn.us/pub/data/.../geodatabase/dem.zip.
+    '''
+    parts = urlsplit(url.strip())
+    return parts.hostname, posixpath.normpath(parts.path)
+
+
+class RemoteCatalog(object):
+    '''Listing of directories on the server, with each file's size and
+    modification time, cached on disk.
+
+    Each directory's listing is kept for ttl seconds after it's made, so
+    while it's fresh, lookups don't touch the server. Files are stored by
+    directory and then by name, so looking one up is two dictionary lookups.
+    '''
+
+    def __init__(self, path, ttl=24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.listings = 0
+        try:
+            with open(path) as catalog_file:
+                self.directories = json.load(catalog_file)
+        except (FileNotFoundError, ValueError):
+            self.directories = {}
+
+    def is_fresh(self, directory):
+        listing = self.directories.get(directory)
+        return (listing is not None
+                and time.time() - listing['listed'] < self.ttl)
+
+    def _list(self, ftp, directory, limiter):
+        '''Returns the entries of a directory on the server as a dictionary
+        of name to its type, size and modification time, each listing held
+        to the HostLimiter. Servers without MLSD are listed with NLST, which
+        gives names only. A directory that isn't on the server (550) lists
+        as empty, so the DEMs in it are counted as invalid URLs rather than
+        stopping the run.
+        '''
+        limiter.request()
+        try:
+            return {name: {'type': facts.get('type'),
+                           'size': (int(facts['size']) if 'size' in facts
+                                    else None),
+                           'mtime': facts.get('modify', '')[:14] or None}
+                    for name, facts in ftp.mlsd(directory,
+                                                ['type', 'size', 'modify'])
+                    if facts.get('type') not in ('cdir', 'pdir')}
+        except ftplib.error_perm as e:
+            if str(e).startswith('550'):
+                return {}
+            if not str(e).startswith(('500', '502')):
+                raise
+        limiter.request()
+        try:
+            return {posixpath.basename(name): {'type': None, 'size': None,
+                                               'mtime': None}
+                    for name in ftp.nlst(directory)}
+        except ftplib.error_perm as e:
+            if not str(e).startswith('550'):
+                raise
+            return {}
+
+    def refresh(self, pool, directories, recursive=False, force=False):
+        '''Function to list directories on the server into the catalog.
+
+        1. Takes in the FTPPool, the directories, whether to go into their
+        subdirectories, and whether to list them even if still fresh.
+        2. Lists each stale directory on a pooled connection, in parallel,
+        queuing the subdirectories found when recursive.
+        3. Saves the catalog if anything was listed.
+        '''
+        pending = set(posixpath.normpath(d) for d in directories)
+        done = set()
+        while pending:
+            stale = [d for d in pending if force or not self.is_fresh(d)]
+            with ThreadPoolExecutor(pool.size) as executor:
+                listings = executor.map(
+                    lambda d: pool.retry(
+                        lambda ftp: self._list(ftp, d, pool.limiter)),
+                    stale)
+                for directory, files in zip(stale, listings):
+                    with self.lock:
+                        self.listings += 1
+                        self.directories[directory] = {'listed': time.time(),
+                                                       'files': files}
+            done |= pending
+            pending = set()
+            if recursive:
+                for directory in done:
+                    for name, entry in self.directories[directory][
+                            'files'].items():
+                        child = posixpath.join(directory, name)
+                        if entry['type'] == 'dir' and child not in done:
+                            pending.add(child)
+        if self.listings:
+            self.save()
+
+    def lookup(self, remote_path):
+        '''Returns the catalog entry of a file (its type, size and mtime),
+        or None if it isn't on the server.
+        '''
+        listing = self.directories.get(posixpath.dirname(remote_path))
+        if listing is None:
+            return None
+        return listing['files'].get(posixpath.basename(remote_path))
+
+    def save(self):
+        with self.lock:
+            temporary = self.path + '.tmp'
+            with open(temporary, 'w') as catalog_file:
+                json.dump(self.directories, catalog_file)
+            os.replace(temporary, self.path)
+
+
+def remote_stat(ftp, remote_path, limiter):
+    '''Returns the size and modification time (as YYYYMMDDHHMMSS) of a
+    file on the server, either of which is None if the server doesn't
+    support the command. Each command is held to the HostLimiter.
+    '''
+    size = mtime = None
+    try:
+        limiter.request()
+        ftp.voidcmd('TYPE I')
+        limiter.request()
+        size = ftp.size(remote_path)
+    except ftplib.error_perm:
+        pass
+    try:
+        limiter.request()
+        mtime = ftp.voidcmd('MDTM ' + remote_path).split()[-1]
+    except ftplib.error_perm:
+        pass
+    return size, mtime
+
+
+def verify_zip(path):
+    '''Raises CorruptDownloadError unless every member of a zip file reads
+    back with the right CRC.
+    '''
+    try:
+        with zipfile.ZipFile(path) as zip_object:
+            bad_member = zip_object.testzip()
+    except (zipfile.BadZipFile, OSError) as e:
+        raise CorruptDownloadError(path + ": " + str(e))
+    if bad_member is not None:
+        raise CorruptDownloadError(path + ": bad CRC in " + bad_member)
+
+
+@contextlib.contextmanager
+def local_file_errors(path):
+    '''Raises any OSError from the local disk, like a full disk or a denied
+    permission, as LocalFileError. Socket errors are OSErrors too, so
+    without this FTPPool.retry() would take them for a lost connection.
+    '''
+    try:
+        yield
+    except OSError as e:
+        raise LocalFileError(path + ": " + str(e)) from e
+
+
+def download(pool, remote_path, local_path, progress, manifest,
+             remote_info=None):
+    '''Function to download one zipped DEM, unless it's already here.
+
+    1. Takes in the FTPPool, the full path of the file on the server, the
+    path to save it to, the Progress to add to, the Manifest, and the file's
+    size and mtime on the server if already known from the catalog.
+    2. Checks the file's size and mtime on the server against the manifest.
+    If they match an archive already verified, there's nothing to do. If
+    both are known and match a partial download, it's resumed from where it
+    stopped, unless the server refuses to resume (REST). Otherwise any
+    partial download is discarded and the file is downloaded from the start.
+    3. Downloads to local_path + '.part', holding to the pool's byte rate
+    and resuming on a new connection if this one drops. The finished
+    archive's CRCs are checked before it's renamed to local_path, and one
+    that fails is downloaded once more from the start. Errors on the local
+    disk are raised as LocalFileError and not retried.
+    '''
+    partial_path = local_path + '.part'
+
+    def receive(ftp, offset):
+        pool.limiter.request()
+        with local_file_errors(partial_path):
+            local_file = open(partial_path, 'r+b' if offset else 'wb')
+        try:
+            with local_file_errors(partial_path):
+                local_file.truncate(offset)
+                local_file.seek(offset)
+
+            def write(block):
+                with local_file_errors(partial_path):
+                    local_file.write(block)
+                pool.limiter.transfer(len(block))
+                progress.add(len(block))
+            ftp.retrbinary('RETR ' + remote_path, write, BLOCK_SIZE,
+                           rest=offset or None)
+        finally:
+            with local_file_errors(partial_path):
+                local_file.close()
+
+    def fetch(ftp):
+        entry = manifest.get(remote_path)
+        if remote_info is None:
+            size, mtime = remote_stat(ftp, remote_path, pool.limiter)
+        else:
+            size, mtime = remote_info
+        unchanged = (entry.get('size'), entry.get('mtime')) == (size, mtime)
+        if (unchanged and entry.get('state') == 'verified'
+                and os.path.exists(local_path)):
+            return
+        # A partial download is only resumed if the manifest knows the size
+        # and mtime it was started against and the server still reports
+        # them; otherwise there's no telling whether the file has changed,
+        # so it's discarded and downloaded from the start
+        resumable = (unchanged and entry.get('state') == 'partial'
+                     and size is not None and mtime is not None)
+        # Everything on the local disk is kept apart from the FTP commands,
+        # so that only the commands' errors count as a lost connection
+        with local_file_errors(partial_path):
+            if resumable and os.path.exists(partial_path):
+                offset = os.path.getsize(partial_path)
+            else:
+                offset = 0
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+            if size is not None and offset > size:
+                offset = 0
+            manifest.update(remote_path, size=size, mtime=mtime,
+                            state='partial', local=local_path)
+
+        if size is None or offset < size:
+            try:
+                receive(ftp, offset)
+            except ftplib.error_perm as e:
+                if not offset:
+                    raise
+                # The server turned down the REST (or doesn't have it), so
+                # the partial download is discarded and the file downloaded
+                # from the start. A file that's really gone fails again.
+                print("resume refused (" + str(e) + "), downloading "
+                      + remote_path + " from the start...")
+                with local_file_errors(partial_path):
+                    os.remove(partial_path)
+                receive(ftp, 0)
+
+        with local_file_errors(partial_path):
+            # A transfer that ends early without an error is treated like a
+            # dropped connection, so it's resumed on the next attempt
+            received = os.path.getsize(partial_path)
+            if size is not None and received != size:
+                raise EOFError("download ended at %d of %d bytes"
+                               % (received, size))
+
+            verify_zip(partial_path)
+            os.replace(partial_path, local_path)
+            manifest.update(remote_path, state='verified')
+
+    try:
+        pool.retry(fetch)
+    except CorruptDownloadError as e:
+        print("corrupt download (" + str(e) + "), downloading again...")
+        os.remove(partial_path)
+        pool.retry(fetch)
+    progress.file_done()
+
+
+def extract_dem(remote_path, local_path, output_dir, manifest):
+    '''Extracts a downloaded zipped DEM into output_dir, then deletes the
+    zip. The zip is kept if extraction fails.
+    '''
+    # Creates a zipfile object, extracts the given file, and closes the object
+    with zipfile.ZipFile(local_path, 'r') as zip_object:
         zip_object.extractall(output_dir)
-        zip_object.close()
+    manifest.update(remote_path, state='extracted')
+    os.remove(local_path)
+
+
+def fetch_all(pool, remote_dems, output_dir, progress, manifest,
+              downloaders=4, extractors=2, max_archives=8, catalog=None):
+    '''Function to download and extract DEMs, overlapping the two.
+
+    1. Takes in the FTPPool, the full paths of the DEMs on the server, the
+    output directory, the Progress and Manifest, the number of download and
+    extraction threads, the most archives allowed on disk at once, and the
+    RemoteCatalog to take sizes and mtimes from. With a catalog, extracted
+    DEMs whose size or mtime has changed on the server are fetched again.
+    2. Downloads on the downloader threads and hands each finished archive
+    to the extractor threads through a bounded queue, so the network and
+    disk are both kept busy. An archive counts against max_archives from
+    when its download starts until its zip is deleted after extraction, so
+    downloaders wait rather than run the scratch disk past that.
+    3. Returns a list of (remote path, error) for the DEMs that failed.
+    '''
+    in_flight = threading.BoundedSemaphore(max_archives)
+    extract_queue = queue.Queue(maxsize=extractors)
+    failures = []
+
+    def fetch(remote_path):
+        entry = manifest.get(remote_path)
+        remote_info = None
+        if catalog is not None:
+            catalog_entry = catalog.lookup(remote_path)
+            if catalog_entry and catalog_entry['size'] is not None:
+                remote_info = (catalog_entry['size'], catalog_entry['mtime'])
+        if entry.get('state') == 'extracted' and remote_info in (
+                None, (entry.get('size'), entry.get('mtime'))):
+            progress.file_done()
+            return
+        local_path = os.path.join(output_dir, os.path.basename(remote_path))
+        in_flight.acquire()
+        try:
+            download(pool, remote_path, local_path, progress, manifest,
+                     remote_info)
+        except ftplib.all_errors + (CorruptDownloadError,
+                                    LocalFileError) as e:
+            in_flight.release()
+            failures.append((remote_path, e))
+            return
+        extract_queue.put((remote_path, local_path))
+
+    def extract():
+        while True:
+            item = extract_queue.get()
+            if item is None:
+                extract_queue.task_done()
+                return
+            # Any error only fails this DEM, since an extractor thread that
+            # died would leave the downloaders blocked on the full queue
+            try:
+                extract_dem(item[0], item[1], output_dir, manifest)
+            except Exception as e:
+                failures.append((item[0], e))
+            finally:
+                in_flight.release()
+                extract_queue.task_done()
+
+    extract_threads = [threading.Thread(target=extract)
+                       for _ in range(extractors)]
+    for thread in extract_threads:
+        thread.start()
+    try:
+        with ThreadPoolExecutor(downloaders) as executor:
+            # Consumed so any unexpected error in fetch() is raised here
+            list(executor.map(fetch, remote_dems))
+    finally:
+        for thread in extract_threads:
+            extract_queue.put(None)
+        for thread in extract_threads:
+            thread.join()
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Download zipped DEMs from URLs in a file.')
+    parser.add_argument('url_file', nargs='?',
+                        default=r"C:\Users\Gerrit\GIS\optimal_agate_picking\URLs.txt")
+    parser.add_argument('output_dir', nargs='?',
+                        default=r"C:\Users\Gerrit\GIS\optimal_agate_picking\DEM_zips")
+    parser.add_argument('--host',
+                        help='FTP server, as host or host:port (default '
+                             'the host in the URLs, or ' + FTP_HOST + ')')
+    parser.add_argument('--connections', type=int, default=4,
+                        help='FTP connections to download on (default 4)')
+    parser.add_argument('--requests-per-sec', type=float, default=2,
+                        help='most FTP commands sent per second (default 2)')
+    parser.add_argument('--max-mbps', type=float,
+                        help='most MB per second downloaded (default no '
+                             'limit)')
+    parser.add_argument('--extractors', type=int, default=2,
+                        help='threads unzipping downloaded DEMs (default 2)')
+    parser.add_argument('--max-archives', type=int,
+                        help='most zips on disk at once, counting those '
+                             'still downloading (default twice the '
+                             'connections)')
+    parser.add_argument('--catalog-ttl', type=float, default=24,
+                        help='hours before a directory on the server is '
+                             'listed again (default 24)')
+    parser.add_argument('--refresh-catalog', action='store_true',
+                        help='list the directories again now')
+    parser.add_argument('--crawl', action='append', default=[],
+                        help='also catalog this directory on the server and '
+                             'everything under it (can be repeated)')
+    args = parser.parse_args()
+
+    # Creates file object at a given location with read-only permissions ('r')
+    print("opening URL file...")
+    url_file = open(args.url_file, 'r')
+
+    # Sets output directory
+    output_dir = args.output_dir
+
+    # Reads the URLs contained in the local file, splitting each into the
+    # server and the full path of the DEM on it
+    dem_urls = [parse_dem_url(URL) for URL in url_file if URL.strip()]
+
+    # Sets up the pool of anonymous connections [login()] to the FTP server
+    # hosting DEMs
+    print("connecting to DNR FTP server...")
+    limiter = HostLimiter(args.requests_per_sec,
+                          args.max_mbps and args.max_mbps * 1e6)
+    host, _, port = (args.host or next(
+        (url_host for url_host, _ in dem_urls if url_host),
+        FTP_HOST)).partition(':')
+    pool = FTPPool(host, args.connections, limiter, port=int(port or 21))
+
+    # Lists the directories the DEMs are in (unless listed recently) for
+    # later error-proofing
+    catalog = RemoteCatalog(os.path.join(output_dir, CATALOG_NAME),
+                            args.catalog_ttl * 3600)
+    catalog.refresh(pool, set(posixpath.dirname(path)
+                              for _, path in dem_urls),
+                    force=args.refresh_catalog)
+    if args.crawl:
+        catalog.refresh(pool, args.crawl, recursive=True,
+                        force=args.refresh_catalog)
+    print(str(catalog.listings) + " director(ies) listed")
+
+    invalid_url = 0
+    remote_dems = []
 
-        # Waiting 5 seconds before fetching another file, for the sake of politeness
-        print("waiting 5 seconds...\n")
-        time.sleep(5)
+    # Checks whether or not each file actually exists. If it does not, it's
+    # counted as invalid.
+    for _, remote_path in dem_urls:
+        if catalog.lookup(remote_path) is not None:
+            remote_dems.append(remote_path)
+        else:
+            invalid_url += 1
 
-    else:
-        invalid_url += 1
+    count = len(remote_dems)
 
-print("\n" + str(count) + " valid url(s)")
-print(str(invalid_url) + " invalid url(s)\n")
+    # Fetches the DEMs on as many threads as there are connections and
+    # unzips them as they arrive, deleting each .zip once it's extracted
+    print("fetching " + str(count) + " DEMs...")
+    progress = Progress(count)
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    failures = fetch_all(pool, remote_dems, output_dir, progress, manifest,
+                         args.connections, args.extractors,
+                         args.max_archives or 2 * args.connections, catalog)
+    for remote_dem, error in failures:
+        print("failed to fetch " + remote_dem + ": " + str(error))
+    progress.report()
 
-print("deleting downloaded .zip files...)
+    print("\n" + str(count) + " valid url(s)")
+    print(str(invalid_url) + " invalid url(s)")
+    print(str(len(failures)) + " failed download(s)")
+    print(str(pool.retries) + " retried connection(s)\n")
 
-# Closes FTP connection
-print("freeing system resources...")
-ftp_server.quit()
+    # Closes FTP connections
+    print("freeing system resources...")
+    pool.close()
 
-# Deletes file object, freeing system resources
-url_file.close()
\ No newline at end of file
+    # Deletes file object, freeing system resources
+    url_file.close()
@@ -0,0 +1,445 @@
+# Purpose: a local stand-in for the MnDNR's FTP server and a benchmark of
+# dem_fetch.py's download-and-extract path against it, so changes to the
+# download engine can be measured without touching ftp.lmic.state.mn.us.
+#
+# The stand-in (FakeFTPServer) is a small threaded FTP server serving
+# synthetic zipped DEM tiles from memory, laid out like the arrowhead
+# project. It speaks just enough FTP for ftplib (PASV/EPSV, SIZE, MDTM,
+# MLSD, NLST, REST and RETR) and can add latency to every reply, limit
+# bandwidth per connection and for the whole server, refuse connections past
+# a limit, drop a share of downloads partway through, and refuse REST, so
+# dropped downloads have to start over.
+#
+# The benchmark runs dem_fetch's fetch_all() once per connection count and
+# reports MB/s, tiles/min, retried connections and failures for each. A few
+# URLs point at a directory the server doesn't have, and should be counted
+# as invalid without stopping the run.
+#
+# Usage: python dem_fetch_bench.py [--tiles N] [--tile-mb MB]
+#                                  [--connections 1 2 4 8] [--latency SEC]
+#                                  [--bandwidth-mbps MB] [--server-mbps MB]
+#                                  [--disconnect-rate P] [--max-connections N]
+#                                  [--missing N] [--no-rest]
+#        python dem_fetch_bench.py --serve ...   (runs only the stand-in, for
+#                                                 use with dem_fetch.py)
+#---
+# MIT License (https://en.wikipedia.org/wiki/MIT_License)
+#
+# Copyright (c) 2017 Gerrit VanderWaal
+#---
+
+import io
+import os
+import time
+import random
+import socket
+import zipfile
+import argparse
+import tempfile
+import posixpath
+import threading
+import socketserver
+
+import dem_fetch
+
+# Directory the synthetic tiles are served under, as on the real server
+PROJECT_DIR = '/pub/data/elevation/lidar/projects/arrowhead'
+
+# Directory the missing tiles' URLs point at, which the server doesn't have
+MISSING_DIR = posixpath.join(PROJECT_DIR, 'block_9', 'geodatabase')
+
+# Bytes sent on a data connection at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def make_tiles(count, size, blocks=('block_1', 'block_3'), seed=0):
+    '''Function to make synthetic zipped DEM tiles.
+
+    1. Takes in the number of tiles, the size of each in bytes, the project
+    blocks to spread them across, and the random seed.
+    2. Zips a file geodatabase of random (so incompressible) bytes for each.
+    3. Returns a dictionary of the path each is served at to its bytes.
+    '''
+    rand = random.Random(seed)
+    tiles = {}
+    for n in range(count):
+        block = blocks[n % len(blocks)]
+        name = 'tile_%04d' % n
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as zip_object:
+            zip_object.writestr(name + '.gdb/a00000001.gdbtable',
+                                rand.getrandbits(8 * size).to_bytes(size,
+                                                                    'little'))
+        tiles[posixpath.join(PROJECT_DIR, block, 'geodatabase',
+                             name + '.zip')] = buffer.getvalue()
+    return tiles
+
+
+class FakeFTPServer(socketserver.ThreadingTCPServer):
+    '''Threaded FTP server on localhost serving files from a dictionary of
+    path to bytes. Port 0 picks a free port; see .port once it's made.
+
+    latency is slept before every reply, bandwidth (bytes/sec) limits each
+    download, total_bandwidth limits all of them together, max_connections
+    turns away logins past that many with 421, disconnect_rate is the
+    chance each download is cut off partway, closing the connection, and
+    with rest False, REST is answered 502 as on servers that can't resume.
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, files, port=0, latency=0, bandwidth=None,
+                 total_bandwidth=None, max_connections=None,
+                 disconnect_rate=0, seed=0, rest=True):
+        super().__init__(('127.0.0.1', port), _FTPHandler)
+        self.files = files
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.total_limiter = dem_fetch.TokenBucket(total_bandwidth)
+        self.max_connections = max_connections
+        self.disconnect_rate = disconnect_rate
+        self.rest = rest
+        self.random = random.Random(seed)
+        self.mtime = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.refused = 0
+        self.disconnects = 0
+
+        # Every directory above a file, mapped to the names in it and
+        # whether each is a file or a directory
+        self.directories = {'/': {}}
+        for path in files:
+            child, kind = path, 'file'
+            while child != '/':
+                parent = posixpath.dirname(child)
+                self.directories.setdefault(parent, {})[
+                    posixpath.basename(child)] = kind
+                child, kind = parent, 'dir'
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _FTPHandler(socketserver.StreamRequestHandler):
+    '''One control connection to FakeFTPServer.'''
+
+    def reply(self, text):
+        time.sleep(self.server.latency)
+        self.wfile.write((text + '\r\n').encode())
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            full = (server.max_connections is not None
+                    and server.connections >= server.max_connections)
+            if full:
+                server.refused += 1
+            else:
+                server.connections += 1
+        if full:
+            self.reply('421 Too many connections, try again later')
+            return
+
+        self.cwd = '/'
+        self.rest = 0
+        self.passive = None
+        try:
+            self.reply('220 Stand-in DEM server ready')
+            for line in self.rfile:
+                command, _, argument = line.decode().rstrip('\r\n') \
+                    .partition(' ')
+                handler = getattr(self, 'ftp_' + command.lower(), None)
+                if handler is None:
+                    self.reply('502 Command not implemented')
+                elif handler(argument) is False:
+                    return
+        except (ConnectionError, socket.timeout):
+            pass
+        finally:
+            if self.passive is not None:
+                self.passive.close()
+            with server.lock:
+                server.connections -= 1
+
+    def _path(self, argument):
+        return posixpath.normpath(posixpath.join(self.cwd, argument or '.'))
+
+    def _data_connection(self):
+        '''Accepts the data connection the client opened after PASV/EPSV.'''
+        if self.passive is None:
+            self.reply('425 Use PASV or EPSV first')
+            return None
+        self.passive.settimeout(10)
+        try:
+            connection, _ = self.passive.accept()
+        except socket.timeout:
+            self.reply('425 Data connection timed out')
+            return None
+        finally:
+            self.passive.close()
+            self.passive = None
+        return connection
+
+    def ftp_user(self, argument):
+        self.reply('331 Any password will do')
+
+    def ftp_pass(self, argument):
+        self.reply('230 Logged in')
+
+    def ftp_type(self, argument):
+        self.reply('200 Type set to ' + argument)
+
+    def ftp_noop(self, argument):
+        self.reply('200 OK')
+
+    def ftp_pwd(self, argument):
+        self.reply('257 "' + self.cwd + '"')
+
+    def ftp_cwd(self, argument):
+        path = self._path(argument)
+        if path in self.server.directories:
+            self.cwd = path
+            self.reply('250 Directory changed')
+        else:
+            self.reply('550 No such directory')
+
+    def ftp_size(self, argument):
+        data = self.server.files.get(self._path(argument))
+        if data is None:
+            self.reply('550 No such file')
+        else:
+            self.reply('213 %d' % len(data))
+
+    def ftp_mdtm(self, argument):
+        if self._path(argument) in self.server.files:
+            self.reply('213 ' + self.server.mtime)
+        else:
+            self.reply('550 No such file')
+
+    def ftp_rest(self, argument):
+        if not self.server.rest:
+            self.reply('502 Command not implemented')
+            return
+        self.rest = int(argument)
+        self.reply('350 Restarting at ' + argument)
+
+    def _listen(self):
+        if self.passive is not None:
+            self.passive.close()
+        self.passive = socket.socket()
+        self.passive.bind(('127.0.0.1', 0))
+        self.passive.listen(1)
+        return self.passive.getsockname()[1]
+
+    def ftp_pasv(self, argument):
+        port = self._listen()
+        self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)'
+                   % (port // 256, port % 256))
+
+    def ftp_epsv(self, argument):
+        self.reply('229 Entering Extended Passive Mode (|||%d|)'
+                   % self._listen())
+
+    def _send_listing(self, argument, format_entry):
+        path = self._path(argument)
+        entries = self.server.directories.get(path)
+        if entries is None:
+            self.reply('550 No such directory')
+            return
+        self.reply('150 Listing ' + path)
+        connection = self._data_connection()
+        if connection is None:
+            return
+        with connection:
+            connection.sendall(''.join(
+                format_entry(path, name, kind) + '\r\n'
+                for name, kind in sorted(entries.items())).encode())
+        self.reply('226 Listing sent')
+
+    def ftp_mlsd(self, argument):
+        def format_entry(path, name, kind):
+            facts = 'type=%s;modify=%s;' % (kind, self.server.mtime)
+            if kind == 'file':
+                facts += 'size=%d;' % len(
+                    self.server.files[posixpath.join(path, name)])
+            return facts + ' ' + name
+        self._send_listing(argument, format_entry)
+
+    def ftp_nlst(self, argument):
+        # Full paths, like the MnDNR's server gives
+        self._send_listing(argument,
+                           lambda path, name, kind: posixpath.join(path, name))
+
+    def ftp_retr(self, argument):
+        server = self.server
+        data = server.files.get(self._path(argument))
+        rest, self.rest = self.rest, 0
+        if data is None:
+            self.reply('550 No such file')
+            return
+        with server.lock:
+            drop = server.random.random() < server.disconnect_rate
+            cut = server.random.randint(rest, len(data)) if drop else None
+        self.reply('150 Sending %d bytes' % (len(data) - rest))
+        connection = self._data_connection()
+        if connection is None:
+            return
+        with connection:
+            end = len(data) if cut is None else cut
+            for start in range(rest, end, CHUNK_SIZE):
+                chunk = data[start:min(start + CHUNK_SIZE, end)]
+                server.total_limiter.take(len(chunk))
+                connection.sendall(chunk)
+                if server.bandwidth:
+                    time.sleep(len(chunk) / server.bandwidth)
+        if cut is not None:
+            # Drops the control connection too, as a real network failure
+            # would
+            with server.lock:
+                server.disconnects += 1
+            return False
+        self.reply('226 Transfer complete')
+
+    def ftp_quit(self, argument):
+        self.reply('221 Goodbye')
+        return False
+
+
+def missing_tiles(count):
+    '''Returns the paths of count tiles in a directory the server doesn't
+    have.
+    '''
+    return [posixpath.join(MISSING_DIR, 'missing_%04d.zip' % n)
+            for n in range(count)]
+
+
+def run_fetch(server, tiles, connections, output_dir, requests_per_sec=0,
+              extractors=2, missing=()):
+    '''Function to time one dem_fetch download-and-extract run.
+
+    1. Takes in the running FakeFTPServer, the paths of the tiles to fetch,
+    the number of connections, an empty output directory, the politeness
+    limit, the number of extractor threads, and paths of tiles that aren't
+    on the server.
+    2. Catalogs the tiles' directories and drops the tiles the catalog
+    doesn't have, then runs fetch_all() as dem_fetch.py does.
+    3. Returns a dictionary of MB/s, tiles/min, seconds, retried connections,
+    connections made, failures, and invalid URLs.
+    '''
+    limiter = dem_fetch.HostLimiter(requests_per_sec)
+    pool = dem_fetch.FTPPool('127.0.0.1', connections, limiter,
+                             port=server.port)
+    start = time.perf_counter()
+    catalog = dem_fetch.RemoteCatalog(
+        os.path.join(output_dir, dem_fetch.CATALOG_NAME))
+    requested = list(tiles) + list(missing)
+    catalog.refresh(pool, set(posixpath.dirname(tile) for tile in requested))
+    remote_dems = [tile for tile in requested
+                   if catalog.lookup(tile) is not None]
+    progress = dem_fetch.Progress(len(remote_dems), interval=float('inf'))
+    manifest = dem_fetch.Manifest(
+        os.path.join(output_dir, dem_fetch.MANIFEST_NAME))
+    failures = dem_fetch.fetch_all(pool, remote_dems, output_dir, progress,
+                                   manifest, connections, extractors,
+                                   2 * connections, catalog)
+    seconds = time.perf_counter() - start
+    pool.close()
+    return {'mb_per_sec': progress.bytes / 1e6 / seconds,
+            'tiles_per_min': (len(remote_dems) - len(failures)) / seconds
+            * 60,
+            'seconds': seconds, 'retries': pool.retries,
+            'connects': pool.connects, 'failures': len(failures),
+            'invalid': len(requested) - len(remote_dems)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark dem_fetch.py against a local stand-in for "
+                    "the MnDNR's FTP server.")
+    parser.add_argument('--tiles', type=int, default=24,
+                        help='number of synthetic tiles (default 24)')
+    parser.add_argument('--tile-mb', type=float, default=2,
+                        help='size of each tile in MB (default 2)')
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='connection counts to run (default 1 2 4 8)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added to every reply (default 0.02)')
+    parser.add_argument('--bandwidth-mbps', type=float, default=4,
+                        help='MB/s limit per download (default 4)')
+    parser.add_argument('--server-mbps', type=float, default=20,
+                        help='MB/s limit for the whole server (default 20)')
+    parser.add_argument('--max-connections', type=int,
+                        help='connections the server allows at once '
+                             '(default no limit)')
+    parser.add_argument('--disconnect-rate', type=float, default=0.05,
+                        help='share of downloads cut off partway '
+                             '(default 0.05)')
+    parser.add_argument('--missing', type=int, default=1,
+                        help='URLs pointing at a directory the server '
+                             "doesn't have (default 1)")
+    parser.add_argument('--no-rest', action='store_true',
+                        help="have the server refuse REST, so cut off "
+                             "downloads start over")
+    parser.add_argument('--requests-per-sec', type=float, default=0,
+                        help="dem_fetch's command rate limit (default none)")
+    parser.add_argument('--serve', action='store_true',
+                        help='only run the stand-in, writing a URL file '
+                             'for dem_fetch.py')
+    parser.add_argument('--port', type=int, default=0,
+                        help='port for --serve (default any free port)')
+    args = parser.parse_args()
+
+    tiles = make_tiles(args.tiles, int(args.tile_mb * 1e6))
+    missing = missing_tiles(args.missing)
+    server = FakeFTPServer(
+        tiles, args.port, args.latency,
+        args.bandwidth_mbps and args.bandwidth_mbps * 1e6,
+        args.server_mbps and args.server_mbps * 1e6, args.max_connections,
+        args.disconnect_rate, rest=not args.no_rest).start()
+
+    if args.serve:
+        url_path = os.path.abspath('stand_in_URLs.txt')
+        with open(url_path, 'w') as url_file:
+            for tile in sorted(tiles) + missing:
+                url_file.write('ftp://127.0.0.1' + tile + '\n')
+        print("serving " + str(len(tiles)) + " tiles on 127.0.0.1:"
+              + str(server.port) + ", URLs in " + url_path)
+        print("run: python dem_fetch.py " + url_path + " OUTPUT_DIR --host "
+              "127.0.0.1:" + str(server.port))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.stop()
+    else:
+        print("%d tiles of %.1f MB, %.0f ms latency, %s MB/s per download, "
+              "%s MB/s total, %.0f%% cut off%s" % (
+                  args.tiles, args.tile_mb, args.latency * 1000,
+                  args.bandwidth_mbps or 'unlimited',
+                  args.server_mbps or 'unlimited',
+                  args.disconnect_rate * 100,
+                  ', no REST' if args.no_rest else ''))
+        print('%-12s %8s %10s %9s %8s %9s %9s %8s' % (
+            'connections', 'MB/s', 'tiles/min', 'seconds', 'retries',
+            'connects', 'failures', 'invalid'))
+        for connections in args.connections:
+            with tempfile.TemporaryDirectory() as output_dir:
+                result = run_fetch(server, sorted(tiles), connections,
+                                   output_dir, args.requests_per_sec,
+                                   missing=missing)
+            print('%-12d %8.2f %10.1f %9.2f %8d %9d %9d %8d' % (
+                connections, result['mb_per_sec'], result['tiles_per_min'],
+                result['seconds'], result['retries'], result['connects'],
+                result['failures'], result['invalid']))
+        server.stop()
@@ -1,23 +1,530 @@
 print("importing os...")
 import os
-print("importing arcpy...")
-import arcpy
+import json
+import math
+import argparse
+import multiprocessing
+from collections import namedtuple, defaultdict
 
-arcpy.env.workspace = r"C:\Users\Gerrit\GIS\optimal_agate_picking\DEM_zips"
+# arcpy is only needed for the arcpy engine, and GDAL and NumPy only for the
+# numpy engine, so neither is required to be installed for the other. arcpy
+# is imported in the main process only: the numpy engine's worker processes
+# don't use it, and on Windows each would import it again, which takes a
+# while and checks out a license
+arcpy = None
+if multiprocessing.current_process().name == 'MainProcess':
+    try:
+        print("importing arcpy...")
+        import arcpy
+    except ImportError:
+        arcpy = None
+try:
+    import numpy as np
+    from osgeo import gdal
+    gdal.UseExceptions()
+except ImportError:
+    np = gdal = None
 
-gdb_list = os.listdir(r"C:\Users\Gerrit\GIS\optimal_agate_picking\DEM_zips")
+# Folder holding a .gdb per downloaded DEM, the raster inside each, and where
+# the mosaic goes
+DEM_DIR = r"C:\Users\Gerrit\GIS\optimal_agate_picking\DEM_zips"
+DEM_NAME = "dem_1m_m"
+OUTPUT_GDB = r"C:\Users\Gerrit\GIS\optimal_agate_picking\dem_1m.gdb"
+OUTPUT_NAME = "north_shore_1m"
 
-dem_list = []
+# NoData value of the numpy engine's output, the lowest 32-bit float, which
+# is what ArcGIS uses for float rasters
+NODATA = -3.4028234663852886e+38
 
-for directory in gdb_list:
-    new_dir = os.path.join("C:\\Users\\Gerrit\\GIS\\optimal_agate_picking\\DEM_zips\\" + directory.rstrip('\r\n'))
-    os.chdir(new_dir)
-    dem_name = os.path.join(new_dir + r"\dem_1m_m")
-    dem_list.append(dem_name)
-    print("appending " + directory)
-    os.chdir(r"C:\Users\Gerrit\GIS\optimal_agate_picking\DEM_zips")
+# Width and height in cells of the pieces the numpy engine splits the
+# mosaic into, each filled by one worker process
+TILE_SIZE = 2048
 
-print("mosaicing...")
-arcpy.MosaicToNewRaster_management(dem_list, r"C:\Users\Gerrit\GIS\optimal_agate_picking\dem_1m.gdb", "north_shore_1m", "", "32_BIT_FLOAT", 1, 1)
+# Creation options of the numpy engine's GeoTIFF output: internally tiled,
+# compressed, and BigTIFF if it needs to be
+GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256',
+                 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER',
+                 'NUM_THREADS=ALL_CPUS']
 
-print("complete")
\ No newline at end of file
+# How the numpy engine resolves cells covered by more than one tile
+METHODS = ('first', 'last', 'min', 'max', 'mean', 'blend')
+
+# File name of the tile footprint index, kept in the DEM folder, and the
+# size in map units (metres for UTM) of the squares it buckets tiles by
+INDEX_NAME = "dem_footprints.json"
+BUCKET_SIZE = 5000
+
+
+class MosaicError(Exception):
+    pass
+
+
+# Where a DEM tile sits and how big it is: its path, the x and y of its
+# top-left corner, its cell size, its columns and rows, its NoData value
+# (or None) and its coordinate system as WKT
+Tile = namedtuple('Tile', 'path left top cellsize cols rows nodata wkt')
+
+
+def list_dems(dem_dir=DEM_DIR, dem_name=DEM_NAME):
+    '''Returns the path of the DEM raster in each geodatabase in dem_dir.'''
+    dem_list = []
+    for directory in sorted(os.listdir(dem_dir)):
+        new_dir = os.path.join(dem_dir, directory.rstrip('\r\n'))
+        if os.path.isdir(new_dir):
+            print("appending " + directory)
+            dem_list.append(os.path.join(new_dir, dem_name))
+    return dem_list
+
+
+def gdal_path(dem):
+    '''Returns the path GDAL opens a raster by. Rasters in a file
+    geodatabase are opened through its OpenFileGDB driver (GDAL 3.7 and up)
+    as OpenFileGDB:"C:\\...\\x.gdb":raster_name.
+    '''
+    gdb, name = os.path.split(dem)
+    if gdb.lower().endswith('.gdb'):
+        return 'OpenFileGDB:"%s":%s' % (gdb, name)
+    return dem
+
+
+def read_tile(dem):
+    '''Returns the Tile of a DEM, read from its header without reading any
+    cells. Rotated rasters and ones with unequal cell width and height
+    aren't supported.
+    '''
+    dataset = gdal.Open(gdal_path(dem))
+    left, cell_x, rotation_x, top, rotation_y, cell_y = \
+        dataset.GetGeoTransform()
+    if rotation_x or rotation_y or abs(cell_x) != abs(cell_y):
+        raise MosaicError(dem + " is rotated or has non-square cells")
+    band = dataset.GetRasterBand(1)
+    return Tile(dem, left, top, cell_x, dataset.RasterXSize,
+                dataset.RasterYSize, band.GetNoDataValue(),
+                dataset.GetProjection())
+
+
+class Grid(namedtuple('Grid', 'left top cellsize cols rows')):
+    '''Output raster grid: the x and y of its top-left corner, its cell size,
+    and its columns and rows.
+    '''
+
+    def clip(self, left, bottom, right, top):
+        '''Returns the part of the grid covering a box in map units, grown
+        out to whole cells.
+        '''
+        col0 = max(0, int(math.floor((left - self.left) / self.cellsize)))
+        col1 = min(self.cols, int(math.ceil((right - self.left)
+                                            / self.cellsize)))
+        row0 = max(0, int(math.floor((self.top - top) / self.cellsize)))
+        row1 = min(self.rows, int(math.ceil((self.top - bottom)
+                                            / self.cellsize)))
+        if col0 >= col1 or row0 >= row1:
+            raise MosaicError("the area of interest doesn't overlap any DEM")
+        return Grid(self.left + col0 * self.cellsize,
+                    self.top - row0 * self.cellsize, self.cellsize,
+                    col1 - col0, row1 - row0)
+
+    def bounds(self, col, row, cols, rows):
+        '''Returns the left, bottom, right and top in map units of a window
+        of the grid.
+        '''
+        return (self.left + col * self.cellsize,
+                self.top - (row + rows) * self.cellsize,
+                self.left + (col + cols) * self.cellsize,
+                self.top - row * self.cellsize)
+
+    def window(self, tile):
+        '''Returns the column and row in the grid of a tile's top-left cell.
+        Tiles must have the grid's cell size and line up with its cells.
+        '''
+        if abs(tile.cellsize - self.cellsize) > 1e-9 * self.cellsize:
+            raise MosaicError("%s has %g cells, not %g" % (
+                tile.path, tile.cellsize, self.cellsize))
+        col = (tile.left - self.left) / self.cellsize
+        row = (self.top - tile.top) / self.cellsize
+        if abs(col - round(col)) > 1e-6 or abs(row - round(row)) > 1e-6:
+            raise MosaicError(tile.path + " doesn't line up with the grid")
+        return int(round(col)), int(round(row))
+
+
+def grid_of(tiles, cellsize=None):
+    '''Returns the smallest Grid covering every tile, with the first tile's
+    cell size unless one is given.
+    '''
+    cellsize = cellsize or tiles[0].cellsize
+    left = min(tile.left for tile in tiles)
+    top = max(tile.top for tile in tiles)
+    right = max(tile.left + tile.cols * tile.cellsize for tile in tiles)
+    bottom = min(tile.top - tile.rows * tile.cellsize for tile in tiles)
+    return Grid(left, top, cellsize,
+                int(round((right - left) / cellsize)),
+                int(round((top - bottom) / cellsize)))
+
+
+def _source_mtime(dem):
+    '''Returns when a DEM last changed. A raster in a file geodatabase
+    isn't a file of its own, so the geodatabase folder's time is used.
+    '''
+    if os.path.exists(dem):
+        return os.path.getmtime(dem)
+    return os.path.getmtime(os.path.dirname(dem))
+
+
+class FootprintIndex(object):
+    '''Spatial index of DEM tiles' footprints, bucketed on a grid of
+    bucket_size squares.
+
+    Each tile is listed in every bucket its footprint touches, so query()
+    only looks at the tiles in the buckets a box touches instead of every
+    tile. Tiles keep the order they were added in, which is the order the
+    first and last overlap methods go by.
+    '''
+
+    def __init__(self, tiles=(), bucket_size=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.tiles = []
+        self.mtimes = []
+        self.buckets = defaultdict(list)
+        for tile in tiles:
+            self.add(tile)
+
+    def _buckets(self, left, bottom, right, top):
+        size = self.bucket_size
+        for i in range(int(math.floor(left / size)),
+                       int(math.floor(right / size)) + 1):
+            for j in range(int(math.floor(bottom / size)),
+                           int(math.floor(top / size)) + 1):
+                yield i, j
+
+    def add(self, tile, mtime=None):
+        number = len(self.tiles)
+        self.tiles.append(tile)
+        self.mtimes.append(mtime)
+        for key in self._buckets(*footprint(tile)):
+            self.buckets[key].append(number)
+
+    def query(self, left, bottom, right, top):
+        '''Returns the tiles whose footprints overlap a box in map units.'''
+        found = set()
+        for key in self._buckets(left, bottom, right, top):
+            for number in self.buckets.get(key, ()):
+                tile_left, tile_bottom, tile_right, tile_top = \
+                    footprint(self.tiles[number])
+                if (tile_left < right and left < tile_right
+                        and tile_bottom < top and bottom < tile_top):
+                    found.add(number)
+        return [self.tiles[number] for number in sorted(found)]
+
+    @classmethod
+    def build(cls, dem_list, path=None, bucket_size=BUCKET_SIZE):
+        '''Function to index DEMs, reusing a saved index.
+
+        1. Takes in the DEM paths, the index file, and the bucket size.
+        2. Loads the index file if there is one, keeping the tiles of DEMs
+        that haven't changed since, and reads the headers of the rest.
+        3. Saves the index back if anything changed, and returns it.
+        '''
+        saved = {}
+        if path and os.path.exists(path):
+            with open(path) as index_file:
+                for entry in json.load(index_file)['tiles']:
+                    saved[entry['tile'][0]] = (entry['mtime'],
+                                               Tile(*entry['tile']))
+        index = cls(bucket_size=bucket_size)
+        changed = len(saved) != len(dem_list)
+        for dem in dem_list:
+            mtime = _source_mtime(dem)
+            if dem in saved and saved[dem][0] == mtime:
+                tile = saved[dem][1]
+            else:
+                print("indexing " + dem)
+                tile = read_tile(dem)
+                changed = True
+            index.add(tile, mtime)
+        if path and changed:
+            index.save(path)
+        return index
+
+    def save(self, path):
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as index_file:
+            json.dump({'tiles': [{'mtime': mtime, 'tile': list(tile)}
+                                 for tile, mtime in zip(self.tiles,
+                                                        self.mtimes)]},
+                      index_file)
+        os.replace(temporary, path)
+
+
+def footprint(tile):
+    '''Returns the left, bottom, right and top of a tile in map units.'''
+    return (tile.left, tile.top - tile.rows * tile.cellsize,
+            tile.left + tile.cols * tile.cellsize, tile.top)
+
+
+def write_header(path, grid, wkt):
+    '''Writes the .hdr and .prj that make a raw .flt file an ESRI float grid
+    ArcGIS (and GDAL) can open.
+    '''
+    base = os.path.splitext(path)[0]
+    with open(base + '.hdr', 'w') as header:
+        header.write("ncols %d\nnrows %d\nxllcorner %r\nyllcorner %r\n"
+                     "cellsize %r\nNODATA_value %r\nbyteorder LSBFIRST\n" % (
+                         grid.cols, grid.rows, grid.left,
+                         grid.top - grid.rows * grid.cellsize, grid.cellsize,
+                         NODATA))
+    if wkt:
+        with open(base + '.prj', 'w') as projection:
+            projection.write(wkt)
+
+
+def read_window(tile, col_off, row_off, cols, rows):
+    '''Returns the part of a tile in a window of the grid, given the tile's
+    own column and row where the window starts, as 32-bit floats with NaN
+    for NoData.
+    '''
+    band = gdal.Open(gdal_path(tile.path)).GetRasterBand(1)
+    block = band.ReadAsArray(col_off, row_off, cols, rows).astype('f4')
+    if tile.nodata is not None:
+        block[block == tile.nodata] = np.nan
+    return block
+
+
+def edge_weights(tile, col_off, row_off, cols, rows):
+    '''Returns the blend weight of each cell of a window of a tile: its
+    distance in cells to the tile's nearest edge, so a tile fades out toward
+    its edges where it overlaps its neighbours.
+    '''
+    row = np.arange(row_off, row_off + rows)
+    col = np.arange(col_off, col_off + cols)
+    return np.minimum.outer(np.minimum(row + 1, tile.rows - row),
+                            np.minimum(col + 1, tile.cols - col)
+                            ).astype('f4')
+
+
+def mosaic_window(tiles, grid, col, row, cols, rows, method='last'):
+    '''Function to mosaic one window of the grid.
+
+    1. Takes in the Tiles, the Grid, the window's first column and row and
+    its size, and the overlap method (one of METHODS).
+    2. Reads the part of each tile that falls in the window and combines
+    them a whole array at a time: the first or last tile's cell, the lowest
+    or highest, the mean, or a blend weighted toward each tile's interior.
+    3. Returns the window as 32-bit floats with NODATA where no tile falls.
+    '''
+    output = np.full((rows, cols), np.nan, dtype='f4')
+    if method in ('mean', 'blend'):
+        weights = np.zeros((rows, cols), dtype='f4')
+        output[:] = 0
+
+    for tile in tiles:
+        col_off, row_off = grid.window(tile)
+        # Overlap of the tile with the window, in grid cells
+        left = max(col, col_off)
+        right = min(col + cols, col_off + tile.cols)
+        top = max(row, row_off)
+        bottom = min(row + rows, row_off + tile.rows)
+        if left >= right or top >= bottom:
+            continue
+        block = read_window(tile, left - col_off, top - row_off,
+                            right - left, bottom - top)
+        window = output[top - row:bottom - row, left - col:right - col]
+
+        if method == 'first':
+            window[:] = np.where(np.isnan(window), block, window)
+        elif method == 'last':
+            window[:] = np.where(np.isnan(block), window, block)
+        elif method == 'min':
+            window[:] = np.fmin(window, block)
+        elif method == 'max':
+            window[:] = np.fmax(window, block)
+        else:
+            if method == 'mean':
+                weight = np.ones(block.shape, dtype='f4')
+            else:
+                weight = edge_weights(tile, left - col_off, top - row_off,
+                                      right - left, bottom - top)
+            weight[np.isnan(block)] = 0
+            window += np.nan_to_num(block) * weight
+            weights[top - row:bottom - row, left - col:right - col] += weight
+
+    if method in ('mean', 'blend'):
+        covered = weights > 0
+        output[covered] /= weights[covered]
+        output[~covered] = NODATA
+    else:
+        output[np.isnan(output)] = NODATA
+    return output
+
+
+def windows(grid, tile_size=TILE_SIZE):
+    '''Yields (col, row, cols, rows) of each tile_size square piece of the
+    grid, the last in each row and column cut to fit.
+    '''
+    for row in range(0, grid.rows, tile_size):
+        for col in range(0, grid.cols, tile_size):
+            yield (col, row, min(tile_size, grid.cols - col),
+                   min(tile_size, grid.rows - row))
+
+
+# Set in each worker process by _start_worker(), so the index and grid are
+# sent to a worker once rather than with every window
+_job = {}
+
+
+def _start_worker(index, grid, method, flt_path):
+    _job.update(index=index, grid=grid, method=method, output=None)
+    if flt_path:
+        _job['output'] = np.memmap(flt_path, dtype='<f4', mode='r+',
+                                   shape=(grid.rows, grid.cols))
+
+
+def _fill_window(window):
+    '''Mosaics a window in a worker process. Into a .flt, it's written
+    straight to the shared memory-mapped file, since no two windows overlap;
+    otherwise it's returned for the parent to write.
+    '''
+    col, row, cols, rows = window
+    tiles = _job['index'].query(*_job['grid'].bounds(col, row, cols, rows))
+    block = mosaic_window(tiles, _job['grid'], col, row, cols, rows,
+                          _job['method'])
+    if _job['output'] is not None:
+        _job['output'][row:row + rows, col:col + cols] = block
+        return col, row, None
+    return col, row, block
+
+
+def mosaic_numpy(tiles, output_path, cellsize=None, method='last',
+                 tile_size=TILE_SIZE, processes=None, aoi=None, index=None):
+    '''Function to mosaic DEM tiles without arcpy, in bounded memory and on
+    every core.
+
+    1. Takes in the Tiles, the path to write (.flt for an ESRI float grid,
+    anything else for a GeoTIFF), the cell size (default the first tile's),
+    the overlap method (one of METHODS), the size of the pieces the mosaic
+    is split into, the number of worker processes (default one per CPU),
+    optionally an area of interest as (left, bottom, right, top) in map
+    units, and the FootprintIndex of the tiles if there is one. With an
+    area of interest, only the tiles overlapping it are read, and only the
+    parts of them inside it.
+    2. Creates the output: a memory-mapped .flt with its .hdr and .prj, or a
+    tiled, DEFLATE-compressed GeoTIFF.
+    3. Splits the grid into tile_size square windows and has a process pool
+    fill them at the same time with mosaic_window(), so no process holds
+    more than a window of the mosaic. Windows of a .flt are written by the
+    workers; windows of a GeoTIFF are written by this process as they
+    finish, compressing on every core.
+    4. Returns the Grid.
+    '''
+    if index is None:
+        index = FootprintIndex(tiles)
+    if aoi is not None:
+        tiles = index.query(*aoi)
+        if not tiles:
+            raise MosaicError("the area of interest doesn't overlap any DEM")
+    grid = grid_of(tiles, cellsize)
+    if aoi is not None:
+        grid = grid.clip(*aoi)
+    flt_path = None
+    if output_path.lower().endswith('.flt'):
+        flt_path = output_path
+        np.memmap(output_path, dtype='<f4', mode='w+',
+                  shape=(grid.rows, grid.cols)).flush()
+        write_header(output_path, grid, tiles[0].wkt)
+        band = None
+    else:
+        dataset = gdal.GetDriverByName('GTiff').Create(
+            output_path, grid.cols, grid.rows, 1, gdal.GDT_Float32,
+            options=GTIFF_OPTIONS)
+        dataset.SetGeoTransform((grid.left, grid.cellsize, 0, grid.top, 0,
+                                 -grid.cellsize))
+        dataset.SetProjection(tiles[0].wkt)
+        band = dataset.GetRasterBand(1)
+        band.SetNoDataValue(NODATA)
+
+    pieces = list(windows(grid, tile_size))
+    pool = multiprocessing.Pool(processes, _start_worker,
+                                (index, grid, method, flt_path))
+    try:
+        for n, (col, row, block) in enumerate(
+                pool.imap_unordered(_fill_window, pieces)):
+            if block is not None:
+                band.WriteArray(block, col, row)
+            print("mosaiced %d of %d pieces" % (n + 1, len(pieces)))
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if band is not None:
+        band.FlushCache()
+        band = dataset = None
+    return grid
+
+
+def mosaic_arcpy(dem_list, output_gdb=OUTPUT_GDB, output_name=OUTPUT_NAME,
+                 cellsize=1):
+    '''Mosaics the DEMs with MosaicToNewRaster, which needs an ArcGIS
+    license.
+    '''
+    arcpy.env.workspace = os.path.dirname(os.path.dirname(dem_list[0]))
+    arcpy.MosaicToNewRaster_management(dem_list, output_gdb, output_name, "",
+                                       "32_BIT_FLOAT", cellsize, 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Mosaic the DEM in each geodatabase in a folder.')
+    parser.add_argument('dem_dir', nargs='?', default=DEM_DIR)
+    parser.add_argument('--engine', choices=('arcpy', 'numpy'),
+                        default='arcpy',
+                        help='arcpy (MosaicToNewRaster) or numpy (GDAL '
+                             'and a process pool, no ArcGIS license needed)')
+    parser.add_argument('--output',
+                        help='for --engine numpy, the GeoTIFF or .flt to '
+                             'write (default north_shore_1m.tif beside '
+                             'dem_dir)')
+    parser.add_argument('--cellsize', type=float,
+                        help='output cell size (default 1 for --engine '
+                             'arcpy, the first DEM\'s cell size for '
+                             '--engine numpy)')
+    parser.add_argument('--method', choices=METHODS, default='last',
+                        help='for --engine numpy, how overlapping tiles are '
+                             'combined (default last, as with arcpy)')
+    parser.add_argument('--processes', type=int,
+                        help='for --engine numpy, worker processes (default '
+                             'one per CPU)')
+    parser.add_argument('--tile-size', type=int, default=TILE_SIZE,
+                        help='for --engine numpy, width and height in cells '
+                             'of the pieces each worker fills (default %d)'
+                             % TILE_SIZE)
+    parser.add_argument('--aoi', type=float, nargs=4,
+                        metavar=('LEFT', 'BOTTOM', 'RIGHT', 'TOP'),
+                        help='for --engine numpy, mosaic only this box, in '
+                             'the DEMs\' map units')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='for --engine numpy, read every DEM\'s header '
+                             'again instead of using the footprint index')
+    args = parser.parse_args()
+
+    dem_list = list_dems(args.dem_dir)
+
+    print("mosaicing...")
+    if args.engine == 'arcpy':
+        if arcpy is None:
+            parser.error("the arcpy engine needs ArcGIS's arcpy")
+        mosaic_arcpy(dem_list, cellsize=args.cellsize or 1)
+    else:
+        if gdal is None:
+            parser.error("the numpy engine needs NumPy and GDAL")
+        output = args.output or os.path.join(
+            os.path.dirname(os.path.abspath(args.dem_dir)),
+            OUTPUT_NAME + '.tif')
+        # Reads each DEM's footprint from the index kept in the DEM folder,
+        # only opening the DEMs that are new or have changed since
+        index_path = os.path.join(args.dem_dir, INDEX_NAME)
+        if args.rebuild_index and os.path.exists(index_path):
+            os.remove(index_path)
+        index = FootprintIndex.build(dem_list, index_path)
+        mosaic_numpy(index.tiles, output, args.cellsize, args.method,
+                     args.tile_size, args.processes, args.aoi, index)
+
+    print("complete")
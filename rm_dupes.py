@@ -1,20 +1,723 @@
 # Script to remove dupilicate images Google Photos/Drive creates when backing up
 # my phone's images. Current record is 288 dupes from 2016.
+#
+# Duplicates are found by content rather than by name, in stages that each
+# only look at the files still in the running:
+#   1. Files are grouped by size. A file with a size no other file has can't
+#      have a duplicate, so most files are ruled out without being opened.
+#   2. Files that share a size are grouped by a hash of their first and last
+#      few KB, which rules out most of the rest with two small reads.
+#   3. Files that still collide are hashed in full.
+# Hashing runs on a thread pool so reading one file overlaps hashing another.
+# Of each set of identical files, the one that looks like the original (no
+# "(1)" on the end of the name, then the oldest) is kept.
+#
+# The hashes are kept in an SQLite index in the directory being cleaned, so a
+# rescan only rehashes files whose size, mtime or inode changed. Deletions
+# are journaled in the same index, and --undo puts back the files deleted by
+# the last run by copying the file each one duplicated.
+#
+# With --similar, images are instead compared by a perceptual hash (dHash or
+# pHash), which survives the re-encoding and resizing backups do to copies.
+# Images are hashed in batches with NumPy and looked up by slices of their
+# hashes (multi-index hashing), so finding every pair within a Hamming
+# distance doesn't compare every image to every other. Similar images are
+# only listed, since they aren't identical.
+#
+# With --recursive the whole tree under the directory is cleaned, walking
+# subdirectories on several threads. Files stream from the walker straight
+# into the size grouping, so only the paths themselves are held in memory.
+# --action picks what's done with each duplicate: deleted (the default),
+# replaced with a hard link to the file kept, moved to a quarantine folder,
+# or just reported.
 import os
+import re
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import functools
+import itertools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-directory = input("Enter directory to clean: ")
+# NumPy and Pillow are only needed for --similar.
+try:
+    import numpy as np
+    from PIL import Image
+except ImportError:
+    np = Image = None
 
-file_list = os.listdir(directory)
+# Bytes read from each end of a file for the partial hash.
+EDGE_BYTES = 4096
 
-del_files = 0
+# Bytes read at a time for the full hash.
+CHUNK_BYTES = 1024 * 1024
 
-# Initiates 'for' loop to cycle through image files stored in file_list
-for files in file_list:
-    print(files)
-    # If there's a ) right before the file extension and the file extension is
-    # only three characters, delete it and keep track of how many are deleted
-    if files[-5] == ")":
-        del_files += 1
-        os.remove(os.path.join(directory, files))
+# Matches the " (1)" or "(1)" Google Photos/Drive adds before the extension.
+COPY_SUFFIX = re.compile(r'\s?\(\d+\)$')
 
-print(str(del_files) + " files deleted")
+# File name of the hash index, kept in the directory being cleaned. Files
+# starting with this (the index and SQLite's journal) are never scanned.
+INDEX_NAME = '.rm_dupes.sqlite'
+
+# Extensions of the files --similar compares.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff',
+                    '.webp')
+
+# Images decoded at a time before their perceptual hashes are computed.
+HASH_BATCH = 256
+
+# Width of the slices perceptual hashes are looked up by, and the number of
+# hashes looked up at a time, when finding similar images.
+SLICE_BITS = 16
+SIMILAR_BLOCK = 65536
+
+# Most candidate pairs expanded at once when finding similar images, so a
+# crowded slice (many images alike in one part of their hash) can't blow up
+# memory.
+SIMILAR_CANDIDATES = 1 << 22
+
+
+def partial_hash(path, size):
+    '''Returns a hash of the first and last EDGE_BYTES of a file, with the
+    size mixed in. Files no bigger than two edges are hashed in full.
+    '''
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(EDGE_BYTES))
+        if size > 2 * EDGE_BYTES:
+            f.seek(-EDGE_BYTES, os.SEEK_END)
+        digest.update(f.read(EDGE_BYTES))
+    return digest.hexdigest()
+
+
+def full_hash(path):
+    '''Returns a hash of the whole of a file.'''
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _regroup(groups, kind, hash_file, pool, index=None):
+    '''Splits each group of paths by hash_file(path, key) on the thread pool
+    and returns the new groups that still have more than one path. Hashes
+    the index already has for a file are used instead of hashing it, and new
+    ones are added to it. Files that can't be read are left out.
+    '''
+    regrouped = defaultdict(list)
+    jobs = []
+    for key, paths in groups.items():
+        for path in paths:
+            digest = index.lookup(path, kind) if index else None
+            if digest is None:
+                jobs.append((path, pool.submit(hash_file, path, key)))
+            else:
+                regrouped[digest].append(path)
+
+    for path, job in jobs:
+        try:
+            digest = job.result()
+        except OSError as e:
+            print('Skipping ' + path + ': ' + str(e))
+            continue
+        regrouped[digest].append(path)
+        if index:
+            index.store(path, kind, digest)
+    if index:
+        index.commit()
+    return {digest: paths for digest, paths in regrouped.items()
+            if len(paths) > 1}
+
+
+def find_duplicates(files, workers=None, index=None, recursive=True):
+    '''Function to find files with identical content.
+
+    1. Takes in an iterable of (path, os.stat_result) pairs, the number of
+    hashing threads (default: a few per CPU, since most of the time is spent
+    waiting on the disk), and optionally the HashIndex to reuse and record
+    hashes in, and whether the files include those of subdirectories, so
+    the index only forgets files gone from the directories scanned.
+    2. Groups the files by size, then by partial_hash(), then by full_hash(),
+    dropping any group left with a single file after each stage.
+    3. Returns a list of lists of paths, each holding identical files.
+    '''
+    by_size = defaultdict(list)
+    inodes = set()
+    for path, stat in files:
+        # Hard links to one file are left alone, since removing them frees
+        # no space. This also keeps the links --action hardlink makes from
+        # being found again on the next run.
+        inode = (stat.st_dev, stat.st_ino)
+        if stat.st_ino and inode in inodes:
+            continue
+        inodes.add(inode)
+        by_size[stat.st_size].append(path)
+        if index:
+            index.update(path, stat)
+    if index:
+        index.prune(recursive)
+    # Empty files are all identical but aren't worth calling duplicates.
+    groups = {size: group for size, group in by_size.items()
+              if len(group) > 1 and size > 0}
+
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(workers) as pool:
+        groups = _regroup(groups, 'partial', partial_hash, pool, index)
+        groups = _regroup(groups, 'full', lambda path, _: full_hash(path),
+                          pool, index)
+    return list(groups.values())
+
+
+class HashIndex(object):
+    '''SQLite index of the files in a directory and their hashes, with a
+    journal of the duplicates deleted from it.
+
+    Paths are stored relative to the directory, so it can be moved or
+    mounted somewhere else without the index going stale. A file's hashes
+    are kept only while its size, mtime and inode are unchanged.
+    '''
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.db = sqlite3.connect(os.path.join(self.root, INDEX_NAME))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                inode INTEGER, partial TEXT, full TEXT, dhash TEXT,
+                phash TEXT, run INTEGER);
+            CREATE TABLE IF NOT EXISTS runs (
+                run INTEGER PRIMARY KEY, started REAL);
+            CREATE TABLE IF NOT EXISTS deletions (
+                run INTEGER, path TEXT, kept TEXT, size INTEGER,
+                mtime_ns INTEGER, full TEXT, deleted REAL,
+                restored REAL);
+        ''')
+        # Indexes made before the perceptual hashes were added lack them.
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(files)')]
+        for column in ('dhash', 'phash'):
+            if column not in columns:
+                self.db.execute('ALTER TABLE files ADD COLUMN ' + column
+                                + ' TEXT')
+        self.run = self.db.execute('INSERT INTO runs (started) VALUES (?)',
+                                   (time.time(),)).lastrowid
+        self.db.commit()
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root)
+
+    def update(self, path, stat):
+        '''Records a file seen in this run, forgetting its hashes if its
+        size, mtime or inode changed since they were taken.
+        '''
+        key = self._relative(path)
+        row = self.db.execute(
+            'SELECT size, mtime_ns, inode FROM files WHERE path = ?',
+            (key,)).fetchone()
+        if row == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            self.db.execute('UPDATE files SET run = ? WHERE path = ?',
+                            (self.run, key))
+        else:
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, '
+                'run) VALUES (?, ?, ?, ?, ?)',
+                (key, stat.st_size, stat.st_mtime_ns, stat.st_ino,
+                 self.run))
+
+    def prune(self, recursive=True, extensions=None):
+        '''Forgets the files that weren't seen in this run, out of those it
+        looked at: only the directory's own files unless recursive, and only
+        files with the given extensions if there are any. The rest keep
+        their hashes for the runs that do look at them.
+        '''
+        stale = [(path,) for path, in self.db.execute(
+                     'SELECT path FROM files WHERE run != ?', (self.run,))
+                 if (recursive or os.sep not in path)
+                 and (not extensions or path.lower().endswith(extensions))]
+        self.db.executemany('DELETE FROM files WHERE path = ?', stale)
+        self.db.commit()
+
+    def lookup(self, path, kind):
+        '''Returns a file's stored hash of the given kind (a column of the
+        files table), or None.
+        '''
+        row = self.db.execute(
+            'SELECT ' + kind + ' FROM files WHERE path = ?',
+            (self._relative(path),)).fetchone()
+        return row[0] if row else None
+
+    def store(self, path, kind, digest):
+        self.db.execute('UPDATE files SET ' + kind + ' = ? WHERE path = ?',
+                        (digest, self._relative(path)))
+
+    def commit(self):
+        self.db.commit()
+
+    def delete(self, path, kept, remove=os.remove):
+        '''Journals a duplicate of the file kept, then removes it with the
+        given function.
+        '''
+        key = self._relative(path)
+        stat = os.stat(path)
+        digest = self.lookup(path, 'full')
+        self.db.execute(
+            'INSERT INTO deletions VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+            (self.run, key, self._relative(kept), stat.st_size,
+             stat.st_mtime_ns, digest, time.time()))
+        self.db.commit()
+        remove(path)
+        self.db.execute('DELETE FROM files WHERE path = ?', (key,))
+        self.db.commit()
+
+    def undo(self):
+        '''Function to put back the files deleted by the last run that
+        deleted any.
+
+        1. Finds that run's journaled deletions that haven't been restored.
+        2. Copies each kept file back to the deleted path, if it still
+        exists and still has the hash the deleted file had, and sets the
+        mtime the deleted file had.
+        3. Returns the number of files restored.
+        '''
+        row = self.db.execute('SELECT MAX(run) FROM deletions '
+                              'WHERE restored IS NULL').fetchone()
+        rows = self.db.execute(
+            'SELECT rowid, path, kept, mtime_ns, full FROM deletions '
+            'WHERE run = ? AND restored IS NULL', (row[0],)).fetchall()
+        restored = 0
+        for rowid, path, kept, mtime_ns, digest in rows:
+            path = os.path.join(self.root, path)
+            kept = os.path.join(self.root, kept)
+            if os.path.exists(path):
+                print('Not restoring ' + path + ': it already exists')
+            elif not os.path.isfile(kept) or full_hash(kept) != digest:
+                print('Cannot restore ' + path + ': ' + kept
+                      + ' is gone or has changed')
+            else:
+                shutil.copy2(kept, path)
+                os.utime(path, ns=(mtime_ns, mtime_ns))
+                self.db.execute('UPDATE deletions SET restored = ? '
+                                'WHERE rowid = ?', (time.time(), rowid))
+                self.db.commit()
+                restored += 1
+        return restored
+
+    def close(self):
+        self.db.close()
+
+
+def original_first(paths):
+    '''Returns the paths of identical files ordered so the one to keep comes
+    first: names without a copy suffix, then the oldest, then the shortest.
+    '''
+    def rank(path):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return (COPY_SUFFIX.search(stem) is not None,
+                os.path.getmtime(path), len(path), path)
+    return sorted(paths, key=rank)
+
+
+def _dct_matrix(size):
+    '''Returns the orthonormal DCT-II matrix of the given size.'''
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n + 1) * n[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+def _load_image(path, shape):
+    '''Returns an image as a grayscale float32 array resized to shape
+    (rows, columns), or None if it can't be read.
+    '''
+    try:
+        with Image.open(path) as image:
+            # Lets JPEGs decode straight to a fraction of their size, which
+            # is most of the time saved on big photos.
+            image.draft('L', (shape[1] * 4, shape[0] * 4))
+            image = image.convert('L').resize((shape[1], shape[0]),
+                                              Image.BILINEAR)
+            return np.asarray(image, dtype=np.float32)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        print('Skipping ' + path + ': ' + str(e))
+        return None
+
+
+def _pack_bits(bits):
+    '''Returns a 64-bit integer for each row of a (batch, 64) boolean
+    array.
+    '''
+    packed = np.packbits(bits, axis=1).view('>u8')[:, 0]
+    return [int(value) for value in packed]
+
+
+def dhash_batch(pixels):
+    '''Returns the difference hash of each image in a (batch, 8, 9) array:
+    a bit for whether each pixel is brighter than the one to its right.
+    '''
+    bits = pixels[:, :, :-1] > pixels[:, :, 1:]
+    return _pack_bits(bits.reshape(len(pixels), 64))
+
+
+def phash_batch(pixels):
+    '''Returns the DCT hash of each image in a (batch, 32, 32) array: a bit
+    for whether each of the lowest 8x8 frequencies is above their median.
+    '''
+    dct = _dct_matrix(pixels.shape[1])
+    low = (dct @ pixels @ dct.T)[:, :8, :8].reshape(len(pixels), 64)
+    # The DC term is just the average brightness, so it's left out of the
+    # median.
+    median = np.median(low[:, 1:], axis=1)
+    return _pack_bits(low > median[:, None])
+
+
+# Image shape each hash is computed from, and the function computing it.
+PERCEPTUAL_HASHES = {'dhash': ((8, 9), dhash_batch),
+                     'phash': ((32, 32), phash_batch)}
+
+
+def perceptual_hashes(paths, method='phash', workers=None, index=None):
+    '''Function to compute the perceptual hashes of images.
+
+    1. Takes in a list of image paths, the hash to use (a key of
+    PERCEPTUAL_HASHES), the number of decoding threads, and optionally the
+    HashIndex to reuse and record hashes in.
+    2. Decodes HASH_BATCH images at a time on a thread pool, stacks them
+    into one array and hashes the whole batch with NumPy.
+    3. Returns a dictionary of path to 64-bit hash. Images that can't be
+    read are left out.
+    '''
+    shape, hash_batch = PERCEPTUAL_HASHES[method]
+    hashes = {}
+    todo = []
+    for path in paths:
+        digest = index.lookup(path, method) if index else None
+        if digest is None:
+            todo.append(path)
+        else:
+            hashes[path] = int(digest, 16)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as pool:
+        for start in range(0, len(todo), HASH_BATCH):
+            batch = todo[start:start + HASH_BATCH]
+            pixels = pool.map(_load_image, batch, [shape] * len(batch))
+            loaded = [(path, image) for path, image in zip(batch, pixels)
+                      if image is not None]
+            if not loaded:
+                continue
+            batch_hashes = hash_batch(np.stack([i for _, i in loaded]))
+            for (path, _), digest in zip(loaded, batch_hashes):
+                hashes[path] = digest
+                if index:
+                    index.store(path, method, '%016x' % digest)
+            if index:
+                index.commit()
+    return hashes
+
+
+def _flip_masks(bits, radius):
+    '''Returns every value of the given width with at most radius bits set.
+    '''
+    masks = [0]
+    for count in range(1, radius + 1):
+        for positions in itertools.combinations(range(bits), count):
+            masks.append(sum(1 << position for position in positions))
+    return masks
+
+
+def similar_pairs(values, distance):
+    '''Function to find the pairs of 64-bit hashes within a Hamming
+    distance, by multi-index hashing.
+
+    1. Takes in a sequence of hashes and the largest distance.
+    2. Identical hashes (such as those of many all-black images) are
+    compared once: each copy is paired only with the first, and the distinct
+    hashes are matched against each other. For that they're split into
+    SLICE_BITS-bit slices. Two hashes within k of each other have a slice
+    within k // slices of each other, so for each slice and each way of
+    flipping that many of its bits or fewer, each hash is matched against
+    the hashes whose slice equals its flipped slice, found by binary search
+    on a sorted copy. Only those candidates have their full distance
+    measured, at most SIMILAR_CANDIDATES (or one hash's candidates, if
+    more) at a time.
+    3. Returns arrays of the indexes i and j of pairs, with i < j, that
+    connect every hash to every hash within distance of it, either directly
+    or through the first of its copies. A pair can appear more than once.
+    '''
+    values = np.asarray(values, dtype=np.uint64)
+    distinct, first, copies = np.unique(values, return_index=True,
+                                        return_inverse=True)
+    copies = copies.ravel()
+    slices = 64 // SLICE_BITS
+    masks = _flip_masks(SLICE_BITS, distance // slices)
+    popcount = np.array([bin(n).count('1') for n in range(256)], np.uint8)
+    # Pairs each copy of a hash with the first of them.
+    repeated = np.flatnonzero(first[copies] != np.arange(len(values)))
+    found_i, found_j = [first[copies[repeated]]], [repeated]
+
+    for s in range(slices):
+        keys = ((distinct >> np.uint64(s * SLICE_BITS))
+                & np.uint64(2 ** SLICE_BITS - 1))
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        for start in range(0, len(distinct), SIMILAR_BLOCK):
+            block = np.arange(start,
+                              min(start + SIMILAR_BLOCK, len(distinct)))
+            for mask in masks:
+                probe = keys[block] ^ np.uint64(mask)
+                low = np.searchsorted(sorted_keys, probe, 'left')
+                counts = np.searchsorted(sorted_keys, probe, 'right') - low
+                ends = np.cumsum(counts)
+                cuts = np.searchsorted(
+                    ends, np.arange(SIMILAR_CANDIDATES, ends[-1],
+                                    SIMILAR_CANDIDATES), 'right')
+                for part in np.split(np.arange(len(block)), cuts):
+                    # Expands each hash into one row per hash in its
+                    # matching run of the sorted slice.
+                    part_counts = counts[part]
+                    i = np.repeat(block[part], part_counts)
+                    offsets = (np.arange(part_counts.sum())
+                               - np.repeat(np.cumsum(part_counts)
+                                           - part_counts, part_counts))
+                    j = order[np.repeat(low[part], part_counts) + offsets]
+                    keep = i < j
+                    i, j = i[keep], j[keep]
+                    xor = (distinct[i] ^ distinct[j]).view(np.uint8)
+                    keep = (popcount[xor].reshape(-1, 8).sum(axis=1)
+                            <= distance)
+                    i, j = first[i[keep]], first[j[keep]]
+                    found_i.append(np.minimum(i, j))
+                    found_j.append(np.maximum(i, j))
+    return np.concatenate(found_i), np.concatenate(found_j)
+
+
+def find_similar(hashes, distance):
+    '''Function to group images with similar perceptual hashes.
+
+    1. Takes in a dictionary of path to hash and the largest Hamming
+    distance counted as similar.
+    2. Finds the similar pairs with similar_pairs() and joins them into
+    groups with a union-find, so images similar through a third are
+    grouped together.
+    3. Returns a list of lists of paths, each holding similar images.
+    '''
+    paths = list(hashes)
+    if not paths:
+        return []
+    parents = list(range(len(paths)))
+
+    def find(n):
+        while parents[n] != n:
+            parents[n] = parents[parents[n]]
+            n = parents[n]
+        return n
+
+    pairs_i, pairs_j = similar_pairs([hashes[p] for p in paths], distance)
+    for i, j in zip(pairs_i.tolist(), pairs_j.tolist()):
+        parents[find(j)] = find(i)
+
+    groups = defaultdict(list)
+    for n, path in enumerate(paths):
+        groups[find(n)].append(path)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+
+def _scan_directory(directory, skip):
+    '''Returns the (path, os.stat_result) of each regular file in a
+    directory and the paths of its subdirectories, leaving out the hash index
+    and the paths in skip. Symbolic links aren't followed.
+    '''
+    files = []
+    directories = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.path in skip or entry.name.startswith(INDEX_NAME):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    files.append((entry.path,
+                                  entry.stat(follow_symlinks=False)))
+    except OSError as e:
+        print('Skipping ' + directory + ': ' + str(e))
+    return files, directories
+
+
+def walk_files(directory, recursive=False, walkers=4, skip=()):
+    '''Function to list the files to look for duplicates in.
+
+    1. Takes in the directory, whether to go into its subdirectories, the
+    number of directories to scan at once, and paths to leave out (such as
+    the quarantine folder).
+    2. Scans directories on a thread pool, handing each one's subdirectories
+    back to the pool as it finishes, with at most walkers scans in flight.
+    3. Yields (path, os.stat_result) for each regular file as its directory
+    is scanned, so the whole tree is never listed at once.
+    '''
+    directory = os.path.abspath(directory)
+    skip = {os.path.abspath(path) for path in skip}
+    if not recursive:
+        yield from _scan_directory(directory, skip)[0]
+        return
+
+    pending = [directory]
+    with ThreadPoolExecutor(max(1, walkers)) as pool:
+        running = set()
+        while pending or running:
+            while pending and len(running) < walkers:
+                running.add(pool.submit(_scan_directory, pending.pop(),
+                                        skip))
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for job in done:
+                files, directories = job.result()
+                pending.extend(directories)
+                yield from files
+
+
+def report(path, keep, index):
+    print('Would remove ' + path + ', a duplicate of ' + keep)
+
+
+def delete(path, keep, index):
+    if index:
+        index.delete(path, keep)
+    else:
+        os.remove(path)
+
+
+def hardlink(path, keep, index):
+    '''Replaces a duplicate with a hard link to the file kept. The link is
+    made beside it first and renamed over it, so the path is never missing.
+    '''
+    temporary = path + '.rm_dupes_link'
+    os.link(keep, temporary)
+    try:
+        os.replace(temporary, path)
+    except OSError:
+        os.remove(temporary)
+        raise
+
+
+def quarantine(path, keep, index, directory, folder):
+    '''Moves a duplicate into the quarantine folder, keeping its path
+    relative to the directory being cleaned. Bound to those two with
+    functools.partial before use.
+    '''
+    destination = os.path.join(folder, os.path.relpath(path, directory))
+
+    def move(path):
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(path, destination)
+
+    if index:
+        index.delete(path, keep, move)
+    else:
+        move(path)
+
+
+# What can be done with each duplicate, called with its path, the path of
+# the file kept and the HashIndex (or None), and how to report the total.
+ACTIONS = {'report': (report, 'files would be removed'),
+           'delete': (delete, 'files deleted'),
+           'hardlink': (hardlink, 'files replaced with hard links'),
+           'quarantine': (quarantine, 'files moved to quarantine')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Remove duplicate files from a directory.')
+    parser.add_argument('directory', nargs='?',
+                        help='directory to clean (prompted for if not given)')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='clean subdirectories too')
+    parser.add_argument('--action', choices=sorted(ACTIONS),
+                        default='delete',
+                        help='what to do with each duplicate (default '
+                             'delete)')
+    parser.add_argument('--dry-run', dest='action', action='store_const',
+                        const='report', help='same as --action report')
+    parser.add_argument('--quarantine',
+                        help='folder for --action quarantine (default '
+                             '.rm_dupes_quarantine in the directory)')
+    parser.add_argument('--workers', type=int,
+                        help='number of hashing threads')
+    parser.add_argument('--walkers', type=int, default=4,
+                        help='directories scanned at once with --recursive '
+                             '(default 4)')
+    parser.add_argument('--no-index', action='store_true',
+                        help="don't keep a hash index in the directory "
+                             "(deletions can't be undone)")
+    parser.add_argument('--undo', action='store_true',
+                        help='put back the files deleted by the last run')
+    parser.add_argument('--similar', action='store_true',
+                        help='list images that look alike instead of '
+                             'removing identical files')
+    parser.add_argument('--hash', choices=sorted(PERCEPTUAL_HASHES),
+                        default='phash',
+                        help='perceptual hash for --similar (default phash)')
+    parser.add_argument('--distance', type=int, default=6,
+                        help='most bits of 64 two images\' hashes can '
+                             'differ by and still be similar (default 6)')
+    args = parser.parse_args()
+
+    directory = args.directory or input("Enter directory to clean: ")
+    quarantine_folder = args.quarantine or os.path.join(
+        directory, '.rm_dupes_quarantine')
+    files = walk_files(directory, args.recursive, args.walkers,
+                       skip=[quarantine_folder])
+
+    index = None if args.no_index else HashIndex(directory)
+
+    if args.undo:
+        if index is None:
+            parser.error('--undo needs the hash index')
+        print(str(index.undo()) + " files restored")
+    elif args.similar:
+        if np is None:
+            parser.error('--similar needs NumPy and Pillow')
+        images = []
+        for path, stat in files:
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(path)
+                if index:
+                    index.update(path, stat)
+        if index:
+            index.prune(args.recursive, IMAGE_EXTENSIONS)
+
+        hashes = perceptual_hashes(images, args.hash, args.workers, index)
+        groups = find_similar(hashes, args.distance)
+        for group in groups:
+            print('Similar: ' + ', '.join(os.path.relpath(path, directory)
+                                          for path in group))
+        print(str(len(groups)) + " sets of similar images")
+    else:
+        action, message = ACTIONS[args.action]
+        if args.action == 'quarantine':
+            action = functools.partial(action, directory=directory,
+                                       folder=quarantine_folder)
+        del_files = 0
+
+        # Keeps the first of each set of identical files and hands the rest
+        # to the action, keeping track of how many there are
+        for group in find_duplicates(files, args.workers, index,
+                                     args.recursive):
+            keep, *dupes = original_first(group)
+            for path in dupes:
+                try:
+                    action(path, keep, index)
+                except OSError as e:
+                    print('Could not remove ' + path + ': ' + str(e))
+                    continue
+                del_files += 1
+
+        print(str(del_files) + " " + message)
+
+    if index:
+        index.close()